@@ -17,6 +17,7 @@ from sqlalchemy.orm import configure_mappers
 
 from config import Config_is
 from app.services.custom_errors import *
+from app.services.db_pool import engine_options
 
 
 # make_versioned()
@@ -151,8 +152,7 @@ def create_app(config_class=Config_is):
     compress.init_app(app)
     cors.init_app(app)
     app.config.from_object(config_class)
-    app.config['SQLALCHEMY_POOL_RECYCLE'] = 30
-    app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
     db.init_app(app)
     migrate.init_app(app, db)
     # limiter = Limiter(
@@ -231,5 +231,10 @@ def create_app(config_class=Config_is):
     app.register_blueprint(lead_management_bp, url_prefix='/lead-management')
     app.register_blueprint(report_bp, url_prefix='/report')
     app.register_blueprint(elevenlabs_bp, url_prefix='/elevenlabs')
+
+    from app.commands import create_indexes_command, explain_indexes_command, partition_tables_command
+    app.cli.add_command(create_indexes_command)
+    app.cli.add_command(explain_indexes_command)
+    app.cli.add_command(partition_tables_command)
     return app
 
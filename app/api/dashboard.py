@@ -4,6 +4,11 @@ from flask import (
     )
 
 from app.api.auth import tokenAuth
+from app.services.auth import admin_authorizer
+from app.services.aggregate_cache import aggregate_cache_stats
+from app.services.task_queues import task_queue_metrics
+from app.services.db_pool import db_pool_metrics
+from app import tasks
 from app.services.dashboard import (
     get_leads_sold_complete_incomplete_count,
     get_dashboard_recent_leads, 
@@ -254,4 +259,129 @@ def dashboard_count_status():
 @tokenAuth.login_required
 def dashboard_lead_flow():
     data = get_dashboard_lead_flow(request.args.get('time_zone'))
-    return jsonify({"data": data, "message": "Success", "status": 200})
\ No newline at end of file
+    return jsonify({"data": data, "message": "Success", "status": 200})
+
+
+@dashboard_bp.route("/cache-stats", methods=['GET'])
+@tokenAuth.login_required
+@admin_authorizer
+def dashboard_cache_stats():
+    """
+    ---
+    tags:
+      - Dashboard
+    summary: Aggregate cache counters
+    description: Hit, miss, single-flight wait and invalidation counters of the dashboard and report cache.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Counters per cache namespace
+        schema:
+          type: object
+          properties:
+            data:
+              type: object
+              example: {"dashboard": {"hit": 120, "miss": 8, "wait_hit": 2, "wait_timeout": 0, "invalidated": 5, "hit_ratio": 0.9375, "ttl_seconds": 300}}
+            message:
+              type: string
+              example: Success
+            status:
+              type: integer
+              example: 200
+    """
+    return jsonify({"data": aggregate_cache_stats(), "message": "Success", "status": 200})
+
+
+@dashboard_bp.route("/queue-metrics", methods=['GET'])
+@tokenAuth.login_required
+@admin_authorizer
+def dashboard_queue_metrics():
+    """
+    ---
+    tags:
+      - Dashboard
+    summary: Background task queue metrics
+    description: Waiting messages, queue wait of the last started tasks and worker profile of each Celery queue.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Metrics per queue
+        schema:
+          type: object
+          properties:
+            data:
+              type: object
+              example: {"ivr-realtime": {"depth": 0, "latency_samples": 500, "latency_p50_seconds": 0.04, "latency_p95_seconds": 0.3, "latency_max_seconds": 1.2, "concurrency": 4, "prefetch_multiplier": 4}}
+            message:
+              type: string
+              example: Success
+            status:
+              type: integer
+              example: 200
+    """
+    return jsonify({"data": task_queue_metrics(), "message": "Success", "status": 200})
+
+
+@dashboard_bp.route("/db-pool-metrics", methods=['GET'])
+@tokenAuth.login_required
+@admin_authorizer
+def dashboard_db_pool_metrics():
+    """
+    ---
+    tags:
+      - Dashboard
+    summary: Database pool and query fan-out metrics
+    description: Connection pool usage and checkout waits, and the shared fan-out executor queue of the serving process.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Pool and fan-out metrics
+        schema:
+          type: object
+          properties:
+            data:
+              type: object
+              example: {"pool": {"size": 10, "max_overflow": 4, "checked_out": 3, "checked_in": 7, "overflow": -7, "checkouts": 1520, "avg_wait_ms": 0.02, "max_wait_ms": 4.1, "timeouts": 0}, "fanout": {"workers": 8, "queued": 0, "submitted": 64, "started": 64, "avg_queue_wait_ms": 0.3, "max_queue_wait_ms": 12.5}}
+            message:
+              type: string
+              example: Success
+            status:
+              type: integer
+              example: 200
+    """
+    return jsonify({"data": db_pool_metrics(), "message": "Success", "status": 200})
+
+
+@dashboard_bp.route("/rollup/rebuild", methods=["POST"])
+@tokenAuth.login_required
+@admin_authorizer
+def rebuild_dashboard_rollup():
+    """
+    Recompute the dashboard daily rollup
+    ---
+    tags:
+      - Dashboard
+    summary: Queue a rebuild of the dashboard daily rollup
+    description: >
+        The last two days are refreshed every 5 minutes and the dashboard window is rebuilt daily.
+        Use this after a deployment or a bulk data fix.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Rebuild queued
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: success
+            status:
+              type: integer
+              example: 200
+    """
+    tasks.rebuild_dashboard_rollup.delay()
+    return jsonify({'message': 'success', 'status': 200})
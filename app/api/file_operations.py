@@ -1,6 +1,6 @@
 """API Endpoints related to File uploader and download."""
 import json
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, Response, stream_with_context
 from app.services.file_operations import (
     download_mortgage_file,
     uploaded_file_info_list,
@@ -8,8 +8,10 @@ from app.services.file_operations import (
     csv_mailing_input_with_mortgage_id,
     report_download_processed_mailer_leads,
     upload_purchase_agreement,
-    download_campaign_leads
+    download_campaign_leads,
+    EXPORT_FORMATS
 )
+from app.services.mailer_ingest import get_mailer_upload_progress
 from app.services.leads_operations import all_download_agent_mailing_leads
 from app.api.auth import tokenAuth
 from app.services.auth import admin_authorizer
@@ -21,6 +23,17 @@ from constants import (
 files_bp = Blueprint("file_operations", __name__)
 
 
+def export_response(chunks, export_format: str, file_name: str) -> Response:
+    """
+    Streaming response for the csv/ndjson export mode
+    """
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename={file_name}.{export_format}"}
+        )
+
+
 @files_bp.route('/upload/purchase_agreement/<id_>', methods=["POST"])
 @tokenAuth.login_required
 def uploading_purchase_agreement(id_):
@@ -120,19 +133,22 @@ def uploading_csv_file_with_mortgage_id():
         description: Category ID for this upload
     responses:
       200:
-        description: File processed and records saved successfully
+        description: >
+          File stored on S3 and queued for the background ingest.
+          Poll /files/upload/mailer-with-mortgage/{job_id}/progress for the result.
         schema:
           type: object
           properties:
             data:
               type: object
               properties:
-                file_id:
-                  type: string
-                total_rows:
+                job_id:
                   type: integer
-                threads:
+                file_id:
                   type: integer
+                status:
+                  type: string
+                  example: Queued
             message:
               type: string
               example: success
@@ -152,6 +168,63 @@ def uploading_csv_file_with_mortgage_id():
     return jsonify({"data": data, "message": "success", "status": 200})
 
 
+@files_bp.route("/upload/mailer-with-mortgage/<int:job_id>/progress", methods=["GET"])
+@tokenAuth.login_required
+@admin_authorizer
+def mailer_upload_progress(job_id):
+    """
+    Mailer Upload Progress
+    ---
+    tags:
+      - Files
+    summary: Progress of a queued mailer upload
+    security:
+      - ApiKeyAuth: []
+    parameters:
+      - name: job_id
+        in: path
+        type: integer
+        required: true
+        description: job_id returned by /upload/mailer-with-mortgage
+    responses:
+      200:
+        description: Current counters of the upload job
+        schema:
+          type: object
+          properties:
+            data:
+              type: object
+              properties:
+                file_id:
+                  type: integer
+                status:
+                  type: string
+                  example: Processing
+                rows_parsed:
+                  type: integer
+                rows_inserted:
+                  type: integer
+                rows_rejected:
+                  type: integer
+                message:
+                  type: string
+                  description: Failure reason when the status is Failed
+                timings:
+                  type: object
+                  description: Seconds spent in each phase (copy, merge, total)
+            message:
+              type: string
+              example: success
+            status:
+              type: integer
+              example: 200
+      204:
+        description: Unknown job id
+    """
+    data = get_mailer_upload_progress(job_id)
+    return jsonify({"data": data, "message": "success", "status": 200})
+
+
 # @files_bp.route("/upload_digital_leads", methods=['POST'])
 # @tokenAuth.login_required
 # @admin_authorizer
@@ -189,6 +262,14 @@ def downloading_mortgage(file_id):
         type: string
         required: true
         description: Campaign name associated with this upload
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [csv, ndjson]
+        description: >
+          Stream the rows as CSV or NDJSON in a single pass over a server side cursor
+          instead of the JSON payload. Recommended for large exports.
     responses:
       200:
         description: List of mortgage leads retrieved successfully
@@ -265,7 +346,10 @@ def downloading_mortgage(file_id):
       404:
         description: File or campaign not found
     """
-    response = download_mortgage_file(file_id, request.args["campaign"])
+    export_format = request.args.get("format")
+    response = download_mortgage_file(file_id, request.args["campaign"], export_format)
+    if export_format:
+        return export_response(response, export_format, f"uploaded_mailer_{file_id}")
     return jsonify(
         {
             "data": response, 
@@ -309,6 +393,16 @@ def uploaded_file_info_listing_page(category_id):
         type: string
         required: false
         description: Search keyword to filter by campaign name.
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Keyset pagination token, send it empty for the first page and then the pagination next value.
+      - name: exact_total
+        in: query
+        type: integer
+        required: false
+        description: 1 to count the exact total in keyset mode, otherwise the total is an estimate.
     responses:
       200:
         description: A list of uploaded files.
@@ -335,6 +429,9 @@ def uploaded_file_info_listing_page(category_id):
                 length:
                   type: integer
                   description: Number of items returned in current page.
+                next:
+                  type: string
+                  description: Keyset token of the next page, only in keyset mode.
             message:
               type: string
               example: Success
@@ -355,6 +452,8 @@ def uploaded_file_info_listing_page(category_id):
         int(request.args.get("page", 1)),
         int(request.args.get("per_page", 10)),
         request.args.get("search"),
+        request.args.get("after"),
+        request.args.get("exact_total") == "1",
     )
     return jsonify(
         {
@@ -387,6 +486,14 @@ def downloading_completed_leads():
         type: integer
         required: false
         description: Agent ID to filter leads by. Required if the user is an admin (role_id = 1).
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [csv, ndjson]
+        description: >
+          Stream the rows as CSV or NDJSON in a single pass over a server side cursor
+          instead of the JSON payload. Recommended for large exports.
     responses:
       200:
         description: List of completed leads retrieved successfully
@@ -461,7 +568,10 @@ def downloading_completed_leads():
               type: integer
               example: 200
     """
-    response = download_all_mailer_leads_except_mailed(request.args.get("agent_id"))
+    export_format = request.args.get("format")
+    response = download_all_mailer_leads_except_mailed(request.args.get("agent_id"), export_format)
+    if export_format:
+        return export_response(response, export_format, "all_except_mailer")
     return jsonify(
         {
             "data": response,
@@ -515,6 +625,18 @@ def downloading_processed_leads():
                 type: boolean
                 example: true
                 description: (Optional) Filter by completed status
+              health:
+                type: string
+                example: "1"
+                description: (Optional) Filter by the health keypad answer, "1" yes "0" no
+              tobacco:
+                type: string
+                example: "0"
+                description: (Optional) Filter by the tobacco keypad answer, "1" yes "0" no
+              coborrower:
+                type: string
+                example: "1"
+                description: (Optional) Filter by the coborrower keypad answer, "1" yes "0" no
     responses:
       200:
         description: Successfully retrieved processed leads or pagination metadata
@@ -623,6 +745,14 @@ def getting_leads_for_download(category):
         required: false
         default: 10
         description: Total number of leads to fetch (used for pagination/threading)
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [csv, ndjson]
+        description: >
+          Stream the rows as CSV or NDJSON in a single pass over a server side cursor
+          instead of the JSON payload. Recommended for large exports.
     requestBody:
       required: true
       content:
@@ -737,9 +867,12 @@ def getting_leads_for_download(category):
               example: 200
     """
     if category == 1:
+        export_format = request.args.get("format")
         result = all_download_agent_mailing_leads(
-            request.json, int(request.args.get("total", 10))
+            request.json, int(request.args.get("total", 10)), export_format
         )
+        if export_format:
+            return export_response(result, export_format, "leads_details")
         # elif category == 2:
         #     result = all_download_agent_digital_leads(int(request.args.get('agent_id')), int(request.args.get('source_id')), request.json, int(request.args.get('total', 10)), request.args.get('suppressed'))
     return jsonify({"data": result, "message": "success", "status": 200})
@@ -771,6 +904,14 @@ def download_leads_by_campaign():
             description: Name (or slug) of the campaign whose leads you want to download
             type: string
             example: july‑2025‑refi
+          - name: format
+            in: query
+            type: string
+            required: false
+            enum: [csv, ndjson]
+            description: >
+              Stream the rows as CSV or NDJSON in a single pass over a server side cursor
+              instead of the JSON payload. Recommended for large exports.
 
         produces:
           - application/json
@@ -843,7 +984,10 @@ def download_leads_by_campaign():
                   type: integer
                   example: 200
         """
-        leads = download_campaign_leads(request.args.get("campaign"))
+        export_format = request.args.get("format")
+        leads = download_campaign_leads(request.args.get("campaign"), export_format)
+        if export_format:
+            return export_response(leads, export_format, "campaign_leads")
         return jsonify({
             "data": leads,
             "headings": CSV_DOWNLOAD_MORTGAGE_FIELDS,  
@@ -65,6 +65,16 @@ def view_leads(category):
         required: false
         description: Number of results per page (default is 10).
         example: 10
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Keyset pagination token, send it empty for the first page and then the pagination next value.
+      - name: exact_total
+        in: query
+        type: integer
+        required: false
+        description: 1 to count the exact total in keyset mode, otherwise the total is an estimate.
       - name: body
         in: body
         required: true
@@ -130,6 +140,8 @@ def view_leads(category):
             request.json,
             int(request.args.get("page", 1)),
             int(request.args.get("per_page", 10)),
+            request.args.get("after"),
+            request.args.get("exact_total") == "1",
         )
         # elif category == 2:
         #     result, pagination = get_agent_digital_leads_excluding_suppressed(
@@ -1012,6 +1024,18 @@ def getting_suppression_requests_list(category):
         default: 10
         description: Number of items per page
 
+      - name: after
+        in: query
+        required: false
+        type: string
+        description: Keyset pagination token, send it empty for the first page and then the pagination next value
+
+      - name: exact_total
+        in: query
+        required: false
+        type: integer
+        description: 1 to count the exact total in keyset mode, otherwise the total is an estimate
+
     responses:
       200:
         description: Paginated list of suppression requests
@@ -1090,6 +1114,9 @@ def getting_suppression_requests_list(category):
                 per_page:
                   type: integer
                   example: 10
+                next:
+                  type: string
+                  description: Keyset token of the next page, only in keyset mode
             message:
               type: string
               example: success
@@ -1099,7 +1126,8 @@ def getting_suppression_requests_list(category):
     """
     if category == 1:
         data, pagination = list_mailing_suppression_requests(
-            int(request.args.get("page", 1)), int(request.args.get("per_page", 10))
+            int(request.args.get("page", 1)), int(request.args.get("per_page", 10)),
+            request.args.get("after"), request.args.get("exact_total") == "1"
         )
     # elif category == 2:
     #     data, pagination = list_digital_suppression_requests(int(request.args.get('source_id')),
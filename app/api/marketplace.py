@@ -11,6 +11,8 @@ from app.services.marketplace import (
     getting_leads_orders
     )
 from app.services.custom_errors import Forbidden
+from app.services.reservation_ledger import reservation_ledger_metrics
+from app import tasks
 
 
 marketplace_bp = Blueprint('Marketplace API', __name__)
@@ -402,4 +404,76 @@ def get_leads_orders(user_id):
         request.args.get('order_id'),
         request.args.get('cart_item_id')
     )
-    return jsonify({'data': result,  "pagination": pagination, 'message': 'success', 'status': 200})
\ No newline at end of file
+    return jsonify({'data': result,  "pagination": pagination, 'message': 'success', 'status': 200})
+
+
+@marketplace_bp.route("/inventory/rebuild", methods=["POST"])
+@tokenAuth.login_required
+@admin_authorizer
+def rebuild_marketplace_inventory():
+    """
+    Recompute the marketplace inventory
+    ---
+    tags:
+      - Marketplace
+    summary: Queue a full rebuild of the marketplace inventory table
+    description: >
+        The inventory is kept up to date on IVR calls, status changes, reservations and purchases
+        and rebuilt daily. Use this after a deployment or a bulk data fix.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Rebuild queued
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: success
+            status:
+              type: integer
+              example: 200
+    """
+    tasks.rebuild_marketplace_inventory.delay()
+    return jsonify({'message': 'success', 'status': 200})
+
+
+@marketplace_bp.route("/reservations/metrics", methods=["GET"])
+@tokenAuth.login_required
+@admin_authorizer
+def marketplace_reservation_metrics():
+    """
+    Checkout reservation ledger metrics
+    ---
+    tags:
+      - Marketplace
+    summary: Count and age of the reserved marketplace checkouts
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Reservation metrics
+        schema:
+          type: object
+          properties:
+            data:
+              type: object
+              properties:
+                active_reservations:
+                  type: integer
+                  example: 4
+                expired_pending_release:
+                  type: integer
+                  example: 0
+                oldest_reservation_age_seconds:
+                  type: integer
+                  example: 540
+            message:
+              type: string
+              example: success
+            status:
+              type: integer
+              example: 200
+    """
+    return jsonify({'data': reservation_ledger_metrics(), 'message': 'success', 'status': 200})
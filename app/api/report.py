@@ -7,6 +7,7 @@ from flask import (
 from app.api.auth import tokenAuth
 from app.services.report import ReportAndAnalytics
 from app.services.auth import admin_authorizer
+from app import tasks
 
 report_bp = Blueprint('Report and Analtics', __name__)
 
@@ -179,3 +180,35 @@ def get_total_leads_and_sold_count():
         request.args.get('end_date')
         ).getting_total_leads_and_sold_count()
     return jsonify({"data": data, "message": "success", "status": 200})
+
+
+@report_bp.route("/summary/rebuild", methods=["POST"])
+@tokenAuth.login_required
+@admin_authorizer
+def rebuild_report_summary():
+    """
+    Recompute the daily report summary
+    ---
+    tags:
+      - Reports
+    summary: Queue a full rebuild of the daily report summary
+    description: >
+        The summary is refreshed on lead status changes, sales docs uploads and IVR calls,
+        and the day that ended is stored nightly. Use this after a deployment or a bulk data fix.
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Rebuild queued
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: success
+            status:
+              type: integer
+              example: 200
+    """
+    tasks.rebuild_report_summary.delay()
+    return jsonify({'message': 'success', 'status': 200})
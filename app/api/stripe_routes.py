@@ -19,6 +19,7 @@ from app.services.stripe_payment import (
     update_payment_failed_status
     )
 from app.services.crud import CRUD
+from app.services.aggregate_cache import invalidate_aggregate_cache
     
 from app.services.custom_errors import *
 from config import Config_is
@@ -429,6 +430,8 @@ def stripe_webhook_validation():
                 subscription_webhook(str(hook.id), request.json)
             # if 'customer.subscription.created' in request.json['type']:
             #     subscription_webhook(str(hook.id), request.json)
+        # revenue and marketplace sales counts of the dashboard
+        invalidate_aggregate_cache("dashboard")
     return jsonify({'message': 'success', 'status': 200})
 
 # @stripe_bp.route('/cards/save', methods=['POST'])
@@ -441,6 +441,18 @@ def list_paginated_users():
         required: false
         description: Filter by user name (partial match allowed)
 
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Keyset pagination token, send it empty for the first page and then the pagination next value
+
+      - name: exact_total
+        in: query
+        type: integer
+        required: false
+        description: 1 to count the exact total in keyset mode, otherwise the total is an estimate
+
     responses:
       200:
         description: List of users
@@ -494,7 +506,9 @@ def list_paginated_users():
     data, pagination = list_users_with_filter(
         int(args.pop('page', 1)),
         int(args.pop('per_page', 10)),
-        args
+        args,
+        args.pop('after', None),
+        args.pop('exact_total', None) == '1'
     )
     return jsonify({"data": data, "pagination": pagination, "message": "Success", "status": 200})
 
@@ -0,0 +1,199 @@
+"""Management commands, run with flask --app runserver <command>."""
+import json
+from datetime import date, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import or_, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from app import db
+from app.models import MailingAssignee as MA, MailingLead as ML, MailingResponse as MR
+from app.services.table_partitions import PARTITIONED_TABLES, convert_to_partitioned
+
+
+# Document columns declared JSONB, databases created before still hold them as json
+JSONB_COLUMNS = {
+    "mailing_lead": ["csv_data"],
+    "mailing_response": ["ivr_response", "ivr_logs", "temp_data"],
+    "mailing_assignee": ["moved_history"],
+    "subscription_order_summary": ["invoice_data"],
+    "marketplace_order_summary": ["invoice_data"],
+    }
+# Indexes of the lead, marketplace and search queries, built without locking the tables for writes
+CONCURRENT_INDEXES = {
+    "mailing_lead": [
+        "ix_mailing_lead_saleable", "ix_mailing_lead_reserved_by",
+        "ix_mailing_lead_full_name_trgm", "ix_mailing_lead_address_trgm", "ix_mailing_lead_city_trgm",
+        ],
+    "mailing_response": ["ix_mailing_response_mortgage_call", "ix_mailing_response_ivr_response"],
+    "mailing_assignee": [
+        "ix_mailing_assignee_agent_purchased_status", "ix_mailing_assignee_sold_date",
+        "ix_mailing_assignee_campaign_name_trgm",
+        ],
+    "user": ["ix_user_name_trgm"],
+    }
+# Single column indexes the ones above replace, dropped once those are built
+SUPERSEDED_INDEXES = [
+    "ix_mailing_lead_mortgage_id", "ix_mailing_lead_can_sale", "ix_mailing_lead_disabled_in_marketplace",
+    "ix_mailing_lead_is_in_checkout", "ix_mailing_lead_item_reserved_temp_by",
+    "ix_mailing_response_id", "ix_mailing_response_completed", "ix_mailing_response_mortgage_id",
+    "ix_mailing_assignee_id", "ix_mailing_assignee_agent_id", "ix_mailing_assignee_lead_status",
+    ]
+
+
+def _index_plan_checks() -> dict:
+    """
+    {index: statement}, the hot query shapes each index is there for:
+    the marketplace stock and reservation filter, the agent lead view, the latest call of a lead
+    """
+    return {
+        "ix_mailing_lead_saleable": select(ML.mortgage_id).where(
+            ML.state == "CA", ML.source_id == 1, ML.can_sale == True, ML.disabled_in_marketplace == False,
+            or_(ML.last_purchased_date == None, ML.last_purchased_date < date.today() - timedelta(days=30)),
+            ML.is_in_checkout == False
+            ),
+        "ix_mailing_assignee_agent_purchased_status": select(MA.id, MA.mortgage_id).where(
+            MA.agent_id.in_([1, 2]), MA.purchased_user_id == None, MA.lead_status == 1
+            ),
+        "ix_mailing_response_mortgage_call": select(MR.call_in_date_time).where(
+            MR.mortgage_id == "1000001"
+            ).order_by(MR.call_in_date_time.desc()).limit(1),
+        }
+
+
+INDEX_ROOT = text("""
+    SELECT COALESCE(pg_partition_root(cls.oid), cls.oid)::regclass::text FROM pg_class cls
+    WHERE cls.relname = :name AND pg_table_is_visible(cls.oid)
+    """)
+COLUMN_TYPE = text("""
+    SELECT data_type FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column
+    """)
+INDEX_STATE = text("""
+    SELECT index.indisvalid FROM pg_class cls JOIN pg_index index ON index.indexrelid = cls.oid
+    WHERE cls.relname = :name
+    """)
+LIST_PARTITIONS = text("""
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    WHERE parent.relname = :table ORDER BY child.relname
+    """)
+
+
+def _index_ddl(index, table: str, name: str, only: bool = False) -> str:
+    """
+    CREATE INDEX CONCURRENTLY of the model index on table under name, a plain CREATE INDEX
+    ON ONLY for the parent of a partitioned table
+    """
+    dialect = postgresql.dialect()
+    quote = dialect.identifier_preparer.quote
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)).replace(
+        f"IF NOT EXISTS {quote(index.name)} ON {quote(index.table.name)} ",
+        f"IF NOT EXISTS {quote(name)} ON {'ONLY ' if only else ''}{quote(table)} ", 1
+        )
+    # the parent index is only declared, each partition builds its own concurrently
+    return ddl if only else ddl.replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1)
+
+
+def _run(connection, sql: str, dry_run: bool) -> None:
+    click.echo(f"{sql};")
+    if not dry_run:
+        connection.execute(text(sql))
+
+
+def _create_index(connection, ddl: str, name: str, dry_run: bool) -> None:
+    """
+    A failed concurrent build leaves an invalid index behind, it is dropped and built again
+    """
+    valid = connection.execute(INDEX_STATE, {"name": name}).scalar()
+    if valid is False:
+        _run(connection, f"DROP INDEX CONCURRENTLY IF EXISTS {name}", dry_run)
+    if valid is not True:
+        _run(connection, ddl, dry_run)
+
+
+@click.command("create-indexes")
+@click.option("--dry-run", is_flag=True, help="Prints the statements without running them")
+@with_appcontext
+def create_indexes_command(dry_run: bool) -> None:
+    """
+    Converts the json columns to JSONB, builds the model indexes on an existing database with
+    CREATE INDEX CONCURRENTLY, then drops the superseded ones. Safe to run again, an interrupted
+    run picks up where it stopped. The type change rewrites the table under an exclusive lock.
+    """
+    tables = db.metadata.tables
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for table, columns in JSONB_COLUMNS.items():
+            for column in columns:
+                if connection.execute(COLUMN_TYPE, {"table": table, "column": column}).scalar() == "json":
+                    _run(connection, f"ALTER TABLE {table} ALTER COLUMN {column} TYPE jsonb USING {column}::jsonb", dry_run)
+        _run(connection, "CREATE EXTENSION IF NOT EXISTS pg_trgm", dry_run)
+        for table, names in CONCURRENT_INDEXES.items():
+            indexes = {index.name: index for index in tables[table].indexes}
+            partitions = [name for (name,) in connection.execute(LIST_PARTITIONS, {"table": table})]
+            for name in names:
+                index = indexes[name]
+                if not partitions:
+                    _create_index(connection, _index_ddl(index, table, name), name, dry_run)
+                    continue
+                if connection.execute(INDEX_STATE, {"name": name}).scalar():
+                    continue
+                _run(connection, _index_ddl(index, table, name, only=True), dry_run)
+                for partition in partitions:
+                    partition_index = f"{name}_{partition[len(table) + 1:]}"
+                    _create_index(connection, _index_ddl(index, partition, partition_index), partition_index, dry_run)
+                    # the parent index turns valid once every partition has its index attached
+                    _run(connection, f"ALTER INDEX {name} ATTACH PARTITION {partition_index}", dry_run)
+        for name in SUPERSEDED_INDEXES:
+            _run(connection, f"DROP INDEX CONCURRENTLY IF EXISTS {name}", dry_run)
+
+
+@click.command("partition-tables")
+@with_appcontext
+def partition_tables_command() -> None:
+    """
+    Converts the plain call and status log tables into month partitioned ones, one transaction
+    per table. A table already partitioned is skipped, so the command can be run again.
+    """
+    for table in PARTITIONED_TABLES:
+        try:
+            result = convert_to_partitioned(table)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        click.echo(result)
+
+
+def _plan_indexes(plan: dict) -> set:
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        names |= _plan_indexes(child)
+    return names
+
+
+@click.command("explain-indexes")
+@with_appcontext
+def explain_indexes_command() -> None:
+    """
+    Asserts the planner serves each hot query from its index, a partition index counts for the
+    index of its parent. Plans follow the table statistics, run it against a database holding
+    production sized data, an almost empty one is answered from whichever index comes first.
+    """
+    failed = []
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        for expected, statement in _index_plan_checks().items():
+            compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+            plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}").scalar()
+            plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+            used = {connection.execute(INDEX_ROOT, {"name": name}).scalar() for name in _plan_indexes(plan)}
+            click.echo(f"{expected}: {'ok' if expected in used else 'MISSING'}, plan uses {sorted(used)}")
+            if expected not in used:
+                failed.append(expected)
+        connection.rollback()
+    if failed:
+        raise click.ClickException(f"hot queries not served by {failed}")
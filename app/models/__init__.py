@@ -12,6 +12,7 @@ from app.models.uploaded_file import UploadedFile
 from app.models.template import InputFileTemplate
 from app.models.shopping_cart import ShoppingCart
 from app.models.sendgrid_log import SendgridLog
+from app.models.sms_log import SmsLog
 from app.models.discount_code import (
     CouponCode, PromotionCode,
     CouponAssignedProduct, UserPromotionCodeAssignment, UserPromotionCodeHistory
@@ -27,6 +28,11 @@ from app.models.mailing_leads import (
     MailingLeadMemberStatusLog
     )
 
+from app.models.marketplace_inventory import MarketplaceInventory
+from app.models.dashboard_rollup import DashboardDailyRollup
+from app.models.report_summary import ReportDailySummary
+from app.models.lead_archive import ArchivedLead
+
 from app.models.stripe_webhook import StripeWebhook
 from app.models.stripe_subscription import StripeCustomerSubscription
 
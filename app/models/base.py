@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from sqlalchemy import DDL, event
+
 from app import db
 
 
@@ -9,3 +11,16 @@ class BaseModel(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     modified_at = db.Column(db.DateTime, default=db.func.now(),
                            onupdate=datetime.utcnow, index=True)
+
+
+# The trigram indexes need the extension, a migration adding one runs op.execute of this first
+TRGM_EXTENSION = DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+event.listen(db.metadata, "before_create", TRGM_EXTENSION)
+
+
+def trgm_index(name: str, column: str) -> db.Index:
+    """
+    GIN trigram index serving ILIKE '%term%' and similarity() on the column. Takes the column
+    name, a column of the class body has no name yet for postgresql_ops to be keyed on.
+    """
+    return db.Index(name, column, postgresql_using="gin", postgresql_ops={column: "gin_trgm_ops"})
@@ -0,0 +1,18 @@
+"""Model for the daily dashboard rollup."""
+from app import db
+from app.models.base import BaseModel
+
+
+class DashboardDailyRollup(BaseModel):
+    __tablename__ = "dashboard_daily_rollup"
+    """
+    Dashboard counters per UTC day, the month figures are sums of these rows
+    """
+    day = db.Column(db.Date, primary_key=True)
+    calls = db.Column(db.Integer, default=0, nullable=False)  # called leads with an assignee
+    unsold_calls = db.Column(db.Integer, default=0, nullable=False)  # of them, with an assignee not sold
+    completed_calls = db.Column(db.Integer, default=0, nullable=False)
+    sold = db.Column(db.Integer, default=0, nullable=False)  # leads sold that day
+    new_users = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)  # paid subscription orders of active subscriptions
+    marketplace_sales = db.Column(db.Integer, default=0, nullable=False)
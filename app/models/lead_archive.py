@@ -0,0 +1,20 @@
+"""Model for the index of the archived mailing leads."""
+from sqlalchemy.dialects.postgresql import JSONB
+
+from app import db
+from app.models.base import BaseModel
+
+
+class ArchivedLead(BaseModel):
+    __tablename__ = "archived_lead"
+    """
+    Lead moved to the S3 archive with its assignees, responses and status logs.
+    Only the columns the lookups need are kept, the rest is read back from object_key.
+    """
+    mortgage_id = db.Column(db.String(30), primary_key=True)
+    uuid = db.Column(db.String(10))
+    state = db.Column(db.String(60))
+    full_name = db.Column(db.String(120))
+    created_date = db.Column(db.Date)
+    agent_ids = db.Column(JSONB, default=[])  # agents the lead was assigned to, for the search permission
+    object_key = db.Column(db.String(200), nullable=False, index=True)  # gzip JSON lines, one lead per line
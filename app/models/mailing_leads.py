@@ -1,16 +1,26 @@
 """Models for storing the uploaded mailing file contents."""
 
 from datetime import datetime
-from sqlalchemy import Sequence
-from sqlalchemy.dialects.postgresql import UUID
+from zoneinfo import ZoneInfo
+from sqlalchemy import DDL, Sequence, event
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 
 from app import db
-from app.models.base import BaseModel
+from app.models.base import BaseModel, trgm_index
+from config import Config_is
+
+
+def call_time_now() -> datetime:
+    """
+    Current time in the time zone the IVR webhooks write call_in_date_time in, naive like the column
+    """
+    return datetime.now(ZoneInfo(Config_is.TIME_ZONE)).replace(tzinfo=None)
+
 
 class MailingLead(BaseModel):
     __tablename__ = "mailing_lead"
     """Table for storing the Mailing Leads from the input CSV file"""
-    mortgage_id = db.Column(db.String(30), primary_key=True, index=True)
+    mortgage_id = db.Column(db.String(30), primary_key=True)
     temp_mortgage_id = db.Column(db.String(14), nullable=True, index=True)
     uuid = db.Column(db.String(10), index=True)
     file_id = db.Column(db.Integer, db.ForeignKey(
@@ -20,26 +30,26 @@ class MailingLead(BaseModel):
     city = db.Column(db.String(100), index=True)
     state = db.Column(db.String(60), index=True)
     zip = db.Column(db.String(10))
-    full_name = db.Column(db.String(120), index=True)
+    full_name = db.Column(db.String(120))
     first_name = db.Column(db.String(120))
     last_name = db.Column(db.String(120))
     loan_date = db.Column(db.Date)
     loan_amount = db.Column(db.Float)
     lender_name = db.Column(db.String(200))
     loan_type = db.Column(db.String(100))
-    csv_data = db.Column(db.JSON, default={})
-    address = db.Column(db.String(230), index=True)
+    csv_data = db.Column(JSONB, default={})
+    address = db.Column(db.String(230))
     # (1: 'not a duplicate', 2: old duplicate, 3: latest duplicate call received)
     duplicate_status = db.Column(db.Integer, default=0, index=True)
     created_date = db.Column(db.Date, index=True)  # Store US/Pacific date
     last_purchased_date = db.Column(db.Date, index=True)
     # marketplace
     source_id = db.Column(db.Integer, index=True)
-    can_sale = db.Column(db.Boolean, default=True, index=True)
-    disabled_in_marketplace = db.Column(db.Boolean, default=False, index=True) # as required we can disable specific leads from the marketplace
-    is_in_checkout = db.Column(db.Boolean, default=False, index=True)
+    can_sale = db.Column(db.Boolean, default=True)
+    disabled_in_marketplace = db.Column(db.Boolean, default=False) # as required we can disable specific leads from the marketplace
+    is_in_checkout = db.Column(db.Boolean, default=False)
     shopping_cart_temp_id = db.Column(db.String(45), index=True) # temporary storage
-    item_reserved_temp_by = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), index=True, nullable=True) # temporary storage of a
+    item_reserved_temp_by = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id"), nullable=True) # temporary storage of a
 
     # relationship
     file_info = db.relationship(
@@ -49,35 +59,65 @@ class MailingLead(BaseModel):
     agent_info = db.relationship(
         "Agent", viewonly=True, backref="mailing_lead_initial_owner", uselist=False)
     # mailing_response = db.relationship("MailingResponse", backref="mailing_response_fetch", cascade="all,delete", uselist=False)
-    
+
+    __table_args__ = (
+        # marketplace stock and checkout reservation, both filter the sellable leads by state and source
+        db.Index(
+            'ix_mailing_lead_saleable', state, source_id, last_purchased_date,
+            postgresql_where=db.and_(can_sale == True, disabled_in_marketplace == False)
+            ),
+        db.Index(
+            'ix_mailing_lead_reserved_by', item_reserved_temp_by,
+            postgresql_where=is_in_checkout == True
+            ),
+        # lead search, substring match on the name, address and city
+        trgm_index('ix_mailing_lead_full_name_trgm', 'full_name'),
+        trgm_index('ix_mailing_lead_address_trgm', 'address'),
+        trgm_index('ix_mailing_lead_city_trgm', 'city'),
+        )
+
 
 class MailingResponse(BaseModel):
     __tablename__ = "mailing_response"
+    """Calls of the leads, range partitioned by month of call_in_date_time"""
 
-    id = db.Column('id', db.Integer, primary_key=True, index=True)
-    completed = db.Column(db.Boolean, default=False, index=True)
-    call_in_date_time = db.Column(db.DateTime, index=True)
-    ivr_response = db.Column(db.JSON, default={})
-    ivr_logs = db.Column(db.JSON, default=[])
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True)
+    completed = db.Column(db.Boolean, default=False)
+    # partition key, part of the primary key as postgres requires. Local time of Config_is.TIME_ZONE,
+    # a response opened by a progress event gets the current time until its call start
+    call_in_date_time = db.Column(db.DateTime, primary_key=True, default=call_time_now, index=True)
+    ivr_response = db.Column(JSONB, default={})
+    ivr_logs = db.Column(JSONB, default=[])  # appended in place with ||, never rewritten from python
     # caller = db.Column(db.String(60), index=True)
-    temp_data = db.Column(db.JSON, default={})
-    mortgage_id = db.Column(db.String(30), db.ForeignKey("mailing_lead.mortgage_id", ondelete="CASCADE"), nullable=True, index=True)
+    temp_data = db.Column(JSONB, default={})
+    mortgage_id = db.Column(db.String(30), db.ForeignKey("mailing_lead.mortgage_id", ondelete="CASCADE"), nullable=True)
     call_sid = db.Column(db.String(60), index=True)
     lead_info = db.relationship(
         "MailingLead", viewonly=True, backref="mailing_response_lead_info", uselist=False)
 
+    __table_args__ = (
+        # lead view ordered by the latest call of the lead
+        db.Index('ix_mailing_response_mortgage_call', mortgage_id, call_in_date_time.desc()),
+        # keypad answer filters of the processed leads download, ivr_response @> '{"tobacco": "1"}'
+        db.Index(
+            'ix_mailing_response_ivr_response', ivr_response,
+            postgresql_using='gin', postgresql_ops={'ivr_response': 'jsonb_path_ops'}
+            ),
+        {'postgresql_partition_by': 'RANGE (call_in_date_time)'},
+        )
+
 
 
 class MailingAssignee(BaseModel):
     __tablename__ = "mailing_assignee"
     """Table for storing the mailing leads assigned to the agents"""
 
-    id = db.Column('id', db.Integer, primary_key=True, index=True)
+    id = db.Column('id', db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey(
-        "agent.id", ondelete='SET NULL'), index=True)
+        "agent.id", ondelete='SET NULL'))
     mortgage_id = db.Column(db.String(30), db.ForeignKey(
         "mailing_lead.mortgage_id", ondelete="CASCADE"), nullable=True, index=True)
-    lead_status = db.Column(db.Integer, default=1, index=True)
+    lead_status = db.Column(db.Integer, default=1)
     lead_status_changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     notes = db.Column(db.Text)
     # Marketplace
@@ -101,7 +141,7 @@ class MailingAssignee(BaseModel):
     moved_from_agent_id = db.Column(db.Integer, db.ForeignKey(
         "agent.id", ondelete='SET NULL'), index=True)
     moved_by_user = db.Column(UUID(as_uuid=True))
-    moved_history = db.Column(db.JSON, default=[])
+    moved_history = db.Column(JSONB, default=[])  # appended in place with ||
     moved_at = db.Column(db.DateTime, nullable=True)
 
     # ghl_client_id = db.Column(db.String(40), index=True)
@@ -116,13 +156,32 @@ class MailingAssignee(BaseModel):
     # user_info = db.relationship("User", viewonly=True, backref="lead_member_purchased_user_detail", uselist=False)
     # cart_info = db.relationship("ShoppingCart", viewonly=True, backref="lead_member_shopping_cart_info", uselist=False)
 
+    __table_args__ = (
+        # lead view of the agents, own leads (purchased_user_id null) or the purchased ones, per status
+        db.Index('ix_mailing_assignee_agent_purchased_status', agent_id, purchased_user_id, lead_status),
+        db.Index('ix_mailing_assignee_sold_date', sold_date, postgresql_where=lead_status == 7),
+        trgm_index('ix_mailing_assignee_campaign_name_trgm', 'campaign_name'),
+        )
+
 
 class MailingLeadMemberStatusLog(BaseModel):
     __tablename__ = "mailing_lead_member_status_log"
-    """Table for storing the status history"""
+    """Table for storing the status history, range partitioned by month of created_at"""
 
-    id = db.Column('id', db.Integer, primary_key=True, index=True)
+    id = db.Column('id', db.Integer, primary_key=True, autoincrement=True, index=True)
+    created_at = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow, index=True)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey("user.id", ondelete="CASCADE"), index=True, nullable=True)
     mailing_assignee_id = db.Column(db.Integer, db.ForeignKey(
         "mailing_assignee.id", ondelete="CASCADE"), index=True)
-    lead_status = db.Column(db.Integer, default=1, index=True)
\ No newline at end of file
+    lead_status = db.Column(db.Integer, default=1, index=True)
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
+
+
+# The month partitions are added by table_partitions, the default one holds the rows of
+# the months without a partition until they are split out of it
+for partitioned_table in (MailingResponse.__table__, MailingLeadMemberStatusLog.__table__):
+    event.listen(
+        partitioned_table, "after_create",
+        DDL("CREATE TABLE IF NOT EXISTS %(table)s_default PARTITION OF %(table)s DEFAULT")
+        )
@@ -0,0 +1,16 @@
+"""Model for the precomputed marketplace inventory."""
+from app import db
+from app.models.base import BaseModel
+
+
+class MarketplaceInventory(BaseModel):
+    __tablename__ = "marketplace_inventory"
+    """
+    Saleable mailing leads count per state, source, completed and call in date.
+    The month buckets of PRICING_DETAIL_MONTH are summed from the call in dates at read time.
+    """
+    state = db.Column(db.String(60), primary_key=True)
+    source_id = db.Column(db.Integer, primary_key=True)  # 0: lead without a source
+    completed = db.Column(db.Boolean, primary_key=True)
+    call_date = db.Column(db.Date, primary_key=True, index=True)
+    lead_count = db.Column(db.Integer, default=0, nullable=False)
@@ -1,6 +1,6 @@
 from uuid import uuid4
 
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy import Identity
 
 from app import db
@@ -30,7 +30,7 @@ class SubscriptionOrderSummary(BaseModel):
     stripe_product_id = db.Column(db.String(40))
     stripe_price_id = db.Column(db.String(40))
     description = db.Column(db.String(230), nullable=True)
-    invoice_data = db.Column(db.JSON, default={})
+    invoice_data = db.Column(JSONB, default={})
     states_chosen = db.Column(db.JSON, default=[])
     # card_brand = db.Column(db.String(40)) # payload['data']['object']['charges']['data'][0]['payment_method_details']['card']['brand']
     # card_expiry_month = payload['data']['object']['charges']['data'][0]['payment_method_details']['card']['exp_year']
@@ -61,7 +61,7 @@ class MarketplaceOrderSummary(BaseModel):
     promo_code_db_id = db.Column(UUID(as_uuid=True), db.ForeignKey('promotion_code.id', ondelete="CASCADE"), nullable=True)
     # stripe_promotion_id = db.Column(db.String(40))
     payment_status = db.Column(db.String(30), index=True)
-    invoice_data = db.Column(db.JSON, default={})
+    invoice_data = db.Column(JSONB, default={})
     # discount_code = db.Column(UUID(as_uuid=True), db.ForeignKey("discount_code.id", ondelete="CASCADE"),nullable=True, index=True)
     user_info = db.relationship("User", viewonly=True, backref="mp_user_order_summary", uselist=False)
 
@@ -0,0 +1,18 @@
+"""Model for the daily report summary."""
+from app import db
+from app.models.base import BaseModel
+
+
+class ReportDailySummary(BaseModel):
+    __tablename__ = "report_daily_summary"
+    """
+    Report counters per UTC day, lead state and assignee lead status.
+    A date range report sums these rows, the running day is read live.
+    """
+    day = db.Column(db.Date, primary_key=True)
+    state = db.Column(db.String(60), primary_key=True)  # '': lead without a state
+    lead_status = db.Column(db.Integer, primary_key=True)
+    sold = db.Column(db.Integer, default=0, nullable=False)  # leads with that sold date, lead_status 7 only
+    assignee_calls = db.Column(db.Integer, default=0, nullable=False)  # assignees of the leads called that day
+    completed_assignee_calls = db.Column(db.Integer, default=0, nullable=False)
+    incomplete_assignee_calls = db.Column(db.Integer, default=0, nullable=False)
@@ -0,0 +1,15 @@
+from sqlalchemy.dialects.postgresql import UUID
+
+from app import db
+from app.models.base import BaseModel
+
+
+class SmsLog(BaseModel):
+    __tablename__ = 'sms_log'
+    id = db.Column(UUID(as_uuid=True), primary_key=True, index=True)
+    to_number = db.Column(db.String(20), nullable=False, index=True)
+    from_number = db.Column(db.String(20))
+    event = db.Column(db.Integer)  # 1: User Invitation, 9: IVR alert
+    sid = db.Column(db.String(50), nullable=True)
+    status = db.Column(db.String(20))  # twilio status, failed when it was not accepted
+    error = db.Column(db.Text)
@@ -17,6 +17,10 @@ class UploadedFile(BaseModel):
     source_id = db.Column(db.Integer, index=True) # Example: NewMTG
     category = db.Column(db.Integer, index=True)  # LEAD_CATEGORY (MAILING, DIGITAL LEADS)
     total_records = db.Column(db.Integer, default=0)
+    # Background ingest (MAILER_UPLOAD_STATUS), rows_parsed is the checkpoint of the last committed chunk
+    upload_status = db.Column(db.Integer, default=3, index=True)
+    rows_parsed = db.Column(db.Integer, default=0)
+    rows_rejected = db.Column(db.Integer, default=0)
     uploaded_by = db.Column(UUID(as_uuid=True), db.ForeignKey(
         "user.id", ondelete="CASCADE"))
     # Relationship
@@ -31,6 +35,8 @@ class UploadedFile(BaseModel):
             campaign=self.campaign,
             source_id=self.source_id,
             category=self.category,
+            total_records=self.total_records,
+            upload_status=self.upload_status,
             created_at=convert_utc_to_timezone(self.created_at)
         )
         return data
@@ -9,8 +9,11 @@ from werkzeug.security import (
     )
 
 from app import db, redis_obj
-from app.models.base import BaseModel
+from app.models.base import BaseModel, trgm_index
 from app.services.utils import convert_utc_to_timezone
+from app.services.token_cache import (
+    token_cache, publish_token_invalidation
+    )
 from config import Config_is
 
 
@@ -55,6 +58,10 @@ class User(BaseModel):
         "UploadedFile", backref="user_uploaded_files", lazy=True)
     agents = db.relationship("Agent", backref="user_agents", lazy=True)
 
+    __table_args__ = (
+        trgm_index('ix_user_name_trgm', 'name'),  # user and agent search by name
+        )
+
     def login_to_dict(self):
         """
         Logged-in user info from object to dict
@@ -145,11 +152,14 @@ class User(BaseModel):
         """
         Verifying the user token valid or not
         """
+        cached = token_cache.get(key_ends_with, token)
+        if cached is not None:
+            return cached
         serializer = URLSafeTimedSerializer(Config_is.SECRET_KEY)
         try:
-            data = serializer.loads(token)
-            data = serializer.loads(token, max_age=expires_in)
+            data, signed_at = serializer.loads(token, max_age=expires_in, return_timestamp=True)
             if verify_user_token_in_cache(f"{data['id']}_{key_ends_with}", token):
+                token_cache.set(key_ends_with, token, data, signed_at.timestamp() + expires_in)
                 return data
             return data
         except Exception as e:
@@ -173,11 +183,14 @@ def remove_user_token(key: str, user_auth_token: Optional[str] = None):
     Remove user token from redis
     """
     print(key)
+    user_id, _, key_ends_with = key.partition('_')
     if user_auth_token:
         if redis_obj.get(key) == user_auth_token:
             redis_obj.delete(key)
+        publish_token_invalidation(user_id, key_ends_with, user_auth_token)
     else:
         redis_obj.delete(key)
+        publish_token_invalidation(user_id)
     return True
 
 
@@ -188,4 +201,5 @@ def logout_user_from_all_devices(user_id: str) -> bool:
     keys = redis_obj.keys(f"{user_id}_*")
     for key in keys:
         redis_obj.delete(key)
+    publish_token_invalidation(user_id)
     return True
@@ -0,0 +1,112 @@
+"""Read-through redis cache for the dashboard and report aggregates."""
+import json
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+
+from flask import current_app
+
+from app import redis_obj
+
+
+AGGREGATE_CACHE_TTL = {"dashboard": 300, "report": 900}
+AGGREGATE_CACHE_LOCK_SECONDS = 30
+AGGREGATE_CACHE_WAIT_SECONDS = 5
+AGGREGATE_CACHE_STATS_KEY = "agg_cache_stats"
+
+
+def _namespace_version(namespace: str) -> str:
+    return redis_obj.get(f"agg_cache_version:{namespace}") or "0"
+
+
+def aggregate_cache_key(namespace: str, name: str, key_parts: tuple) -> str:
+    """
+    agg_cache:<namespace>:v<version>:<function>:<time zone / date range ...>
+    Bumping the namespace version orphans every key of it, the TTL cleans them up.
+    """
+    parts = ":".join(str(part) for part in key_parts)
+    return f"agg_cache:{namespace}:v{_namespace_version(namespace)}:{name}:{parts}"
+
+
+def _count(namespace: str, event: str) -> None:
+    try:
+        redis_obj.hincrby(AGGREGATE_CACHE_STATS_KEY, f"{namespace}:{event}", 1)
+    except Exception as e:
+        print(f"aggregate cache counter {namespace} {event} {e}")
+
+
+def cached_aggregate(namespace: str, key: Optional[Callable] = None):
+    """
+    Cache the JSON of the wrapped function result under the (function, key arguments) key.
+    Only one caller recomputes an expired key, the others wait for its result.
+    key: builds the key parts from the call arguments, defaults to the positional arguments.
+    """
+    ttl = AGGREGATE_CACHE_TTL[namespace]
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if redis_obj is None:
+                return func(*args, **kwargs)
+            try:
+                key_parts = key(*args, **kwargs) if key else args + tuple(sorted(kwargs.items()))
+                cache_key = aggregate_cache_key(namespace, func.__qualname__, tuple(key_parts))
+                cached = redis_obj.get(cache_key)
+            except Exception as e:
+                print(f"cached_aggregate {func.__qualname__} {e}")
+                return func(*args, **kwargs)
+            if cached is not None:
+                _count(namespace, "hit")
+                return json.loads(cached)
+            _count(namespace, "miss")
+            lock_key = f"{cache_key}:lock"
+            if not redis_obj.set(lock_key, 1, nx=True, ex=AGGREGATE_CACHE_LOCK_SECONDS):
+                deadline = time.monotonic() + AGGREGATE_CACHE_WAIT_SECONDS
+                while time.monotonic() < deadline:
+                    time.sleep(0.1)
+                    cached = redis_obj.get(cache_key)
+                    if cached is not None:
+                        _count(namespace, "wait_hit")
+                        return json.loads(cached)
+                _count(namespace, "wait_timeout")
+                return func(*args, **kwargs)
+            try:
+                result = func(*args, **kwargs)
+                # Same serializer as jsonify so a cached response matches a fresh one
+                serialized = current_app.json.dumps(result)
+                redis_obj.setex(cache_key, ttl, serialized)
+                return json.loads(serialized)
+            finally:
+                redis_obj.delete(lock_key)
+        return wrapper
+    return decorator
+
+
+def invalidate_aggregate_cache(*namespaces: str) -> None:
+    """
+    Drop the cached aggregates after a write that changes them
+    (lead status change, IVR completion, stripe payment).
+    """
+    if redis_obj is None:
+        return
+    for namespace in namespaces or tuple(AGGREGATE_CACHE_TTL):
+        try:
+            redis_obj.incr(f"agg_cache_version:{namespace}")
+            _count(namespace, "invalidated")
+        except Exception as e:
+            print(f"invalidate_aggregate_cache {namespace} {e}")
+
+
+def aggregate_cache_stats() -> Dict[str, Any]:
+    stats = redis_obj.hgetall(AGGREGATE_CACHE_STATS_KEY) if redis_obj is not None else {}
+    result = {}
+    for namespace in AGGREGATE_CACHE_TTL:
+        counts = {
+            event: int(stats.get(f"{namespace}:{event}", 0))
+            for event in ("hit", "miss", "wait_hit", "wait_timeout", "invalidated")
+            }
+        lookups = counts["hit"] + counts["miss"]
+        counts["hit_ratio"] = round(counts["hit"] / lookups, 4) if lookups else None
+        counts["ttl_seconds"] = AGGREGATE_CACHE_TTL[namespace]
+        result[namespace] = counts
+    return result
@@ -85,6 +85,13 @@ class AmazonServices:
         print(status)
         return status
 
+    def get_object_stream(self, path: str):
+        """
+        Streaming body of an s3 object, read it lazily instead of downloading to disk
+        """
+        response = self.s3_client.get_object(Bucket=Config_is.S3_BUCKET_NAME, Key=path)
+        return response["Body"]
+
     def list_objects(self, prefix: str) -> List:
         objects = self.s3_client.list_objects_v2(
             Bucket=Config_is.S3_BUCKET_NAME, Prefix=prefix, Delimiter="/"
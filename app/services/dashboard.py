@@ -1,13 +1,11 @@
 from datetime import datetime, timedelta
 from typing import (List, Dict, Tuple)
-from concurrent.futures import ThreadPoolExecutor
 import queue
 from dateutil.relativedelta import relativedelta
-from collections import defaultdict
 
 
 from flask import g
-from sqlalchemy import func, and_, case, or_
+from sqlalchemy import func, or_
 from app.models import (
      MailingAssignee as MA,
      MailingLead as ML,
@@ -20,6 +18,9 @@ from app.models import (
 )
 from app.services.utils import (
     date_time_obj_to_str, get_current_date_time)
+from app.services.aggregate_cache import cached_aggregate
+from app.services.db_pool import run_fanout
+from app.services.dashboard_rollup import monthly_dashboard_rollup, sum_dashboard_rollup
 from app import  app,db
 from config import Config_is
 from app.services.custom_errors import *
@@ -77,38 +78,20 @@ def get_leads_sold_complete_incomplete_count(category: int) -> List[Dict]:
     raise NoContent()
 
 
+@cached_aggregate("dashboard")
 def get_dashboard_count(time_zone: str):
     current_time = get_current_date_time(datetime.utcnow(), time_zone)
-    first_of_this_month = current_time.replace(day=1)
-    last_month_start = (first_of_this_month - timedelta(days=1)).replace(day=1)
-    if current_time.month == 12:
-          first_of_next_month = current_time.replace(year=current_time.year + 1, month=1, day=1)
-    else:
-          first_of_next_month = current_time.replace(month=current_time.month + 1, day=1)
-    dashboard_count = {}
-    mr_obj = MR.query.join(MA, MR.mortgage_id == MA.mortgage_id).with_entities(
-          func.count(func.distinct(case((and_(MR.call_in_date_time >= last_month_start, MR.call_in_date_time < first_of_this_month,
-                MA.lead_status != 7), MR.mortgage_id), else_= None))).label("last_month_total_leads"),
-          func.count(func.distinct(case((and_(MA.sold_date >= last_month_start, MA.sold_date < first_of_this_month,
-               MA.lead_status == 7), MR.mortgage_id),else_=None))).label("last_month_sold"),
-          func.count(func.distinct(case((and_(MR.call_in_date_time >= first_of_this_month, MR.call_in_date_time < first_of_next_month,
-                MA.lead_status != 7), MR.mortgage_id), else_= None))).label("this_month_total_leads"),
-          func.count(func.distinct(case((and_(MA.sold_date >= first_of_this_month, MA.sold_date < first_of_next_month,
-               MA.lead_status == 7), MR.mortgage_id), else_=None))).label("this_month_sold")).first()
-    dashboard_count.update(mr_obj._asdict())
-    user_obj = User.query.with_entities(
-          func.sum(case((and_(User.is_active == True, User.registered == True, User.registered_at >= last_month_start,
-                User.registered_at < first_of_this_month), 1), else_= 0)).label("last_month_users"),
-          func.sum(case((and_(User.is_active == True, User.registered == True, User.registered_at >= first_of_this_month,
-                User.registered_at < first_of_next_month), 1), else_= 0)).label("this_month_users")).first()
-    dashboard_count.update(user_obj._asdict())
+    today = current_time.date()
+    first_of_this_month = today.replace(day=1)
+    last_month_start = first_of_this_month - relativedelta(months=1)
+    first_of_next_month = first_of_this_month + relativedelta(months=1)
     if current_time.weekday() == Config_is.RENEWAL_DAY_OF_WEEK:
-        sos_end_date = current_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        sos_end_date = today
         days_to_skip = 1  # exclude today, if today is wednesday
-        days_diff = (first_of_next_month.date() - current_time.date()).days
+        days_diff = (first_of_next_month - today).days
         remaining_wednesdays = 0
         for i in range(days_to_skip, days_diff):
-            day = current_time.date() + timedelta(days=i)
+            day = today + timedelta(days=i)
             if day.weekday() == Config_is.RENEWAL_DAY_OF_WEEK:
                 remaining_wednesdays += 1
 
@@ -117,21 +100,22 @@ def get_dashboard_count(time_zone: str):
     else:
         sos_end_date = first_of_next_month
         estimated_future_revenue = 0
-    revenue_obj = SOS.query.join(SCS, SOS.subscription_db_id == SCS.id).with_entities(
-          func.sum(case((and_(SOS.created_at >= last_month_start, SOS.created_at < first_of_this_month, SOS.payment_status == 'paid',
-               SCS.status == 'active'), SOS.amount_received), else_=0)).label("last_month_revenue"),
-          func.sum(case((and_(SOS.created_at >= first_of_this_month, SOS.created_at < sos_end_date, SOS.payment_status == 'paid',
-               SCS.status == 'active'), SOS.amount_received), else_=0)).label("this_month_revenue")).first()
-    if revenue_obj:
-        revenue_dict = revenue_obj._asdict()
-        dashboard_count["this_month_revenue"] = revenue_dict.get("this_month_revenue") + estimated_future_revenue
-    marketplace_obj = MOS.query.with_entities(
-          func.count(case((and_(MOS.created_at >= last_month_start, MOS.created_at < first_of_this_month, 
-               MOS.payment_status == 'succeeded'), 1), else_=0)).label("last_month_marketplace_sales"),
-          func.count(case((and_(MOS.created_at >= first_of_this_month, MOS.created_at < first_of_next_month, 
-               MOS.payment_status == 'succeeded'), 1), else_=0)).label("this_month_marketplace_sales")).first()
-    dashboard_count.update(marketplace_obj._asdict())
-    return dashboard_count
+    sums = sum_dashboard_rollup({
+        "last_month": (last_month_start, first_of_this_month),
+        "this_month": (first_of_this_month, first_of_next_month),
+        "revenue": (first_of_this_month, sos_end_date),
+        })
+    return {
+        "last_month_total_leads": sums["last_month_unsold_calls"],
+        "last_month_sold": sums["last_month_sold"],
+        "this_month_total_leads": sums["this_month_unsold_calls"],
+        "this_month_sold": sums["this_month_sold"],
+        "last_month_users": sums["last_month_new_users"],
+        "this_month_users": sums["this_month_new_users"],
+        "this_month_revenue": sums["revenue_revenue"] + estimated_future_revenue,
+        "last_month_marketplace_sales": sums["last_month_marketplace_sales"],
+        "this_month_marketplace_sales": sums["this_month_marketplace_sales"],
+        }
 
 
 def get_recent_user(q: queue.Queue):
@@ -199,15 +183,17 @@ def get_latest_upload(q: queue.Queue):
         db.session.rollback()
         q.put(("latest_upload", str(e)))
 
+@cached_aggregate("dashboard")
 def get_recent_activity_overview() -> Dict:
     result = {}
     thread_response = queue.Queue()
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        executor.submit(get_recent_user, thread_response)
-        executor.submit(get_latest_purchase, thread_response)
-        executor.submit(get_latest_territory, thread_response)
-        executor.submit(get_latest_upload, thread_response)
+    run_fanout([
+        (get_recent_user, thread_response),
+        (get_latest_purchase, thread_response),
+        (get_latest_territory, thread_response),
+        (get_latest_upload, thread_response),
+        ])
 
     for _ in range(4):
         data = thread_response.get(timeout=7)
@@ -216,132 +202,11 @@ def get_recent_activity_overview() -> Dict:
     return result
 
 
-def mr_count(q: queue.Queue, params):
-    try:
-        with app.app_context():
-            with db.session.begin():
-                result = MR.query.join(MA, MR.mortgage_id == MA.mortgage_id).with_entities(
-                    func.count(func.distinct(case((and_(MR.call_in_date_time >= params["last_month_start"], MR.call_in_date_time < params["first_of_this_month"],
-                        MA.lead_status != 7), MR.mortgage_id), else_= None))).label("last_month_total_leads"),
-                    func.count(func.distinct(case((and_(MA.sold_date >= params["last_month_start"], MA.sold_date < params["first_of_this_month"],
-                        MA.lead_status == 7), MR.mortgage_id),else_=None))).label("last_month_sold"),
-                    func.count(func.distinct(case((and_(MR.call_in_date_time >= params["first_of_this_month"], MR.call_in_date_time < params["first_of_next_month"],
-                        MA.lead_status != 7), MR.mortgage_id), else_= None))).label("this_month_total_leads"),
-                    func.count(func.distinct(case((and_(MA.sold_date >= params["first_of_this_month"], MA.sold_date < params["first_of_next_month"],
-                        MA.lead_status == 7), MR.mortgage_id), else_=None))).label("this_month_sold")).first()
-                q.put({"mr_data": result._asdict()})
-    except Exception as e:
-        db.session.rollback()
-        q.put({"mr_data": f"Error: {str(e)}"})
-
-
-def user_count(q: queue.Queue, params):
-    try:
-        with app.app_context():
-            with db.session.begin():
-                result = User.query.with_entities(
-                    func.sum(case((and_(User.is_active == True, User.registered == True, User.registered_at >= params["last_month_start"],
-                        User.registered_at < params["first_of_this_month"]), 1), else_= 0)).label("last_month_users"),
-                    func.sum(case((and_(User.is_active == True, User.registered == True, User.registered_at >= params["first_of_this_month"],
-                        User.registered_at < params["first_of_next_month"]), 1), else_= 0)).label("this_month_users")).first()
-                q.put({"user_data": result._asdict()})
-    except Exception as e:
-        db.session.rollback()
-        q.put({"user_data": f"Error: {str(e)}"})
-
-
-def total_revenue(q: queue.Queue, params):
-    try:
-        with app.app_context():
-            with db.session.begin():
-                if params["current_time"].weekday() == Config_is.RENEWAL_DAY_OF_WEEK:
-                    sos_end_date = params["current_time"].replace(hour=0, minute=0, second=0, microsecond=0)
-                    days_to_skip = 1
-                    days_diff = (params["first_of_next_month"].date() - params["current_time"].date()).days
-                    remaining_wednesdays = 0
-                    for i in range(days_to_skip, days_diff):
-                        day = params["current_time"].date() + timedelta(days=i)
-                        if day.weekday() == Config_is.RENEWAL_DAY_OF_WEEK:
-                            remaining_wednesdays += 1
-                    active_subscriptions_count = SCS.query.filter(SCS.status == 'active').count()
-                    estimated_future_revenue = remaining_wednesdays * active_subscriptions_count
-                else:
-                    sos_end_date = params["first_of_next_month"]
-                    estimated_future_revenue = 0
-
-                result = SOS.query.join(SCS, SOS.subscription_db_id == SCS.id).with_entities(
-                    func.sum(case((and_(SOS.created_at >= params["last_month_start"], SOS.created_at < params["first_of_this_month"], SOS.payment_status == 'paid',
-                        SCS.status == 'active'), SOS.amount_received), else_=0)).label("last_month_revenue"),
-                    func.sum(case((and_(SOS.created_at >= params["first_of_this_month"], SOS.created_at < sos_end_date, SOS.payment_status == 'paid',
-                        SCS.status == 'active'), SOS.amount_received), else_=0)).label("this_month_revenue")).first()
-                revenue_dict = result._asdict() if result else {}
-                revenue_dict["this_month_revenue"] = revenue_dict.get("this_month_revenue", 0) + estimated_future_revenue
-                q.put({"revenue_data": revenue_dict})
-    except Exception as e:
-        db.session.rollback()
-        q.put({"revenue_data": f"Error: {str(e)}"})
-
-
-def marketplace_sales(q: queue.Queue, params):
-    try:
-        with app.app_context():
-            with db.session.begin():
-                result = MOS.query.with_entities(
-                    func.count(case((and_(MOS.created_at >= params["last_month_start"], MOS.created_at < params["first_of_this_month"], 
-                        MOS.payment_status == 'succeeded'), 1), else_=0)).label("last_month_marketplace_sales"),
-                    func.count(case((and_(MOS.created_at >= params["first_of_this_month"], MOS.created_at < params["first_of_next_month"], 
-                        MOS.payment_status == 'succeeded'), 1), else_=0)).label("this_month_marketplace_sales")).first()
-                q.put({"marketplace_data": result._asdict()})
-    except Exception as e:
-        db.session.rollback()
-        q.put({"marketplace_data": f"Error: {str(e)}"})
-
-
-def dashboard_count(time_zone: str) -> Dict:
-    current_time = get_current_date_time(datetime.utcnow(), time_zone)
-    first_of_this_month = current_time.replace(day=1)
-    last_month_start = (first_of_this_month - timedelta(days=1)).replace(day=1)
-    if current_time.month == 12:
-        first_of_next_month = current_time.replace(year=current_time.year + 1, month=1, day=1)
-    else:
-        first_of_next_month = current_time.replace(month=current_time.month + 1, day=1)
-
-    params = {
-        "current_time": current_time,
-        "last_month_start": last_month_start,
-        "first_of_this_month": first_of_this_month,
-        "first_of_next_month": first_of_next_month
-    }
-
-    q = queue.Queue()
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        executor.submit(mr_count, q, params)
-        executor.submit(user_count, q, params)
-        executor.submit(total_revenue, q, params)
-        executor.submit(marketplace_sales, q, params)
-
-    dashboard_count = {}
-    for _ in range(4):
-        data = q.get(timeout=7)
-        dashboard_count.update(data)
-
-    return dashboard_count
-
-
+@cached_aggregate("dashboard")
 def get_dashboard_lead_flow(time_zone: str):
-    end_date = get_current_date_time(datetime.utcnow(), time_zone).replace(day=1, hour=0, minute=0, second=0, microsecond=0) + relativedelta(months=1)
+    end_date = get_current_date_time(datetime.utcnow(), time_zone).date().replace(day=1) + relativedelta(months=1)
     start_date = end_date - relativedelta(months=6)
-    data = defaultdict(lambda: {"month": None, "total": 0, "sold": 0})
-    lead_objs = MR.query.join(MA, MR.mortgage_id == MA.mortgage_id).with_entities(func.date_trunc('month', MR.call_in_date_time).label('month'),
-                func.count(func.distinct(MR.mortgage_id)).label('total')).filter(MR.call_in_date_time >= start_date, 
-                MR.call_in_date_time < end_date).group_by('month').all()
-    for obj in lead_objs:
-        data[obj.month]["month"] = obj.month.month
-        data[obj.month]["total"] = obj.total
-    sold_objs =  MR.query.join(MA, MR.mortgage_id == MA.mortgage_id).with_entities(func.date_trunc('month', MA.sold_date).label('month'), 
-                func.count(func.distinct(MA.mortgage_id)).label('sold')).filter(MA.lead_status == 7, MA.sold_date >= start_date, 
-                MA.sold_date < end_date).group_by('month').all()
-    for obj in sold_objs:
-        data[obj.month]["month"] = obj.month.month
-        data[obj.month]["sold"] = obj.sold
-    return [data[month] for month in sorted(data.keys())]
+    return [
+        {"month": row.month.month, "total": row.total, "sold": row.sold}
+        for row in monthly_dashboard_rollup(start_date, end_date) if row.total or row.sold
+        ]
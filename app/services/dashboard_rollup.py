@@ -0,0 +1,141 @@
+"""Daily rollup of the dashboard counters, refreshed for the recent days only."""
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Date, and_, case, cast, func
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.models import (
+    DashboardDailyRollup as DR,
+    MailingAssignee as MA,
+    MailingResponse as MR,
+    MarketplaceOrderSummary as MOS,
+    StripeCustomerSubscription as SCS,
+    SubscriptionOrderSummary as SOS,
+    User
+    )
+from app.services.crud import CRUD
+
+
+ROLLUP_REFRESH_DAYS = 2  # yesterday and today, the days still receiving new rows
+ROLLUP_REBUILD_MONTHS = 7  # lead flow window plus the running month
+ROLLUP_COLUMNS = ("calls", "unsold_calls", "completed_calls", "sold", "new_users", "revenue", "marketplace_sales")
+
+
+def _daily_counts(start_day: date, end_day: date) -> Dict[date, Dict]:
+    """
+    {day: counters} of the days in [start_day, end_day), each source scanned once over its date index
+    """
+    start = datetime.combine(start_day, datetime.min.time())
+    end = datetime.combine(end_day, datetime.min.time())
+    days = {start_day + timedelta(days=i): dict.fromkeys(ROLLUP_COLUMNS, 0) for i in range((end_day - start_day).days)}
+    call_day = cast(MR.call_in_date_time, Date)
+    for row in (
+        MR.query.join(MA, MR.mortgage_id == MA.mortgage_id)
+        .filter(MR.call_in_date_time >= start, MR.call_in_date_time < end)
+        .with_entities(
+            call_day.label('day'),
+            func.count(func.distinct(MR.mortgage_id)).label('calls'),
+            func.count(func.distinct(case((MA.lead_status != 7, MR.mortgage_id), else_=None))).label('unsold_calls'),
+            func.count(func.distinct(case((MR.completed == True, MR.mortgage_id), else_=None))).label('completed_calls')
+            )
+        .group_by(call_day)
+        ):
+        days[row.day].update(calls=row.calls, unsold_calls=row.unsold_calls, completed_calls=row.completed_calls)
+    for row in (
+        MR.query.join(MA, MR.mortgage_id == MA.mortgage_id)
+        .filter(MA.lead_status == 7, MA.sold_date >= start_day, MA.sold_date < end_day)
+        .with_entities(MA.sold_date.label('day'), func.count(func.distinct(MR.mortgage_id)).label('sold'))
+        .group_by(MA.sold_date)
+        ):
+        days[row.day]['sold'] = row.sold
+    registered_day = cast(User.registered_at, Date)
+    for row in (
+        User.query
+        .filter(User.is_active == True, User.registered == True, User.registered_at >= start, User.registered_at < end)
+        .with_entities(registered_day.label('day'), func.count(User.id).label('new_users'))
+        .group_by(registered_day)
+        ):
+        days[row.day]['new_users'] = row.new_users
+    order_day = cast(SOS.created_at, Date)
+    for row in (
+        SOS.query.join(SCS, SOS.subscription_db_id == SCS.id)
+        .filter(SOS.payment_status == 'paid', SCS.status == 'active', SOS.created_at >= start, SOS.created_at < end)
+        .with_entities(order_day.label('day'), func.coalesce(func.sum(SOS.amount_received), 0).label('revenue'))
+        .group_by(order_day)
+        ):
+        days[row.day]['revenue'] = row.revenue
+    sale_day = cast(MOS.created_at, Date)
+    for row in (
+        MOS.query
+        .filter(MOS.payment_status == 'succeeded', MOS.created_at >= start, MOS.created_at < end)
+        .with_entities(sale_day.label('day'), func.count(MOS.id).label('marketplace_sales'))
+        .group_by(sale_day)
+        ):
+        days[row.day]['marketplace_sales'] = row.marketplace_sales
+    return days
+
+
+def refresh_dashboard_rollup(start_day: date, end_day: date) -> int:
+    """
+    Recomputes the rollup rows of [start_day, end_day)
+    """
+    now = datetime.utcnow()
+    rows = [
+        dict(day=day, created_at=now, modified_at=now, **counters)
+        for day, counters in _daily_counts(start_day, end_day).items()
+        ]
+    if not rows:
+        return 0
+    statement = insert(DR).values(rows)
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[DR.day],
+            set_={column: statement.excluded[column] for column in ROLLUP_COLUMNS + ("modified_at",)}
+            )
+        )
+    CRUD.db_commit()
+    print(f"refresh_dashboard_rollup {start_day} {end_day} days {len(rows)}")
+    return len(rows)
+
+
+def refresh_recent_dashboard_rollup() -> int:
+    tomorrow = datetime.utcnow().date() + timedelta(days=1)
+    return refresh_dashboard_rollup(tomorrow - timedelta(days=ROLLUP_REFRESH_DAYS), tomorrow)
+
+
+def rebuild_dashboard_rollup() -> int:
+    """
+    Recomputes the dashboard window, picks up the changes to older days such as
+    a lead status reverted or a subscription cancelled
+    """
+    tomorrow = datetime.utcnow().date() + timedelta(days=1)
+    start_day = tomorrow.replace(day=1) - relativedelta(months=ROLLUP_REBUILD_MONTHS)
+    return refresh_dashboard_rollup(start_day, tomorrow)
+
+
+def sum_dashboard_rollup(periods: Dict[str, tuple]) -> Dict:
+    """
+    periods: {label: (start_day, end_day)}, returns {label_column: sum} from one scan of the rollup
+    """
+    start_day = min(start for start, _ in periods.values())
+    end_day = max(end for _, end in periods.values())
+    sums = [
+        func.coalesce(func.sum(case((and_(DR.day >= start, DR.day < end), getattr(DR, column)), else_=0)), 0)
+        .label(f"{label}_{column}")
+        for label, (start, end) in periods.items() for column in ROLLUP_COLUMNS
+        ]
+    return DR.query.filter(DR.day >= start_day, DR.day < end_day).with_entities(*sums).first()._asdict()
+
+
+def monthly_dashboard_rollup(start_day: date, end_day: date) -> List:
+    month = func.date_trunc('month', DR.day)
+    return (
+        DR.query.filter(DR.day >= start_day, DR.day < end_day)
+        .with_entities(month.label('month'), func.sum(DR.calls).label('total'), func.sum(DR.sold).label('sold'))
+        .group_by(month)
+        .order_by(month)
+        .all()
+        )
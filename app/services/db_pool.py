@@ -0,0 +1,128 @@
+"""Database connection pool sizing, the shared query fan-out executor and their metrics."""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from config import Config_is
+
+
+REQUEST_THREAD_CONNECTIONS = 2  # gunicorn --threads, each request thread holds a connection too
+
+_metrics_lock = threading.Lock()
+_pool_metrics = {"checkouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0}
+_fanout_metrics = {"submitted": 0, "started": 0, "queue_wait_seconds": 0.0, "max_queue_wait_seconds": 0.0}
+_executor = None
+_executor_pid = None
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool recording how long the checkouts wait for a free connection
+    """
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with _metrics_lock:
+                _pool_metrics["timeouts"] += 1
+            raise
+        waited = time.monotonic() - started
+        with _metrics_lock:
+            _pool_metrics["checkouts"] += 1
+            _pool_metrics["wait_seconds"] += waited
+            _pool_metrics["max_wait_seconds"] = max(_pool_metrics["max_wait_seconds"], waited)
+        return connection
+
+
+def engine_options() -> Dict:
+    """
+    Every fan-out worker and request thread can hold a connection at once, so parallel
+    queries run in parallel instead of queueing on the pool
+    """
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": Config_is.DB_POOL_SIZE,
+        "max_overflow": Config_is.DB_MAX_OVERFLOW,
+        "pool_timeout": Config_is.DB_POOL_TIMEOUT,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        }
+
+
+def fanout_workers() -> int:
+    """
+    Fan-out threads the pool can serve next to the request threads without making them wait
+    """
+    headroom = Config_is.DB_POOL_SIZE + Config_is.DB_MAX_OVERFLOW - REQUEST_THREAD_CONNECTIONS
+    return max(1, min(Config_is.DB_FANOUT_WORKERS, headroom))
+
+
+def fanout_executor() -> ThreadPoolExecutor:
+    """
+    Executor of the process shared by the parallel queries, created again after a fork
+    """
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _metrics_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=fanout_workers(), thread_name_prefix="db-fanout")
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _timed_call(submitted_at: float, fn: Callable, args: Tuple):
+    waited = time.monotonic() - submitted_at
+    with _metrics_lock:
+        _fanout_metrics["started"] += 1
+        _fanout_metrics["queue_wait_seconds"] += waited
+        _fanout_metrics["max_queue_wait_seconds"] = max(_fanout_metrics["max_queue_wait_seconds"], waited)
+    return fn(*args)
+
+
+def run_fanout(calls: List[Tuple], timeout: Optional[float] = None) -> None:
+    """
+    calls: [(fn, *args)], run on the shared executor, returns once all of them finished.
+    The functions open their own app context so each thread works on its own session.
+    """
+    executor = fanout_executor()
+    with _metrics_lock:
+        _fanout_metrics["submitted"] += len(calls)
+    futures = [executor.submit(_timed_call, time.monotonic(), fn, args) for fn, *args in calls]
+    wait(futures, timeout=timeout)
+
+
+def db_pool_metrics() -> Dict:
+    from app import db
+    pool = db.engine.pool
+    with _metrics_lock:
+        checkouts = _pool_metrics["checkouts"]
+        started = _fanout_metrics["started"]
+        metrics = {
+            "pool": {
+                "size": pool.size(),
+                "max_overflow": Config_is.DB_MAX_OVERFLOW,
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "checkouts": checkouts,
+                "avg_wait_ms": round(_pool_metrics["wait_seconds"] * 1000 / checkouts, 3) if checkouts else 0,
+                "max_wait_ms": round(_pool_metrics["max_wait_seconds"] * 1000, 3),
+                "timeouts": _pool_metrics["timeouts"],
+                },
+            "fanout": {
+                "workers": fanout_workers(),
+                "queued": _executor._work_queue.qsize() if _executor else 0,
+                "submitted": _fanout_metrics["submitted"],
+                "started": started,
+                "avg_queue_wait_ms": round(_fanout_metrics["queue_wait_seconds"] * 1000 / started, 3) if started else 0,
+                "max_queue_wait_ms": round(_fanout_metrics["max_queue_wait_seconds"] * 1000, 3),
+                },
+            }
+    return metrics
@@ -1,13 +1,12 @@
-import csv
 import io
+import csv
+import json
 import queue
 import base64
-from uuid import uuid4
+from itertools import chain
 from math import ceil
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 from datetime import datetime, timedelta
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor
 
 from flask import g, request
 from sqlalchemy.orm import Query
@@ -23,16 +22,26 @@ from app.models import (
     Agent, User
 )
 from app.services.aws_services import AmazonServices
+from app.services.mailer_ingest import (
+    mailer_upload_s3_path,
+    publish_upload_progress
+    )
 from app.services.utils import (
-    convert_datetime_to_timezone_date, 
     date_time_obj_to_str,
     date_object_to_string
     )
+from app.services.pagination import keyset_paginate
+from app.services.db_pool import run_fanout
 from app.services.custom_errors import *
-from app import app, logging, db, redis_obj
-from constants import LEAD_STATUS
+from app import app, logging, db, tasks
+from constants import LEAD_STATUS, MAILER_UPLOAD_STATUS
 from config import Config_is
 
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_CHUNK_SIZE = 2000
+# yes/no keypad answers of ivr_response the processed leads download filters on, "1" yes "0" no
+IVR_ANSWER_FILTERS = ("health", "tobacco", "coborrower")
+
 
 def upload_purchase_agreement(id_: str, base64_img: str) -> bool:
     # Remove data URI scheme header
@@ -56,25 +65,6 @@ def upload_purchase_agreement(id_: str, base64_img: str) -> bool:
     return True
 
 
-def mailing_campaign_bulk_save(
-    thread_response, lead_data: List, lead_assignee: List[MA]
-    ):
-    with app.app_context():
-        try:
-            db.session.bulk_save_objects(lead_data)
-            db.session.commit()
-            db.session.bulk_save_objects(lead_assignee)
-            thread_response.put(True)
-            db.session.commit()
-        except Exception as e:
-            print(f"bulk_save Exception: {e}")
-            logging.error(f"bulk_save Exception: {e}")
-            thread_response.put(str(e))
-            db.session.rollback()
-        db.session.close()
-    return True
-
-
 # def iul_campaign_bulk_save(thread_response, file_id: int, db_data: List, db_agents: Dict, campaign: str):
 #     print('iul_campaign_bulk_save')
 #         with app.app_context():
@@ -98,20 +88,11 @@ def mailing_campaign_bulk_save(
 #     return True
 
 
-def csv_header_modify(csv_row: Dict, csv_headings: Dict) -> Dict:
-    for variable, column in csv_headings.items():
-        try:
-            csv_row[variable] = csv_row.pop(column)
-        except KeyError:
-            pass
-    return csv_row
-
-
 def csv_mailing_input_with_mortgage_id(
         campaign: str, file_is: object, source_id: int, 
         category: int, csv_headers: Dict):
-    threads, delete_table, run, thread_response = [], None, True, queue.Queue()
-    mortgage_ids = []
+    if not csv_headers.get("AGENT_ID"):
+        raise BadRequest("Agent Column name should be either 'AGENT_ID' or 'Agent Identifier'")
     uploaded = CRUD.create(
         UF, {
             "name": file_is.filename,
@@ -119,111 +100,63 @@ def csv_mailing_input_with_mortgage_id(
             "category": category,
             "uploaded_by": g.user["id"],
             "campaign": campaign,
+            "upload_status": 1
         },
     )
-    created_date = convert_datetime_to_timezone_date(uploaded.created_at)
-    with io.TextIOWrapper(file_is) as fp:
-        reader = csv.DictReader(fp)
-        # if (
-        #     not csv_headers.get("AGENT_ID")
-        #     or csv_headers.get("Agent Identifier") not in reader.fieldnames
-        # ):
-        if not csv_headers.get("AGENT_ID"):
-            raise BadRequest("Agent Column name should be either 'AGENT_ID' or 'Agent Identifier'")
-        counter = 0
-        while run:
-            lead_data, assignee_data = [], []
-            for _ in range(10000):
-                try:
-                    row = next(reader)
-                    if not row.get(csv_headers["AGENT_ID"]):
-                        continue
-                    counter += 1
-                    csv_modified = csv_header_modify(row, csv_headers)
-                    unique_id = uuid4().hex[:10]
-                    # disabled_in_marketplace = False if row.get(STATE, '') not in DISABLED_STATES else True
-                    mortgage_ids.append(int(row.get("MORTGAGE_ID")))
-                    lead_data.append(
-                        ML(
-                            mortgage_id=row.get("MORTGAGE_ID"),
-                            file_id=uploaded.id,
-                            uuid=unique_id,
-                            full_name=(
-                                row.get("FULL_NAME", "")
-                                or f"{row.get('FIRST', '')} {row.get('LAST', '')}"
-                            ).strip(),
-                            first_name=row.get('FIRST', ''),
-                            last_name=row.get('LAST', ''),
-                            state=row.get("STATE", "").upper(),
-                            agent_id=row.get("AGENT_ID"),
-                            city=row.pop('CITY'),
-                            lender_name=row.get('LENDER_NAME'),
-                            loan_amount=float(row.get('LOAN_AMOUNT', '0').lstrip('$').replace(',', '')),
-                            loan_date=row.get('LOAN_DATE'),
-                            loan_type=row.get('LOAN_TYPE'),
-                            address=csv_modified.get("ADDRESS",''),
-                            zip=csv_modified.get("ZIP"),
-                            source_id=source_id,
-                            csv_data=csv_modified,
-                            created_date=created_date
-                        )
-                    )
-                    assignee_data.append(MA(agent_id=row.get("AGENT_ID"), mortgage_id=row.get("MORTGAGE_ID"), campaign_name=campaign))
-                    # disabled_in_marketplace=disabled_in_marketplace,
-                    if counter % 2500 == 0:
-                        t = Thread(
-                            target=mailing_campaign_bulk_save,
-                            args=(thread_response, lead_data, assignee_data),
-                        )
-                        lead_data, assignee_data = [], []
-                        threads.append(t)
-                        t.start()            
-                except StopIteration:
-                    run = False
-                    break
-            if counter and counter % 2500 != 0:
-                t = Thread(
-                    target=mailing_campaign_bulk_save,
-                    args=(thread_response, lead_data, assignee_data),
-                )
-                threads.append(t)
-                t.start()
-    file_is.seek(0)
-    AmazonServices().acl_file_upload_obj_s3(file_is, f"{Config_is.ENVIRONMENT}/weekly-files/{uploaded.id}.csv", "text/csv")
-    for t in threads:
-        t.join()
-        try:
-            response_is = thread_response.get_nowait()
-            if response_is is True:
-                continue
-            if "duplicate key value violates unique constraint " in str(response_is):
-                print(f"dupliocate {response_is}")
-                logging.info(f"response_is {response_is} violates")
-                delete_table = f"Duplicate mortgage Id"
-                break
-            else:
-                delete_table = str(response_is)
-                break
-        except Exception as e:
-            print(f"our exception {e}")
-            logging.error(f"our exception {e}")
-            delete_table = str(e)
-            break
-    else:
-        mortgage_ids.sort()
-        redis_obj.set("new_file_name", int(mortgage_ids[-1]) + 1)
-        return {"file_id": uploaded.id, "total_records": counter, "threads": len(threads)}
-    logging.info(f"finale if {delete_table} {uploaded.id}")
-    print(f"finale if {delete_table} {uploaded.id}")
     try:
+        AmazonServices().acl_file_upload_obj_s3(file_is, mailer_upload_s3_path(uploaded.id), "text/csv")
+    except CustomError:
         UF.query.filter_by(id=uploaded.id).delete()
-        db.session.commit()
-        print("delete committed")
-    except Exception as e:
-        print(e)
-        db.session.rollback()
-        logging.info("Deletion committed")
-    raise BadRequest(delete_table)
+        CRUD.db_commit()
+        raise
+    publish_upload_progress(uploaded, 1)
+    tasks.ingest_mailer_upload.delay(uploaded.id, csv_headers)
+    return {"job_id": uploaded.id, "file_id": uploaded.id, "status": MAILER_UPLOAD_STATUS[1]}
+
+
+def mortgage_file_row(data: Dict, campaign: str) -> Dict:
+    data |= dict(campaign=campaign, loan_date=date_object_to_string(data['loan_date']))
+    return data
+
+
+def mailer_leads_except_mailed_row(data: Dict) -> Dict:
+    data['loan_date'] = date_object_to_string(data['loan_date'])
+    data["lead_status"] = LEAD_STATUS.get(data["lead_status"])
+    data['call_in_time'] = date_time_obj_to_str(data.pop('call_in_date_time'))
+    return data
+
+
+def export_chunks(rows: Iterator, export_format: str, serializer: Callable[[Dict], Dict]) -> Iterator[str]:
+    buffer, writer = io.StringIO(), None
+    for count, row in enumerate(rows, 1):
+        data = serializer(row._asdict())
+        if export_format == "ndjson":
+            buffer.write(json.dumps(data, default=str) + "\n")
+        else:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(data.keys()), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in data.items()})
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_query_export(query: Query, export_format: str, serializer: Callable[[Dict], Dict]) -> Iterator[str]:
+    """
+    Single pass export over a server side cursor (yield_per), the rows are
+    written out in CSV or NDJSON chunks so the memory stays flat for any size.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise BadRequest(f"format should be one of {', '.join(EXPORT_FORMATS)}")
+    rows = iter(query.yield_per(EXPORT_CHUNK_SIZE))
+    first = next(rows, None)
+    if first is None:
+        raise NoContent()
+    return export_chunks(chain([first], rows), export_format, serializer)
 
 
 def thread_download_mortgage_file(
@@ -239,9 +172,7 @@ def thread_download_mortgage_file(
                         page=page, per_page=per_page, error_out=False
                     )
                     for data in leads_obj.items:
-                        data = data._asdict()
-                        data |= dict(campaign=campaign, loan_date=date_object_to_string(data['loan_date']))
-                        response.append(data)
+                        response.append(mortgage_file_row(data._asdict(), campaign))
                     thread_response.put(response)
                 except Exception as e:
                     print(f"thread_download_mortgage_file Exception {e}")
@@ -255,7 +186,7 @@ def thread_download_mortgage_file(
     return True
 
 
-def download_mortgage_file(file_id: str, campaign: str) -> List:
+def download_mortgage_file(file_id: str, campaign: str, export_format: Optional[str] = None) -> Union[List, Iterator[str]]:
     leads_obj = ML.query.filter(ML.file_id == file_id)
     leads_obj = leads_obj.with_entities(
         ML.mortgage_id, ML.full_name, ML.agent_id, ML.state, ML.city, ML.address, ML.zip, 
@@ -265,17 +196,26 @@ def download_mortgage_file(file_id: str, campaign: str) -> List:
 
     return threaded_file_download(
         query=leads_obj,
-        campaign=campaign
+        campaign=campaign,
+        export_format=export_format
     )
 
 
 def uploaded_file_info_list(
-    category_id: int, page: int, per_page: int, search: Optional[str] = None
+    category_id: int, page: int, per_page: int, search: Optional[str] = None,
+    after: Optional[str] = None, exact_total: bool = False
     ) -> Tuple:
     file_obj = UF.query.filter(UF.category == category_id)
     if search:
         file_obj = file_obj.filter(UF.campaign.ilike(f"%{search}%"))
-    file_obj = file_obj.order_by(UF.created_at.desc()).paginate(
+    file_obj = file_obj.order_by(UF.created_at.desc())
+    if after is not None:
+        items, pagination = keyset_paginate(file_obj, [UF.created_at, UF.id], after, per_page, exact_total)
+        result = [f.to_dict() for f in items]
+        if result:
+            return result, pagination
+        raise NoContent()
+    file_obj = file_obj.paginate(
         page=page, per_page=per_page, error_out=False
     )
     result = [f.to_dict() for f in file_obj.items]
@@ -301,11 +241,7 @@ def all_mailer_leads_except_mailed_thread(
                         page=page, per_page=per_page, error_out=False
                     )
                     for data in leads.items:
-                        data = data._asdict()
-                        data['loan_date'] = date_object_to_string(data['loan_date'])
-                        data["lead_status"] = LEAD_STATUS.get(data["lead_status"])
-                        data['call_in_time'] = date_time_obj_to_str(data.pop('call_in_date_time'))
-                        response.append(data)
+                        response.append(mailer_leads_except_mailed_row(data._asdict()))
                     thread_response.put(response)
                 except Exception as e:
                     print(f"all_mailer_leads_except_mailed_thread Exception: {e}")
@@ -321,7 +257,7 @@ def all_mailer_leads_except_mailed_thread(
     return True
 
 
-def download_all_mailer_leads_except_mailed(agent_id: int) -> List:
+def download_all_mailer_leads_except_mailed(agent_id: int, export_format: Optional[str] = None) -> Union[List, Iterator[str]]:
     if g.user["role_id"] == 1 and request.args.get("agent_id"):
         agent_id = [request.args.get("agent_id")]
     else:
@@ -354,6 +290,8 @@ def download_all_mailer_leads_except_mailed(agent_id: int) -> List:
         .order_by(MR.call_in_date_time.desc())
     )
     # LeadMember.purchased_user_id.is_(None)
+    if export_format:
+        return stream_query_export(query, export_format, mailer_leads_except_mailed_row)
     try:
         count = query.distinct(ML.mortgage_id).count()
     except:
@@ -362,15 +300,10 @@ def download_all_mailer_leads_except_mailed(agent_id: int) -> List:
     if not count:
         raise NoContent()
     total_pages = ceil(count / per_page)
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        for page in range(1, total_pages + 1):
-            executor.submit(
-                all_mailer_leads_except_mailed_thread,
-                page,
-                per_page,
-                query,
-                thread_response,
-            )
+    run_fanout([
+        (all_mailer_leads_except_mailed_thread, page, per_page, query, thread_response)
+        for page in range(1, total_pages + 1)
+        ])
     for page in range(1, total_pages + 1):
         val = thread_response.get(timeout=120)
         if isinstance(val, list):
@@ -444,6 +377,10 @@ def report_download_processed_mailer_leads(data: Dict, page: int) -> List:
     )
     if "completed" in data:
         leads_query = leads_query.filter(MR.completed == data["completed"])
+    ivr_answers = {key: str(data[key]) for key in IVR_ANSWER_FILTERS if data.get(key) is not None}
+    if ivr_answers:
+        # ivr_response @> '{"tobacco": "1"}', served by the ivr_response GIN index
+        leads_query = leads_query.filter(MR.ivr_response.contains(ivr_answers))
     if not page:
         try:
             count = leads_query.distinct(MA.mortgage_id).count()
@@ -453,14 +390,7 @@ def report_download_processed_mailer_leads(data: Dict, page: int) -> List:
         if count == 0:
             raise NoContent()
         return {"total": count, "pages": ceil(count / per_page)}
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        executor.submit(
-            thread_download_leads_with_time_type,
-            int(page),
-            per_page,
-            leads_query,
-            thread_response,
-        )
+    run_fanout([(thread_download_leads_with_time_type, int(page), per_page, leads_query, thread_response)])
     val = thread_response.get(timeout=180)
     if isinstance(val, list):
         result.extend(val)
@@ -468,7 +398,7 @@ def report_download_processed_mailer_leads(data: Dict, page: int) -> List:
         raise InternalError()
     return result
 
-def download_campaign_leads(campaign: str) -> List:
+def download_campaign_leads(campaign: str, export_format: Optional[str] = None) -> Union[List, Iterator[str]]:
     query = ML.query.join(MA, MA.mortgage_id == ML.mortgage_id).filter(
         MA.campaign_name == campaign
     )
@@ -483,15 +413,19 @@ def download_campaign_leads(campaign: str) -> List:
 
     return threaded_file_download(
         query=query,
-        campaign=campaign
+        campaign=campaign,
+        export_format=export_format
     )
 
 def threaded_file_download(
     query: Query,
     campaign: str,
     per_page: int = 15000,
-    timeout: int = 120
-) -> List:
+    timeout: int = 120,
+    export_format: Optional[str] = None
+) -> Union[List, Iterator[str]]:
+    if export_format:
+        return stream_query_export(query, export_format, lambda data: mortgage_file_row(data, campaign))
     result, thread_response = [], queue.Queue()
     total = query.distinct(ML.mortgage_id).count()
     if not total:
@@ -499,16 +433,10 @@ def threaded_file_download(
 
     total_pages = ceil(total / per_page)
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        for page in range(1, total_pages + 1):
-            executor.submit(
-                thread_download_mortgage_file,
-                query,
-                page,
-                per_page,
-                campaign,
-                thread_response,
-            )
+    run_fanout([
+        (thread_download_mortgage_file, query, page, per_page, campaign, thread_response)
+        for page in range(1, total_pages + 1)
+        ])
 
     for _ in range(1, total_pages + 1):
         val = thread_response.get(timeout=timeout)
@@ -0,0 +1,237 @@
+"""Redis stream of the IVR webhook events, persisted in batches by a consumer group."""
+import json
+import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from sqlalchemy import Text, cast
+
+from app import db, redis_obj
+from app import tasks
+from app.models import MailingResponse as MR
+from app.services.aggregate_cache import invalidate_aggregate_cache
+from app.services.crud import CRUD
+
+
+IVR_EVENT_STREAM = "ivr_events"
+IVR_EVENT_GROUP = "ivr_persisters"
+IVR_EVENT_STREAM_MAXLEN = 100000
+IVR_EVENT_BATCH = 200
+IVR_EVENT_CLAIM_IDLE_MS = 60000
+# One consumer at a time, the events of a call are applied in the order they were published
+IVR_EVENT_LOCK_KEY = "ivr_events:lock"
+IVR_EVENT_LOCK_SECONDS = 60
+PENDING_IVR_CALLS_KEY = "ivr_pending_calls"  # call_sid: call start epoch
+PENDING_IVR_CALLS_BACKFILLED_KEY = "ivr_pending_calls_backfilled"
+PENDING_IVR_CALL_SECONDS = 300
+PENDING_IVR_CALLS_BATCH = 200
+
+
+def _event_handlers() -> Dict:
+    # twilio_call_sms publishes through this module
+    from app.services.twilio_call_sms import IVR_EVENT_HANDLERS
+    return IVR_EVENT_HANDLERS
+
+
+def track_pending_calls(results: List[Dict]) -> None:
+    """
+    Keeps the calls with collected answers still to finalize, in the order the events were applied
+    """
+    pipeline = redis_obj.pipeline(transaction=False)
+    now = time.time()
+    for result in results:
+        if result.get("closed_call_sid"):
+            pipeline.zrem(PENDING_IVR_CALLS_KEY, result["closed_call_sid"])
+        if result.get("opened_call_sid"):
+            pipeline.zadd(PENDING_IVR_CALLS_KEY, {result["opened_call_sid"]: now}, nx=True)
+    pipeline.execute()
+
+
+def _after_commit(results: List[Dict]) -> None:
+    try:
+        track_pending_calls(results)
+    except Exception as e:
+        print(f"track_pending_calls {e}")
+    mortgage_ids = sorted({result["mortgage_id"] for result in results if result.get("mortgage_id")})
+    if not mortgage_ids:
+        return
+    previous_call_dates = sorted({dt for result in results for dt in result.get("previous_call_dates", [])})
+    invalidate_aggregate_cache()
+    tasks.refresh_marketplace_inventory.delay(mortgage_ids, previous_call_dates)
+    if previous_call_dates:
+        # Today is read live, the days the calls moved away from are recounted
+        tasks.refresh_report_summary.delay(previous_call_dates)
+    for result in results:
+        if result.get("alert"):
+            tasks.latest_ivr_response_alert_to_agents.delay(**result["alert"])
+
+
+def _apply_inline(kind: str, data: Dict) -> None:
+    result = _event_handlers()[kind](data)
+    CRUD.db_commit()
+    # redis is the broker as well, the webhook still answers Twilio once the event is stored
+    try:
+        _after_commit([result])
+    except Exception as e:
+        print(f"_apply_inline {kind} after commit {e}")
+
+
+def publish_ivr_event(kind: str, data: Dict) -> None:
+    """
+    Queues the event for the persisters, applied in the request when redis is unavailable
+    """
+    try:
+        redis_obj.xadd(
+            IVR_EVENT_STREAM, {"kind": kind, "data": json.dumps(data)},
+            maxlen=IVR_EVENT_STREAM_MAXLEN, approximate=True
+            )
+    except Exception as e:
+        print(f"publish_ivr_event {kind} {e}")
+        _apply_inline(kind, data)
+
+
+def ensure_ivr_event_group() -> None:
+    try:
+        redis_obj.xgroup_create(IVR_EVENT_STREAM, IVR_EVENT_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def apply_ivr_events(entries: List) -> List[Dict]:
+    """
+    Applies a batch in one transaction, an event that fails is rolled back to its savepoint
+    and acknowledged with the batch so it is not retried forever.
+    """
+    handlers = _event_handlers()
+    results = []
+    for entry_id, fields in entries:
+        try:
+            with db.session.begin_nested():
+                results.append(handlers[fields["kind"]](json.loads(fields["data"])))
+        except Exception as e:
+            print(f"apply_ivr_events {entry_id} {fields} {e}")
+    CRUD.db_commit()
+    return results
+
+
+def _acquire_ivr_event_lock() -> Optional[str]:
+    """
+    Token of the taken lock, None while another run holds it
+    """
+    token = uuid4().hex
+    if redis_obj.set(IVR_EVENT_LOCK_KEY, token, nx=True, ex=IVR_EVENT_LOCK_SECONDS):
+        return token
+    return None
+
+
+def _release_ivr_event_lock(token: str) -> None:
+    # a run that outlived the lock leaves the one of the next run alone
+    if redis_obj.get(IVR_EVENT_LOCK_KEY) == token:
+        redis_obj.delete(IVR_EVENT_LOCK_KEY)
+
+
+def process_ivr_events(consumer: str, time_budget: float = 2.5) -> int:
+    """
+    Drains the stream until it is empty or the time budget is spent,
+    the entries a dead consumer left pending are claimed first.
+    Returns 0 right away while another run holds the lock.
+    """
+    token = _acquire_ivr_event_lock()
+    if not token:
+        return 0
+    try:
+        return _drain_ivr_events(consumer, time_budget)
+    finally:
+        _release_ivr_event_lock(token)
+
+
+def _drain_ivr_events(consumer: str, time_budget: float) -> int:
+    ensure_ivr_event_group()
+    started = time.monotonic()
+    processed = 0
+    _, entries, *_ = redis_obj.xautoclaim(
+        IVR_EVENT_STREAM, IVR_EVENT_GROUP, consumer, IVR_EVENT_CLAIM_IDLE_MS, start_id="0-0", count=IVR_EVENT_BATCH)
+    while True:
+        if not entries:
+            streams = redis_obj.xreadgroup(
+                IVR_EVENT_GROUP, consumer, {IVR_EVENT_STREAM: ">"}, count=IVR_EVENT_BATCH)
+            entries = streams[0][1] if streams else []
+        if not entries:
+            break
+        results = apply_ivr_events(entries)
+        redis_obj.xack(IVR_EVENT_STREAM, IVR_EVENT_GROUP, *[entry_id for entry_id, _ in entries])
+        _after_commit(results)
+        processed += len(entries)
+        entries = []
+        if time.monotonic() - started >= time_budget:
+            break
+    if processed:
+        print(f"process_ivr_events {consumer} events {processed}")
+    return processed
+
+
+def backfill_pending_ivr_calls() -> int:
+    """
+    Indexes the open calls once, for the calls started before the index existed or while redis was down
+    """
+    if not redis_obj.set(PENDING_IVR_CALLS_BACKFILLED_KEY, 1, nx=True):
+        return 0
+    now = time.time()
+    call_sids = [
+        row.call_sid for row in MR.query.filter(
+            MR.call_sid != None, MR.temp_data != None, cast(MR.temp_data, Text).notin_(["{}", "null"])
+            ).with_entities(MR.call_sid)
+        ]
+    for i in range(0, len(call_sids), PENDING_IVR_CALLS_BATCH):
+        redis_obj.zadd(
+            PENDING_IVR_CALLS_KEY,
+            {call_sid: now - PENDING_IVR_CALL_SECONDS for call_sid in call_sids[i:i + PENDING_IVR_CALLS_BATCH]},
+            nx=True
+            )
+    print(f"backfill_pending_ivr_calls calls {len(call_sids)}")
+    return len(call_sids)
+
+
+def close_stale_ivr_calls(older_than: int = PENDING_IVR_CALL_SECONDS, batch_size: int = PENDING_IVR_CALLS_BATCH) -> int:
+    """
+    Finalizes the calls Twilio never reported completed, batch by batch.
+    A call leaves the index only after its batch is committed. Each batch holds the lock of the
+    event consumers, a call_completed event of the same call is applied before or after it, never
+    alongside. The run stops while the consumers hold the lock, the next one picks up the rest.
+    """
+    from app.services.twilio_call_sms import finalize_ivr_call
+    backfill_pending_ivr_calls()
+    closed = 0
+    while True:
+        token = _acquire_ivr_event_lock()
+        if not token:
+            break
+        try:
+            call_sids = redis_obj.zrangebyscore(
+                PENDING_IVR_CALLS_KEY, "-inf", time.time() - older_than, start=0, num=batch_size)
+            if not call_sids:
+                break
+            results = []
+            for call_sid in call_sids:
+                try:
+                    with db.session.begin_nested():
+                        alert = finalize_ivr_call(call_sid)
+                except Exception as e:
+                    print(f"close_stale_ivr_calls {call_sid} {e}")
+                    continue
+                results.append({
+                    "mortgage_id": alert["mortgage_info"]["mortgage_id"] if alert else None,
+                    "alert": alert, "closed_call_sid": call_sid
+                    })
+                closed += bool(alert)
+            CRUD.db_commit()
+            # Failed calls leave the index as well, they would fail again every run
+            redis_obj.zrem(PENDING_IVR_CALLS_KEY, *call_sids)
+        finally:
+            _release_ivr_event_lock(token)
+        _after_commit(results)
+        if len(call_sids) < batch_size:
+            break
+    print(f"close_stale_ivr_calls closed {closed}")
+    return closed
@@ -0,0 +1,131 @@
+"""Redis lookup of the lead fields the IVR reads back while the caller waits."""
+import json
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from app import redis_obj
+from app.models import MailingLead as ML
+
+
+IVR_LOOKUP_KEY = "ivr_lookup"  # mortgage_id: lead fields
+IVR_TEMP_LOOKUP_KEY = "ivr_lookup_temp"  # temp_mortgage_id: mortgage_id
+IVR_LOOKUP_BATCH = 5000
+IVR_LOOKUP_COLUMNS = (
+    ML.mortgage_id, ML.temp_mortgage_id, ML.full_name, ML.lender_name,
+    ML.loan_date, ML.source_id, ML.uuid, ML.state, ML.file_id, ML.created_at
+    )
+
+
+def ivr_lookup_record(lead) -> Dict:
+    return dict(
+        mortgage_id=lead.mortgage_id,
+        full_name=lead.full_name,
+        lender_name=lead.lender_name,
+        loan_date=lead.loan_date.isoformat() if lead.loan_date else None,
+        source_id=lead.source_id,
+        uuid=lead.uuid,
+        state=lead.state,
+        file_id=lead.file_id,
+        created_at=lead.created_at.timestamp() if lead.created_at else 0
+        )
+
+
+def cache_ivr_leads(leads: List) -> int:
+    """
+    Leads have to come oldest first, the newest lead keeps a shared temp mortgage id
+    """
+    pipeline = redis_obj.pipeline(transaction=False)
+    for lead in leads:
+        pipeline.hset(IVR_LOOKUP_KEY, lead.mortgage_id, json.dumps(ivr_lookup_record(lead)))
+        if lead.temp_mortgage_id:
+            pipeline.hset(IVR_TEMP_LOOKUP_KEY, lead.temp_mortgage_id, lead.mortgage_id)
+    pipeline.execute()
+    return len(leads)
+
+
+def evict_ivr_leads(leads: List[Tuple[str, Optional[str]]]) -> int:
+    """
+    Drops deleted leads, given as (mortgage_id, temp_mortgage_id), from the lookup. A temp
+    mortgage id is dropped only while it still points at the lead, a newer lead may share it.
+    """
+    for i in range(0, len(leads), IVR_LOOKUP_BATCH):
+        batch = leads[i:i + IVR_LOOKUP_BATCH]
+        temp_ids = sorted({temp_id for _, temp_id in batch if temp_id})
+        mortgage_ids = {mortgage_id for mortgage_id, _ in batch}
+        pipeline = redis_obj.pipeline(transaction=False)
+        pipeline.hdel(IVR_LOOKUP_KEY, *mortgage_ids)
+        if temp_ids:
+            pipeline.hmget(IVR_TEMP_LOOKUP_KEY, temp_ids)
+        results = pipeline.execute()
+        if temp_ids:
+            stale = [temp_id for temp_id, mortgage_id in zip(temp_ids, results[1]) if mortgage_id in mortgage_ids]
+            if stale:
+                redis_obj.hdel(IVR_TEMP_LOOKUP_KEY, *stale)
+    return len(leads)
+
+
+def warm_ivr_lookup(file_id: Optional[int] = None) -> int:
+    """
+    Loads the leads of an uploaded file, or every lead without a file id, into the lookup
+    """
+    if redis_obj is None:
+        return 0
+    query = ML.query.with_entities(*IVR_LOOKUP_COLUMNS).order_by(ML.created_at)
+    if file_id:
+        query = query.filter(ML.file_id == file_id)
+    warmed, batch = 0, []
+    for lead in query.yield_per(IVR_LOOKUP_BATCH):
+        batch.append(lead)
+        if len(batch) == IVR_LOOKUP_BATCH:
+            warmed += cache_ivr_leads(batch)
+            batch = []
+    if batch:
+        warmed += cache_ivr_leads(batch)
+    print(f"warm_ivr_lookup file {file_id} leads {warmed}")
+    return warmed
+
+
+def _cached_lead(mortgage_id: Optional[str]) -> Optional[Dict]:
+    if not mortgage_id:
+        return None
+    record = redis_obj.hget(IVR_LOOKUP_KEY, mortgage_id)
+    return json.loads(record) if record else None
+
+
+def find_ivr_lead(number: str, by_temp: Optional[bool] = None, file_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    Lead the caller typed in, by mortgage id, temp mortgage id or either of them (by_temp None).
+    Falls back to the database and caches the lead on a miss.
+    """
+    candidates = []
+    try:
+        if by_temp is not False:
+            candidates.append(_cached_lead(redis_obj.hget(IVR_TEMP_LOOKUP_KEY, number)))
+        if not by_temp:
+            candidates.append(_cached_lead(number))
+    except Exception as e:
+        print(f"find_ivr_lead cache {number} {e}")
+    candidates = [lead for lead in candidates if lead and (not file_id or lead['file_id'] == file_id)]
+    if candidates:
+        return max(candidates, key=lambda lead: lead['created_at'])
+    query = ML.query.with_entities(*IVR_LOOKUP_COLUMNS)
+    if by_temp is None:
+        query = query.filter((ML.temp_mortgage_id == number) | (ML.mortgage_id == number))
+    elif by_temp:
+        query = query.filter(ML.temp_mortgage_id == number)
+    else:
+        query = query.filter(ML.mortgage_id == number)
+    if file_id:
+        query = query.filter(ML.file_id == file_id)
+    lead = query.order_by(ML.created_at.desc()).first()
+    if not lead:
+        return None
+    try:
+        cache_ivr_leads([lead])
+    except Exception as e:
+        print(f"find_ivr_lead cache {number} {e}")
+    return ivr_lookup_record(lead)
+
+
+def ivr_loan_date(lead: Dict) -> Optional[date]:
+    return date.fromisoformat(lead['loan_date']) if lead.get('loan_date') else None
@@ -0,0 +1,151 @@
+"""Archive of the inactive mailing leads on S3, with the index table the lookups fall back to."""
+import gzip
+import json
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from app import db
+from app.models import (
+    ArchivedLead,
+    MailingAssignee as MA,
+    MailingLead as ML,
+    MailingLeadMemberStatusLog as MLMSL,
+    MailingResponse as MR
+    )
+from app.services.aws_services import AmazonServices
+from app.services.crud import CRUD
+from app.services.ivr_lookup import evict_ivr_leads
+from config import Config_is
+
+
+ARCHIVE_BATCH_SIZE = 5000  # leads per S3 object
+ARCHIVE_PREFIX = f"{Config_is.ENVIRONMENT}/lead_archive"
+
+# Leads nobody touched since the cutoff, the purchased ones stay with their buyers
+ARCHIVE_CANDIDATES_SQL = text("""
+    SELECT ml.mortgage_id FROM mailing_lead ml
+    WHERE COALESCE(ml.created_date, ml.created_at::date) < :cutoff
+        AND COALESCE(ml.is_in_checkout, false) = false
+        AND NOT EXISTS (
+            SELECT 1 FROM mailing_response mr
+            WHERE mr.mortgage_id = ml.mortgage_id AND mr.call_in_date_time >= :cutoff
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM mailing_assignee ma
+            WHERE ma.mortgage_id = ml.mortgage_id
+                AND (ma.purchased_user_id IS NOT NULL OR ma.modified_at >= :cutoff)
+        )
+    ORDER BY ml.mortgage_id
+    LIMIT :limit
+    FOR UPDATE OF ml SKIP LOCKED
+    """)
+
+
+def _row_dict(row) -> Dict:
+    return {column.name: getattr(row, column.key) for column in row.__table__.columns}
+
+
+def _lead_documents(mortgage_ids: List[str]) -> Dict[str, Dict]:
+    """
+    {mortgage_id: {"lead", "assignees", "responses"}}, each assignee carries its status logs
+    """
+    documents = {
+        lead.mortgage_id: {"lead": _row_dict(lead), "assignees": [], "responses": []}
+        for lead in ML.query.filter(ML.mortgage_id.in_(mortgage_ids))
+        }
+    assignees = {}
+    for assignee in MA.query.filter(MA.mortgage_id.in_(mortgage_ids)):
+        assignees[assignee.id] = _row_dict(assignee) | {"status_logs": []}
+        documents[assignee.mortgage_id]["assignees"].append(assignees[assignee.id])
+    if assignees:
+        for log in MLMSL.query.filter(MLMSL.mailing_assignee_id.in_(list(assignees))).order_by(MLMSL.id):
+            assignees[log.mailing_assignee_id]["status_logs"].append(_row_dict(log))
+    for response in MR.query.filter(MR.mortgage_id.in_(mortgage_ids)):
+        documents[response.mortgage_id]["responses"].append(_row_dict(response))
+    return documents
+
+
+def archive_leads_batch(cutoff: date) -> int:
+    """
+    Uploads one batch and removes it from the hot tables, the assignees, responses and
+    status logs go with the lead through the cascading foreign keys. Returns the leads archived.
+    """
+    mortgage_ids = [
+        row.mortgage_id for row in db.session.execute(
+            ARCHIVE_CANDIDATES_SQL, {"cutoff": cutoff, "limit": ARCHIVE_BATCH_SIZE})
+        ]
+    if not mortgage_ids:
+        db.session.rollback()
+        return 0
+    documents = _lead_documents(mortgage_ids)
+    body = gzip.compress("".join(
+        json.dumps(document, default=str) + "\n" for document in documents.values()
+        ).encode())
+    object_key = f"{ARCHIVE_PREFIX}/{datetime.utcnow():%Y/%m}/{uuid4().hex}.jsonl.gz"
+    # The object is written before the rows are deleted, a failed commit leaves an unreferenced object only
+    AmazonServices().put_object(body, object_key, "application/gzip")
+    now = datetime.utcnow()
+    db.session.bulk_insert_mappings(ArchivedLead, [
+        dict(
+            mortgage_id=mortgage_id, uuid=document["lead"]["uuid"], state=document["lead"]["state"],
+            full_name=document["lead"]["full_name"], created_date=document["lead"]["created_date"],
+            agent_ids=sorted({a["agent_id"] for a in document["assignees"] if a["agent_id"] is not None}),
+            object_key=object_key, created_at=now, modified_at=now
+            )
+        for mortgage_id, document in documents.items()
+        ])
+    ML.query.filter(ML.mortgage_id.in_(list(documents))).delete(synchronize_session=False)
+    CRUD.db_commit()
+    try:
+        # the lookup would keep answering the IVR for the deleted leads otherwise
+        evict_ivr_leads([
+            (mortgage_id, document["lead"]["temp_mortgage_id"]) for mortgage_id, document in documents.items()])
+    except Exception as e:
+        print(f"archive_leads_batch evict_ivr_leads {e}")
+    print(f"archive_leads_batch {object_key} leads {len(documents)}")
+    return len(documents)
+
+
+def archive_old_leads(time_budget: float = 3000) -> int:
+    cutoff = datetime.utcnow().date() - timedelta(days=Config_is.LEAD_ARCHIVE_HORIZON_DAYS)
+    started, archived = time.monotonic(), 0
+    while time.monotonic() - started < time_budget:
+        count = archive_leads_batch(cutoff)
+        archived += count
+        if count < ARCHIVE_BATCH_SIZE:
+            break
+    print(f"archive_old_leads before {cutoff} leads {archived}")
+    return archived
+
+
+def read_archived_lead(mortgage_id: str, uuid: Optional[str] = None) -> Optional[Dict]:
+    """
+    Document of an archived lead read back from its S3 object, None when it is not archived
+    """
+    filters = {"mortgage_id": mortgage_id} | ({"uuid": uuid} if uuid else {})
+    index = ArchivedLead.query.filter_by(**filters).with_entities(ArchivedLead.object_key).first()
+    if not index:
+        return None
+    with gzip.GzipFile(fileobj=AmazonServices().get_object_stream(index.object_key)) as lines:
+        for line in lines:
+            document = json.loads(line)
+            if document["lead"]["mortgage_id"] == mortgage_id:
+                return document
+    return None
+
+
+def archived_date(value: Optional[str]) -> Optional[date]:
+    return date.fromisoformat(value[:10]) if value else None
+
+
+def archived_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def archived_latest_response(document: Dict) -> Dict:
+    responses = [r for r in document["responses"] if r.get("call_in_date_time")]
+    return max(responses, key=lambda r: r["call_in_date_time"]) if responses else {}
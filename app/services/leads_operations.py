@@ -1,13 +1,12 @@
 import queue
 import base64
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional, Union
 from math import ceil
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict
 import boto3
 from flask import g, render_template
-from sqlalchemy import (func,  and_, not_, desc)
+from sqlalchemy import (func,  and_, not_, desc, text, cast)
+from sqlalchemy.dialects.postgresql import JSONB
 from werkzeug.datastructures import FileStorage
 from sqlalchemy.orm import Query
 
@@ -23,20 +22,42 @@ from app.services.utils import (
     date_object_to_string,
     convert_utc_to_timezone
 )
-from app.services.file_operations import thread_download_mortgage_file
+from app.services.file_operations import (
+    thread_download_mortgage_file,
+    stream_query_export
+    )
 from app.services.custom_errors import *
 from app.services.crud import CRUD
+from app.services.pagination import keyset_paginate
+from app.services.text_search import contains, similarity_rank
+from app.services.db_pool import run_fanout
+from app.services.aggregate_cache import invalidate_aggregate_cache
+from app.services.report_summary import report_days_for_leads
+from app.services.lead_archive import (
+    read_archived_lead, archived_date, archived_datetime, archived_latest_response
+    )
 from app.services.sendgrid_email import SendgridEmailSending
 from app.services.aws_services import AmazonServices
-from app import app, db, logging
+from app import app, db, logging, tasks
 from config import Config_is
 from constants import (
     EXCLUDED_STATUS_FILTER_FROM_SALE,
-    EXCLUDED_STATUS_OCCUR_TWO_TIME,
     LEAD_STATUS 
     )
 
 
+LEAD_SEARCH_COLUMNS = [ML.full_name, ML.address, ML.city]
+
+
+def lead_search_rank(name: Optional[str]):
+    """
+    Rank of the name search, None for a mortgage id or a term too short to rank
+    """
+    if not name or name.strip().isdigit():
+        return None
+    return similarity_rank(LEAD_SEARCH_COLUMNS, name)
+
+
 def view_lead_filters(db_query, query_filters: Dict):
     if g.user['role_id'] == 1 and query_filters.get('agent_id'):
         db_query = db_query.filter(MA.agent_id == query_filters.pop('agent_id'))  
@@ -47,12 +68,12 @@ def view_lead_filters(db_query, query_filters: Dict):
     else:
         db_query = db_query.filter(MA.lead_status != 12)
     if query_filters.get('campaign'):
-        db_query = db_query.filter(MA.campaign_name.ilike(f"%{query_filters.pop('campaign', '')}%"))
+        db_query = db_query.filter(contains([MA.campaign_name], query_filters.pop('campaign', '')))
     if query_filters.get('name'):
         if query_filters.get('name').strip().isdigit():
             db_query = db_query.filter(MA.mortgage_id == query_filters.pop('name').strip())
         else:
-            db_query = db_query.filter(ML.full_name.ilike(f"%{query_filters.pop('name').strip()}%"))
+            db_query = db_query.filter(contains(LEAD_SEARCH_COLUMNS, query_filters.pop('name')))
     if query_filters.get('purchased_user_id'):
         db_query = db_query.filter(MA.purchased_user_id == query_filters.pop('purchased_user_id'))
     else:
@@ -62,9 +83,11 @@ def view_lead_filters(db_query, query_filters: Dict):
     return db_query
 
 
-def get_agents_mailing_leads(query_filters: Dict, page: int, per_page: int) -> Tuple:
+def get_agents_mailing_leads(query_filters: Dict, page: int, per_page: int, 
+                             after: Optional[str] = None, exact_total: bool = False) -> Tuple:
     print(query_filters, page, per_page)
     result = []
+    key_columns = [MA.modified_at, MA.id]
     if not query_filters.pop('is_mailed', None):
         db_query = ML.query.join(
             MR, MR.mortgage_id == ML.mortgage_id).join(MA, MA.mortgage_id==ML.mortgage_id).with_entities(
@@ -74,6 +97,7 @@ def get_agents_mailing_leads(query_filters: Dict, page: int, per_page: int) -> T
                 ML.lender_name, ML.loan_amount, ML.loan_date, MA.id.label('assignee_id'))
         if query_filters.get('lead_status', '') != 12:
             db_query =  db_query.order_by(MR.call_in_date_time.desc())
+            key_columns = [MR.call_in_date_time, ML.mortgage_id, MA.id]
         else:
             db_query =  db_query.order_by(MA.modified_at.desc())
         if 'completed' in query_filters:
@@ -93,24 +117,40 @@ def get_agents_mailing_leads(query_filters: Dict, page: int, per_page: int) -> T
             .filter(MR.mortgage_id == None)
             .order_by(MA.modified_at.desc())
             )
+    # the keyset cursor needs the plain order, only the page based listing is ranked
+    rank = lead_search_rank(query_filters.get('name')) if after is None else None
     db_query = view_lead_filters(db_query, query_filters)
+    if rank is not None:
+        db_query = db_query.order_by(None).order_by(rank.desc(), *[column.desc() for column in key_columns])
     try:
-        leads = db_query.paginate(page=page, per_page=per_page, error_out=False)    
-        for data in leads.items:
-            data = data._asdict()
+        if after is not None:
+            rows, pagination = keyset_paginate(db_query, key_columns, after, per_page, exact_total)
+        else:
+            leads = db_query.paginate(page=page, per_page=per_page, error_out=False)
+            rows = [data._asdict() for data in leads.items]
+            pagination = {'total': leads.total, 'current_page': leads.page, 'per_page': leads.per_page}
+        for data in rows:
             data['loan_date'] = date_object_to_string(data['loan_date'])
             data['call_in_date_time'] = date_time_obj_to_str(data.get('call_in_date_time'))
             result.append(data)
+    except CustomError:
+        raise
     except Exception as e:
         db.session.rollback()
         print(f"get_agents_mailing_value_leads --> {e}")
         raise InternalError('Server is overloaded please try again later')
     if result:
-        return result, {'total': leads.total, 'current_page': leads.page, 'per_page': leads.per_page,
-                        'length': len(result)}
+        pagination['length'] = len(result)
+        return result, pagination
     raise NoContent()
 
 
+def agent_mailing_lead_row(data: Dict) -> Dict:
+    data['loan_date'] = date_object_to_string(data['loan_date'])
+    data['call_in_date_time'] = date_time_obj_to_str(data.get('call_in_date_time', None))
+    return data
+
+
 def download_all_mailing_leads_thread(db_query, page, per_page, thread_response):
     try:
         with app.app_context():
@@ -120,10 +160,7 @@ def download_all_mailing_leads_thread(db_query, page, per_page, thread_response)
                     leads = db_query.order_by(ML.mortgage_id.desc()).paginate(
                         page=page, per_page=per_page, error_out=False)
                     for data in leads.items:
-                        data = data._asdict()
-                        data['loan_date'] = date_object_to_string(data['loan_date'])
-                        data['call_in_date_time'] = date_time_obj_to_str(data.get('call_in_date_time', None))
-                        response.append(data)
+                        response.append(agent_mailing_lead_row(data._asdict()))
                     thread_response.put(response)
                 except Exception as e:
                     db.session.rollback()
@@ -136,7 +173,7 @@ def download_all_mailing_leads_thread(db_query, page, per_page, thread_response)
     return True
 
 
-def all_download_agent_mailing_leads(query_filters: Dict, total: int) -> List:
+def all_download_agent_mailing_leads(query_filters: Dict, total: int, export_format: Optional[str] = None) -> Union[List, Iterator[str]]:
     result, page, per_page, thread_response = [], 0, 15000, queue.Queue()
     if not query_filters.pop('is_mailed', None):
         db_query = ML.query.join(MR, MR.mortgage_id == ML.mortgage_id).join(
@@ -155,9 +192,12 @@ def all_download_agent_mailing_leads(query_filters: Dict, total: int) -> List:
             MA.campaign_name, ML.zip, ML.city, ML.address, ML.first_name, 
             ML.last_name, ML.loan_amount, ML.loan_date).filter(MR.mortgage_id == None).order_by(MA.modified_at.desc())
     db_query = view_lead_filters(db_query, query_filters)
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        for page in range(1, ceil(total / per_page) + 1):
-            executor.submit(download_all_mailing_leads_thread, db_query, page, per_page, thread_response)
+    if export_format:
+        return stream_query_export(db_query, export_format, agent_mailing_lead_row)
+    run_fanout([
+        (download_all_mailing_leads_thread, db_query, page, per_page, thread_response)
+        for page in range(1, ceil(total / per_page) + 1)
+        ])
     for _ in range(1, ceil(total / per_page) + 1):
         val = thread_response.get(timeout=120)
         print(f'Length of cal {len(val)}')
@@ -196,10 +236,25 @@ def get_mailing_single_mortgage_details(mortgage_id: str, agent_id: int) -> Dict
     return data
 
 
+def archived_single_lead_serializer(document: Dict) -> Dict:
+    lead, response = document["lead"], archived_latest_response(document)
+    data = {key: lead.get(key) for key in (
+        "mortgage_id", "full_name", "address", "lender_name", "city", "loan_amount",
+        "state", "zip", "first_name", "last_name")}
+    data['loan_date'] = date_object_to_string(archived_date(lead.get('loan_date')))
+    if response:
+        data['ivr_response'] = response.get('ivr_response')
+        data['call_in_date_time'] = date_time_obj_to_str(archived_datetime(response.get('call_in_date_time')))
+    return data
+
+
 def single_mortgage_public(mortgage_id: str, uuid: str) -> Dict:
     lead_obj = ML.query.filter_by(mortgage_id=mortgage_id, uuid=uuid).first()
     if not lead_obj:
-        raise NoContent()
+        document = read_archived_lead(mortgage_id, uuid)
+        if not document:
+            raise NoContent()
+        return archived_single_lead_serializer(document)
     data = mailer_single_lead_serializer(lead_obj)
     return data
 
@@ -232,41 +287,51 @@ def single_mortgage_public(mortgage_id: str, uuid: str) -> Dict:
 #     raise NoContent()
 
 
+STATUS_CHANGE_SQL = text("""
+    WITH changed AS (
+        UPDATE mailing_assignee SET lead_status = :lead_status, lead_status_changed_at = :changed_at
+        WHERE mortgage_id = ANY(:mortgage_ids) AND agent_id = ANY(:agent_ids)
+        RETURNING id
+    )
+    INSERT INTO mailing_lead_member_status_log
+        (mailing_assignee_id, lead_status, user_id, is_active, created_at, modified_at)
+    SELECT id, :lead_status, :user_id, true, :changed_at, :changed_at FROM changed
+    """)
+# A lead stays on sale while none of its assignees holds an excluded status
+CAN_SALE_SQL = text("""
+    UPDATE mailing_lead SET can_sale = derived.can_sale
+    FROM (
+        SELECT ml.mortgage_id, NOT EXISTS (
+            SELECT 1 FROM mailing_assignee ma
+            WHERE ma.mortgage_id = ml.mortgage_id AND ma.lead_status = ANY(:excluded_statuses)
+        ) AS can_sale
+        FROM mailing_lead ml WHERE ml.mortgage_id = ANY(:mortgage_ids)
+    ) derived
+    WHERE mailing_lead.mortgage_id = derived.mortgage_id
+        AND mailing_lead.can_sale IS DISTINCT FROM derived.can_sale
+    """)
+
+
 def mailing_campaign_status_change(mortgage_ids: List, agent_ids: List, lead_status: int) -> bool:
-    MA.query.filter(MA.mortgage_id.in_(mortgage_ids), MA.agent_id.in_(agent_ids)).update({'lead_status': lead_status, 'lead_status_changed_at': datetime.utcnow()})
-    CRUD.db_commit()
-    status_logs = []
-    agent_mortgage_status = defaultdict(int)
-    can_sale = set()
-    cannot_sale = set()
-    for ld in MA.query.filter(
-        MA.mortgage_id.in_(mortgage_ids)
-        ).with_entities(MA.mortgage_id, MA.lead_status, MA.id.label('assignee_id')).all():
-        status_logs.append(
-            MLMSL(
-                mailing_assignee_id=ld.assignee_id,
-                lead_status=lead_status,
-                user_id=g.user['id']
-            )
-        )
-        if ld.mortgage_id in cannot_sale:
-            continue
-        if ld.lead_status in EXCLUDED_STATUS_FILTER_FROM_SALE:
-            cannot_sale.add(ld.mortgage_id)
-        else:
-            can_sale.add(ld.mortgage_id)
-    if status_logs:
-        db.session.bulk_save_objects(status_logs)
-    for mortgage_id in (set(agent_mortgage_status.keys()) - cannot_sale):
-        if agent_mortgage_status[mortgage_id] >= 2:
-            cannot_sale.add(mortgage_id)
-        else:
-            can_sale.add(mortgage_id)
-    if cannot_sale:
-        ML.query.filter(ML.mortgage_id.in_(list(cannot_sale)), ML.can_sale == True).update({'can_sale': False})
-    if can_sale - cannot_sale:
-        ML.query.filter(ML.mortgage_id.in_(list(can_sale - cannot_sale)), ML.can_sale == False).update({'can_sale': True})
+    """
+    Status update, status log and can_sale recount in one transaction of two set based statements
+    """
+    mortgage_ids, agent_ids = list(mortgage_ids), list(agent_ids)
+    if not mortgage_ids or not agent_ids:
+        return True
+    report_days = report_days_for_leads(mortgage_ids, agent_ids)
+    changed = db.session.execute(STATUS_CHANGE_SQL, {
+        "lead_status": lead_status, "changed_at": datetime.utcnow(), "user_id": g.user['id'],
+        "mortgage_ids": mortgage_ids, "agent_ids": agent_ids
+        }).rowcount
+    db.session.execute(CAN_SALE_SQL, {
+        "mortgage_ids": mortgage_ids, "excluded_statuses": EXCLUDED_STATUS_FILTER_FROM_SALE
+        })
     CRUD.db_commit()
+    print(f"mailing_campaign_status_change {lead_status} assignees {changed}")
+    invalidate_aggregate_cache()
+    tasks.refresh_marketplace_inventory.delay(mortgage_ids)
+    tasks.refresh_report_summary.delay(report_days)
     return True
 
 
@@ -287,6 +352,7 @@ def admin_mailing_suppression_decide(agent_mortgage: List, data: Dict) -> bool:
     # Admin can approve or reject the suppression requests
     # mortgage_id_list = set()
     status_logs = []
+    report_days = report_days_for_leads(assignee_ids=[lead['id'] for lead in agent_mortgage])
     for lead in agent_mortgage:
         MA.query.filter(MA.id == lead['id'], MA.agent_id == lead['agent_id']).update(
             {'suppression_approved_by': g.user['id'], **data})
@@ -305,6 +371,8 @@ def admin_mailing_suppression_decide(agent_mortgage: List, data: Dict) -> bool:
         # ML.query.filter(ML.mortgage_id.in_(list(mortgage_id_list)), ML.disabled_in_marketplace == False).update(
         #     {'disabled_in_marketplace': True})
     CRUD.db_commit()
+    invalidate_aggregate_cache()
+    tasks.refresh_report_summary.delay(report_days)
     return True
 
 
@@ -361,24 +429,32 @@ class CopyMoveMailingLead:
         return True
     
     def move_leads(self) -> bool:
-        ids = []
+        ids, assignee_ids = [], []
         print(self.mortgage_ids)
         for lm in MA.query.filter(
             MA.mortgage_id.in_(list(self.mortgage_ids.keys())),
-            MA.agent_id.in_(self.from_agent_ids)).all():
-            print(lm)
+            MA.agent_id.in_(self.from_agent_ids)).with_entities(MA.id, MA.mortgage_id, MA.agent_id):
             if lm.mortgage_id in ids or self.mortgage_ids.get(str(lm.mortgage_id)) != lm.agent_id:
                 continue
             ids.append(lm.mortgage_id)
-            lm.moved_at = datetime.utcnow()
-            moved_history = lm.moved_history if lm.moved_history else []
-            moved_history.append({'moved_from_agent_id': lm.agent_id, 'moved_by_user': lm.g.user['id'], 'moved_at': str(lm.moved_at), 'moved_to': self.to_agent_id})
-            lm.moved_history = moved_history
-            lm.moved_from_agent_id = lm.agent_id
-            lm.agent_id = self.to_agent_id
-            lm.lead_status = 1
-            lm.moved = True
-            lm.moved_by_user = g.user['id']
+            assignee_ids.append(lm.id)
+        if not assignee_ids:
+            return True
+        moved_at = datetime.utcnow()
+        # The history entry is appended in the database, the existing entries are never loaded
+        history_entry = func.jsonb_build_array(func.jsonb_build_object(
+            'moved_from_agent_id', MA.agent_id, 'moved_by_user', str(g.user['id']),
+            'moved_at', str(moved_at), 'moved_to', self.to_agent_id
+            ))
+        MA.query.filter(MA.id.in_(assignee_ids)).update({
+            MA.moved_history: func.coalesce(MA.moved_history, cast('[]', JSONB)).op('||')(history_entry),
+            MA.moved_from_agent_id: MA.agent_id,
+            MA.agent_id: self.to_agent_id,
+            MA.lead_status: 1,
+            MA.moved: True,
+            MA.moved_at: moved_at,
+            MA.moved_by_user: g.user['id'],
+            }, synchronize_session=False)
         CRUD.db_commit()
         return True
 
@@ -459,12 +535,16 @@ def upload_sales_docs(category: int, mortgage_id: str, agent_id: int, files:  Op
 
         encoded_file = base64.b64encode(file_contents).decode('ascii')
         attachments.append({'encoded_file': encoded_file, 'name': file_name, 'type': file_type})
+    report_days = report_days_for_leads(assignee_ids=[query_response[1].id])
     query_response[1].lead_status = 7
     query_response[0].can_sale = False
     if not query_response[1].sold_date:
         query_response[1].sold_date = convert_datetime_to_timezone_date(datetime.utcnow())
     query_response[1].suppressed_by = g.user['id']
     CRUD.db_commit()
+    invalidate_aggregate_cache()
+    tasks.refresh_marketplace_inventory.delay([mortgage_id])
+    tasks.refresh_report_summary.delay(report_days)
     html_data = render_template(
         "suppression_requests.html", mortgage_id=mortgage_id, full_name=query_response[0].full_name,
         agent_name=g.user['name'], sold_date=date_object_to_string(query_response[1].sold_date),
@@ -506,27 +586,34 @@ def list_sold_documents(category: int, mortgage_id: str, agent_id: int) -> List:
     raise NoContent()
 
 
-def list_mailing_suppression_requests(page: int, per_page: int) -> Tuple:
+def list_mailing_suppression_requests(page: int, per_page: int, after: Optional[str] = None, 
+                                      exact_total: bool = False) -> Tuple:
     result = []
     try:
-        lead_objs = ML.query.join(
+        lead_query = ML.query.join(
             MR, MR.mortgage_id == ML.mortgage_id).join(MA, MA.mortgage_id==ML.mortgage_id).join(
                 Agent, Agent.id == MA.agent_id).join(User, User.id == Agent.user_id).with_entities(
                     ML.mortgage_id, ML.source_id, ML.full_name, ML.state, ML.city, MA.id.label('assignee_id'), MA.agent_id, MA.notes, 
                     MA.lead_status, MA.suppression_rejection_msg, MA.campaign_name, MR.call_in_date_time, MR.completed, 
                     MR.ivr_response, MR.ivr_logs, MA.sold_date, User.name.label('agent_name'), ML.zip, 
                     ML.city, ML.address, ML.first_name, ML.last_name, ML.lender_name, ML.loan_amount, ML.loan_date).filter(
-                        MA.lead_status == 7).order_by(MA.modified_at.desc()).paginate(
-                            page=page, per_page=per_page, error_out=False)
-        for data in lead_objs.items:
-            data = data._asdict()
+                        MA.lead_status == 7).order_by(MA.modified_at.desc())
+        if after is not None:
+            rows, pagination = keyset_paginate(lead_query, [MA.modified_at, MA.id], after, per_page, exact_total)
+        else:
+            lead_objs = lead_query.paginate(page=page, per_page=per_page, error_out=False)
+            rows = [data._asdict() for data in lead_objs.items]
+            pagination = {'total': lead_objs.total, 'current_page': lead_objs.page, 'per_page': lead_objs.per_page}
+        for data in rows:
             data['call_in_date_time'] = date_time_obj_to_str(data['call_in_date_time'])
             for dt in ('sold_date', 'loan_date'):
                 data[dt] = date_object_to_string(data[dt])
             result.append(data)
         if result:
-            return result, {'total': lead_objs.total, 'current_page': lead_objs.page, 'length': len(result), 
-                            'per_page': lead_objs.per_page}
+            pagination['length'] = len(result)
+            return result, pagination
+    except BadRequest:
+        raise
     except Exception as e:
         print(f"list_mailing_suppression_requests {e}")
     raise NoContent()
@@ -543,12 +630,38 @@ def get_mailing_leads_search(search: str) -> Dict:
         lead_obj = lead_obj.filter(MA.agent_id.in_(g.user['mailing_agent_ids']))
     lead_obj = lead_obj.filter(MA.mortgage_id == search).first()
     if not lead_obj:
-        raise NoContent()
+        return archived_mailing_lead_search(search)
     data = lead_obj._asdict()
     data['loan_date'] = date_object_to_string(data['loan_date'])
     data['call_in_date_time'] = date_time_obj_to_str(lead_obj.call_in_date_time)
     return data
 
+
+def archived_mailing_lead_search(mortgage_id: str) -> Dict:
+    """
+    Search row of an archived lead, limited to its assignees the user can see
+    """
+    document = read_archived_lead(mortgage_id)
+    if not document:
+        raise NoContent()
+    assignees = document["assignees"]
+    if g.user['role_id'] != 1:
+        assignees = [a for a in assignees if a['agent_id'] in g.user['mailing_agent_ids']]
+    if not assignees:
+        raise NoContent()
+    lead, assignee, response = document["lead"], assignees[0], archived_latest_response(document)
+    data = {key: lead.get(key) for key in (
+        "mortgage_id", "source_id", "full_name", "state", "zip", "city", "address",
+        "first_name", "last_name", "lender_name", "loan_amount")}
+    data.update({key: assignee.get(key) for key in (
+        "agent_id", "notes", "lead_status", "suppression_rejection_msg", "campaign_name")})
+    data.update({key: response.get(key) for key in ("completed", "ivr_response", "ivr_logs")})
+    data['assignee_id'] = assignee['id']
+    data['loan_date'] = date_object_to_string(archived_date(lead.get('loan_date')))
+    data['call_in_date_time'] = date_time_obj_to_str(archived_datetime(response.get('call_in_date_time')))
+    data['archived'] = True
+    return data
+
             
 # def get_leads_count_for_territory(category: int) -> List[Dict]:
 #     if category == 1:
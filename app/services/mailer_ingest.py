@@ -0,0 +1,347 @@
+"""COPY based ingest of the weekly mailer CSV files."""
+import csv
+import io
+import json
+import codecs
+from datetime import datetime, timedelta
+from itertools import islice
+from time import perf_counter
+from uuid import uuid4
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import text, func, cast, BigInteger
+from sqlalchemy.exc import IntegrityError, DataError
+from psycopg2 import DataError as CopyDataError
+
+from app import db, logging, redis_obj
+from app.models import (
+    UploadedFile as UF,
+    MailingLead as ML
+)
+from app.services.crud import CRUD
+from app.services.aws_services import AmazonServices
+from app.services.ivr_lookup import evict_ivr_leads, warm_ivr_lookup
+from app.services.utils import convert_datetime_to_timezone_date
+from app.services.custom_errors import *
+from config import Config_is
+from constants import MAILER_UPLOAD_STATUS
+
+MAILER_UPLOAD_CHUNK_SIZE = 25000
+MAILER_UPLOAD_PROGRESS_HOURS = 168
+
+# Columns of the temporary staging table, in the order they are written by COPY
+STAGING_COLUMNS = (
+    "mortgage_id", "uuid", "agent_id", "full_name", "first_name", "last_name",
+    "state", "city", "zip", "address", "lender_name", "loan_amount",
+    "loan_date", "loan_type", "csv_data"
+    )
+
+CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE mailing_lead_staging (
+    mortgage_id VARCHAR(30),
+    uuid VARCHAR(10),
+    agent_id INTEGER,
+    full_name VARCHAR(120),
+    first_name VARCHAR(120),
+    last_name VARCHAR(120),
+    state VARCHAR(60),
+    city VARCHAR(100),
+    zip VARCHAR(10),
+    address VARCHAR(230),
+    lender_name VARCHAR(200),
+    loan_amount DOUBLE PRECISION,
+    loan_date TEXT,
+    loan_type VARCHAR(100),
+    csv_data JSONB
+) ON COMMIT DROP
+"""
+
+# Both tables are filled from the staging rows in one statement, so a duplicate
+# mortgage id rolls back the whole file instead of leaving half of it behind.
+MERGE_STAGING_TABLE = """
+WITH inserted_leads AS (
+    INSERT INTO mailing_lead (
+        mortgage_id, file_id, uuid, agent_id, full_name, first_name, last_name,
+        state, city, zip, address, lender_name, loan_amount, loan_date, loan_type,
+        csv_data, source_id, created_date, duplicate_status, can_sale,
+        disabled_in_marketplace, is_in_checkout, is_active, created_at, modified_at
+    )
+    SELECT
+        mortgage_id, :file_id, uuid, agent_id, full_name, first_name, last_name,
+        state, city, zip, address, lender_name, loan_amount,
+        NULLIF(loan_date, '')::date, loan_type, csv_data, :source_id,
+        :created_date, 0, TRUE, FALSE, FALSE, TRUE, :now, :now
+    FROM mailing_lead_staging
+    RETURNING mortgage_id, agent_id
+)
+INSERT INTO mailing_assignee (
+    agent_id, mortgage_id, campaign_name, lead_status, lead_status_changed_at,
+    copied, moved, moved_history, is_active, created_at, modified_at
+)
+SELECT agent_id, mortgage_id, :campaign, 1, :now, FALSE, FALSE, '[]', TRUE, :now, :now
+FROM inserted_leads
+"""
+
+
+def csv_header_modify(csv_row: Dict, csv_headings: Dict) -> Dict:
+    for variable, column in csv_headings.items():
+        try:
+            csv_row[variable] = csv_row.pop(column)
+        except KeyError:
+            pass
+    return csv_row
+
+
+class _CsvRowStream(io.RawIOBase):
+    """
+    File like object handed to COPY, encodes the rows lazily so the
+    whole upload never has to be held in memory.
+    """
+    def __init__(self, rows: Iterator[List]):
+        self.rows = rows
+        self.buffer = b""
+        self.line = io.StringIO()
+        self.writer = csv.writer(self.line, lineterminator="\n")
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.line.seek(0)
+            self.line.truncate()
+            self.writer.writerow(row)
+            self.buffer += self.line.getvalue().encode("utf-8")
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+class MailerCopyIngest:
+    """
+    Streams mailer CSV rows into a staging table using COPY ... FROM STDIN and
+    merges them into mailing_lead and mailing_assignee with a single statement.
+    Each chunk is committed together with the checkpoint on the uploaded file row,
+    so a retried job continues after the last committed chunk.
+    """
+    def __init__(self, uploaded: UF, csv_headers: Dict):
+        self.uploaded = uploaded
+        self.csv_headers = csv_headers
+        self.created_date = convert_datetime_to_timezone_date(uploaded.created_at)
+        self.chunk_parsed = 0
+        self.chunk_inserted = 0
+        self.timings = {"copy": 0.0, "merge": 0.0}
+
+    def staging_row(self, row: Dict) -> Optional[List]:
+        """
+        Converts a csv row into the staging table columns, None for the skipped rows
+        """
+        if not row.get(self.csv_headers["AGENT_ID"]):
+            return None
+        row = csv_header_modify(row, self.csv_headers)
+        city = row.pop("CITY", None)
+        return [
+            row.get("MORTGAGE_ID"),
+            uuid4().hex[:10],
+            row.get("AGENT_ID"),
+            (row.get("FULL_NAME", "") or f"{row.get('FIRST', '')} {row.get('LAST', '')}").strip(),
+            row.get("FIRST", ""),
+            row.get("LAST", ""),
+            row.get("STATE", "").upper(),
+            city,
+            row.get("ZIP"),
+            row.get("ADDRESS", ""),
+            row.get("LENDER_NAME"),
+            float(row.get("LOAN_AMOUNT", "0").lstrip("$").replace(",", "")),
+            row.get("LOAN_DATE"),
+            row.get("LOAN_TYPE"),
+            json.dumps(row)
+        ]
+
+    def staging_rows(self, rows: Iterator[Dict]) -> Iterator[List]:
+        for row in rows:
+            self.chunk_parsed += 1
+            data = self.staging_row(row)
+            if data is None:
+                continue
+            self.chunk_inserted += 1
+            yield data
+
+    def load(self, rows: Iterator[Dict]) -> bool:
+        """
+        Copies the rows into the staging table and merges them, the caller commits
+        """
+        self.chunk_parsed, self.chunk_inserted = 0, 0
+        now = datetime.utcnow()
+        started = perf_counter()
+        db.session.execute(text(CREATE_STAGING_TABLE))
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY mailing_lead_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            _CsvRowStream(self.staging_rows(rows))
+            )
+        self.timings["copy"] += perf_counter() - started
+        if not self.chunk_parsed:
+            return False
+        started = perf_counter()
+        db.session.execute(
+            text(MERGE_STAGING_TABLE), {
+                "file_id": self.uploaded.id, "source_id": self.uploaded.source_id,
+                "created_date": self.created_date, "campaign": self.uploaded.campaign,
+                "now": now
+                })
+        self.timings["merge"] += perf_counter() - started
+        return True
+
+    def run(self, reader: csv.DictReader, chunk_size: int = MAILER_UPLOAD_CHUNK_SIZE) -> bool:
+        """
+        Loads the reader chunk by chunk starting after the uploaded file checkpoint
+        """
+        if self.uploaded.rows_parsed:
+            # Skip the rows of the chunks committed by a previous attempt
+            next(islice(reader, self.uploaded.rows_parsed, self.uploaded.rows_parsed), None)
+        while True:
+            try:
+                loaded = self.load(islice(reader, chunk_size))
+                if loaded:
+                    self.uploaded.rows_parsed = (self.uploaded.rows_parsed or 0) + self.chunk_parsed
+                    self.uploaded.total_records = (self.uploaded.total_records or 0) + self.chunk_inserted
+                    self.uploaded.rows_rejected = (self.uploaded.rows_rejected or 0) + (self.chunk_parsed - self.chunk_inserted)
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                logging.info(f"MailerCopyIngest {self.uploaded.id} violates {e}")
+                if "duplicate key value violates unique constraint" in str(e):
+                    raise BadRequest("Duplicate mortgage Id")
+                raise BadRequest(str(e.orig))
+            except (DataError, CopyDataError, ValueError, KeyError) as e:
+                db.session.rollback()
+                print(f"MailerCopyIngest Exception: {e}")
+                logging.error(f"MailerCopyIngest Exception: {e}")
+                raise BadRequest(str(e))
+            if not loaded:
+                return True
+            publish_upload_progress(self.uploaded, 2, timings=self.timings)
+            if self.chunk_parsed < chunk_size:
+                return True
+
+
+def mailer_upload_s3_path(file_id: int) -> str:
+    return f"{Config_is.ENVIRONMENT}/weekly-files/{file_id}.csv"
+
+
+def publish_upload_progress(uploaded: UF, status: int, message: str = "", 
+                            timings: Optional[Dict] = None) -> bool:
+    """
+    Publish the upload counters to redis for the progress polling
+    """
+    data = {
+        "status": MAILER_UPLOAD_STATUS[status],
+        "rows_parsed": uploaded.rows_parsed or 0,
+        "rows_inserted": uploaded.total_records or 0,
+        "rows_rejected": uploaded.rows_rejected or 0,
+        "message": message
+        }
+    if timings is not None:
+        data["timings"] = json.dumps({k: round(v, 3) for k, v in timings.items()})
+    try:
+        key = f"mailer_upload_{uploaded.id}"
+        redis_obj.hset(key, mapping=data)
+        redis_obj.expire(key, timedelta(hours=MAILER_UPLOAD_PROGRESS_HOURS))
+        return True
+    except Exception as e:
+        print(f"publish_upload_progress {uploaded.id} {e}")
+    return False
+
+
+def get_mailer_upload_progress(file_id: int) -> Dict:
+    data = redis_obj.hgetall(f"mailer_upload_{file_id}")
+    if not data:
+        uploaded = UF.query.filter_by(id=file_id).first()
+        if not uploaded:
+            raise NoContent()
+        data = {
+            "status": MAILER_UPLOAD_STATUS.get(uploaded.upload_status),
+            "rows_parsed": uploaded.rows_parsed or 0,
+            "rows_inserted": uploaded.total_records or 0,
+            "rows_rejected": uploaded.rows_rejected or 0,
+            "message": ""
+            }
+    for k in ("rows_parsed", "rows_inserted", "rows_rejected"):
+        data[k] = int(data[k])
+    data["timings"] = json.loads(data.get("timings") or "{}")
+    data["file_id"] = file_id
+    return data
+
+
+def ingest_uploaded_mailer_file(file_id: int, csv_headers: Dict) -> bool:
+    """
+    Background job body, loads the s3 copy of the uploaded mailer file.
+    Data errors delete the upload, other exceptions are raised for a retry.
+    """
+    uploaded = UF.query.filter_by(id=file_id).first()
+    if not uploaded or uploaded.upload_status == 3:
+        return False
+    uploaded.upload_status = 2
+    CRUD.db_commit()
+    ingest = MailerCopyIngest(uploaded, csv_headers)
+    started = perf_counter()
+    body = AmazonServices().get_object_stream(mailer_upload_s3_path(file_id))
+    try:
+        ingest.run(csv.DictReader(codecs.getreader("utf-8-sig")(body)))
+    except BadRequest as e:
+        mark_upload_failed(file_id, e.message)
+        return False
+    finally:
+        body.close()
+    uploaded.upload_status = 3
+    CRUD.db_commit()
+    ingest.timings["total"] = perf_counter() - started
+    publish_upload_progress(uploaded, 3, timings=ingest.timings)
+    highest_mortgage_id = (
+        ML.query.filter(ML.file_id == file_id)
+        .with_entities(func.max(cast(ML.mortgage_id, BigInteger)))
+        .scalar()
+        )
+    if highest_mortgage_id is not None:
+        redis_obj.set("new_file_name", int(highest_mortgage_id) + 1)
+    try:
+        # The mailer goes out after the upload, have the IVR lookup ready before the first call
+        warm_ivr_lookup(file_id)
+    except Exception as e:
+        print(f"ingest_uploaded_mailer_file warm_ivr_lookup {file_id} {e}")
+    return True
+
+
+def mark_upload_failed(file_id: int, message: str) -> bool:
+    """
+    Removes the partially loaded leads (cascade) and keeps the reason for the progress polling
+    """
+    db.session.rollback()
+    uploaded = UF.query.filter_by(id=file_id).first()
+    if not uploaded:
+        return False
+    publish_upload_progress(uploaded, 4, message)
+    # a call during the upload may have cached some of the leads already
+    leads = [
+        (lead.mortgage_id, lead.temp_mortgage_id)
+        for lead in ML.query.filter(ML.file_id == file_id).with_entities(ML.mortgage_id, ML.temp_mortgage_id)
+        ]
+    try:
+        UF.query.filter_by(id=file_id).delete()
+        db.session.commit()
+    except Exception as e:
+        print(f"mark_upload_failed {file_id} {e}")
+        logging.error(f"mark_upload_failed {file_id} {e}")
+        db.session.rollback()
+        return True
+    try:
+        evict_ivr_leads(leads)
+    except Exception as e:
+        print(f"mark_upload_failed evict_ivr_leads {file_id} {e}")
+    return True
@@ -1,11 +1,8 @@
 from typing import (List, Dict, Tuple)
-from datetime import (datetime, timedelta)
+from datetime import datetime
 from collections import defaultdict
 
 from flask import g
-from sqlalchemy import (
-    case, func, literal, or_, cast, Date, Integer
-    )
 from app.models import (
     MailingLead as ML, 
     MailingAssignee as MA,
@@ -21,6 +18,10 @@ from app.services.utils import (
     date_object_to_string,
     convert_utc_to_timezone
 )
+from app.services.marketplace_inventory import (
+    available_inventory,
+    inventory_month_bucket
+    )
 from app.services.custom_errors import *
 from app import redis_obj
 from constants import USA_STATES
@@ -29,94 +30,35 @@ from constants import USA_STATES
 def mailing_completed_incomplete_statewise_count_for_sale(page: int, per_page: int, states: str = None) -> Tuple:
     states = list(USA_STATES.values()) if not states else states.split(',')
     # TODO: category and source based have to be done
-    db_query = (
-        MR.query
-        .join(ML, ML.mortgage_id == MR.mortgage_id)
-        .filter(
-            ~ML.lead_assigned_members.any(MA.agent_id.in_(g.user['mailing_agent_ids'])), 
-            or_(
-                ML.last_purchased_date == None,
-                ML.last_purchased_date < (datetime.utcnow() - timedelta(days=30)).date()
-            ),
-            ML.disabled_in_marketplace == False,
-            ML.is_in_checkout == False,
-            ML.can_sale == True,
-            ML.state.in_(states),
-            MR.call_in_date_time < (datetime.utcnow() - timedelta(days=30)),
-            MR.call_in_date_time >= (datetime.utcnow() - timedelta(days=730)),
-            )
-        .with_entities(
-            ML.state,
-            func.count(ML.mortgage_id).filter(MR.completed== True).label("completed"),
-            func.count(ML.mortgage_id).filter(MR.completed== False).label("incomplete")
-        )
-        .group_by(ML.state)
-    ).paginate(page=page, per_page=per_page, error_out=False)
-    result = []
+    state_counts = defaultdict(lambda: {"completed": 0, "incomplete": 0})
+    for (state, _, completed, _), count in available_inventory(g.user['mailing_agent_ids'], states).items():
+        state_counts[state]["completed" if completed else "incomplete"] += count
     # Only include 'complete' and 'incomplete' in the result if their counts are non-zero
     # This eliminates zero-count entries from the output JSON
-    for ld in db_query.items:
-        item = {"state": ld.state}
-        if ld.completed:
-            item["completed"] = ld.completed
-        if ld.incomplete:
-            item["incomplete"] = ld.incomplete
-        result.append(item)
+    items = []
+    for state in sorted(state_counts):
+        item = {"state": state}
+        item.update({k: v for k, v in state_counts[state].items() if v})
+        if len(item) > 1:
+            items.append(item)
+    result = items[(page - 1) * per_page: page * per_page]
     if result:
-        return result, {'total': db_query.total, 'current_page': db_query.page, 'length': len(result), 
-                            'per_page': db_query.per_page}
+        return result, {'total': len(items), 'current_page': page, 'length': len(result), 
+                            'per_page': per_page}
     raise NoContent('Sorry leads are not available for sale.')
 
     
 def specific_state_available_leads(state: str) -> List:
      # TODO: category and source based have to be done
-    today = datetime.utcnow()
-    today_date = today.date()
-    days_diff_expression = cast(
-        literal(today_date) - cast(MR.call_in_date_time, Date),
-        Integer
-        )
+    today_date = datetime.utcnow().date()
     result = defaultdict(dict)
-    days_diff_expression = cast(
-        func.extract('epoch', literal(today) - MR.call_in_date_time) / (60 * 60 * 24),
-        Integer
-        )
-    month_bucket_expr = case(
-        ((days_diff_expression >= 30) & (days_diff_expression <= 60), 1),
-        ((days_diff_expression > 60) & (days_diff_expression <= 90), 2),
-        ((days_diff_expression > 90) & (days_diff_expression <= 180), 3),
-        ((days_diff_expression > 180) & (days_diff_expression <= 270), 6),
-        ((days_diff_expression > 270) & (days_diff_expression <= 730), 9)
-        )
-    db_query = (
-        ML.query
-        .join(MR, MR.mortgage_id == ML.mortgage_id)
-        .filter(
-            ~ML.lead_assigned_members.any(MA.agent_id.in_(g.user['mailing_agent_ids'])),
-            or_(
-                ML.last_purchased_date == None,
-                ML.last_purchased_date < (today_date - timedelta(days=30))
-            ),
-            ML.disabled_in_marketplace == False,
-            ML.is_in_checkout == False,
-            ML.can_sale == True,
-            ML.state == state,
-            MR.call_in_date_time >= (datetime.utcnow()-timedelta(days=730)),
-            MR.call_in_date_time < (datetime.utcnow()-timedelta(days=30)))
-        .with_entities(
-            MR.completed,
-            month_bucket_expr.label("month"),
-            func.count(ML.mortgage_id).label("count")
-            )
-        .group_by(
-            MR.completed,
-            month_bucket_expr
-            )
-        )
-    for ld in db_query.all():
-        result[ld.month] |= {'completed' if ld.completed else 'incomplete': ld.count, 'month': ld.month}
+    for (_, _, completed, call_date), count in available_inventory(g.user['mailing_agent_ids'], [state]).items():
+        month = inventory_month_bucket((today_date - call_date).days)
+        if month is None or not count:
+            continue
+        key = 'completed' if completed else 'incomplete'
+        result[month] |= {key: result[month].get(key, 0) + count, 'month': month}
     if result:
-        pop_none = result.pop(None, None)
         sorted_dict = {key: result[key] for key in sorted(result.keys())}
         return list(sorted_dict.values())
     raise NoContent("Sorry there is not leads available for purchase")
@@ -0,0 +1,199 @@
+"""Incrementally maintained inventory of the saleable marketplace mailing leads."""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Date, cast, func, or_, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.models import (
+    MailingAssignee as MA,
+    MailingLead as ML,
+    MailingResponse as MR,
+    MarketplaceInventory as MI
+    )
+from app.services.crud import CRUD
+from constants import PRICING_DETAIL_MONTH
+
+
+INVENTORY_WINDOW_DAYS = 730
+INVENTORY_MIN_AGE_DAYS = 30
+INVENTORY_REFRESH_CHUNK = 5000
+
+call_date_expr = cast(MR.call_in_date_time, Date)
+state_expr = func.coalesce(ML.state, '')
+source_expr = func.coalesce(ML.source_id, 0)
+completed_expr = func.coalesce(MR.completed, False)
+
+
+def saleable_lead_filters(today_is: datetime, reserved_by: Optional[str] = None) -> List:
+    """
+    Lead level conditions of a marketplace sale, the buyer exclusion is applied at read time.
+    reserved_by: match the leads this user holds in checkout instead of the free ones
+    """
+    if reserved_by:
+        checkout = [ML.is_in_checkout == True, ML.item_reserved_temp_by == reserved_by]
+    else:
+        checkout = [ML.is_in_checkout == False]
+    return [
+        or_(
+            ML.last_purchased_date == None,
+            ML.last_purchased_date < (today_is - timedelta(days=30)).date()
+            ),
+        ML.disabled_in_marketplace == False,
+        *checkout,
+        ML.can_sale == True,
+        MR.call_in_date_time >= (today_is - timedelta(days=INVENTORY_WINDOW_DAYS + 1)),
+        ]
+
+
+def inventory_month_bucket(age_days: int) -> Optional[int]:
+    """
+    PRICING_DETAIL_MONTH key of a lead called age_days ago
+    """
+    for month in sorted(PRICING_DETAIL_MONTH):
+        info = PRICING_DETAIL_MONTH[month]
+        if info.get('start_day') is not None and info['start_day'] <= age_days <= info['end_day']:
+            return month
+    return None
+
+
+def _inventory_counts_query(today_is: datetime, reserved_by: Optional[str] = None):
+    return (
+        ML.query
+        .join(MR, MR.mortgage_id == ML.mortgage_id)
+        .filter(*saleable_lead_filters(today_is, reserved_by))
+        .with_entities(
+            state_expr.label('state'),
+            source_expr.label('source_id'),
+            completed_expr.label('completed'),
+            call_date_expr.label('call_date'),
+            func.count(ML.mortgage_id).label('lead_count')
+            )
+        .group_by(state_expr, source_expr, completed_expr, call_date_expr)
+        )
+
+
+def _lock_inventory() -> None:
+    # Serializes the inventory writers, readers are not blocked
+    db.session.execute(text("LOCK TABLE marketplace_inventory IN SHARE ROW EXCLUSIVE MODE"))
+
+
+def rebuild_marketplace_inventory() -> int:
+    """
+    Full recompute, run daily so the leads whose last purchase passes 30 days come back to sale
+    """
+    today_is = datetime.utcnow()
+    _lock_inventory()
+    db.session.execute(MI.__table__.delete())
+    counts = _inventory_counts_query(today_is).subquery()
+    result = db.session.execute(
+        insert(MI).from_select(
+            ['state', 'source_id', 'completed', 'call_date', 'lead_count', 'created_at', 'modified_at'],
+            select(
+                counts.c.state, counts.c.source_id, counts.c.completed, counts.c.call_date,
+                counts.c.lead_count, func.now(), func.now()
+                )
+            )
+        )
+    CRUD.db_commit()
+    print(f"rebuild_marketplace_inventory rows {result.rowcount}")
+    return result.rowcount
+
+
+def refresh_marketplace_inventory(mortgage_ids: List[str], previous_call_dates: Optional[List[str]] = None) -> int:
+    """
+    Recounts the inventory rows of the given leads after a status change, IVR call, reservation or purchase.
+    previous_call_dates: the call in dates a lead moved away from, their rows are recounted as well
+    """
+    today_is = datetime.utcnow()
+    previous = {date.fromisoformat(dt) for dt in previous_call_dates or []}
+    refreshed = 0
+    for i in range(0, len(mortgage_ids), INVENTORY_REFRESH_CHUNK):
+        chunk = mortgage_ids[i:i + INVENTORY_REFRESH_CHUNK]
+        keys = set()
+        for lead in (
+            ML.query
+            .join(MR, MR.mortgage_id == ML.mortgage_id)
+            .filter(ML.mortgage_id.in_(chunk))
+            .with_entities(state_expr.label('state'), source_expr.label('source_id'), call_date_expr.label('call_date'))
+            .distinct()
+            ):
+            keys.add((lead.state, lead.source_id, lead.call_date))
+            keys.update((lead.state, lead.source_id, dt) for dt in previous)
+        keys = {key for key in keys if key[2] is not None}
+        if not keys:
+            continue
+        _lock_inventory()
+        counts = {
+            (row.state, row.source_id, row.completed, row.call_date): row.lead_count
+            for row in _inventory_counts_query(today_is).filter(
+                tuple_(state_expr, source_expr, call_date_expr).in_(list(keys)))
+            }
+        rows = [
+            dict(
+                state=state, source_id=source_id, completed=completed, call_date=call_date,
+                lead_count=counts.get((state, source_id, completed, call_date), 0),
+                created_at=today_is, modified_at=today_is
+                )
+            for state, source_id, call_date in keys for completed in (True, False)
+            ]
+        statement = insert(MI).values(rows)
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[MI.state, MI.source_id, MI.completed, MI.call_date],
+                set_={'lead_count': statement.excluded.lead_count, 'modified_at': statement.excluded.modified_at}
+                )
+            )
+        CRUD.db_commit()
+        refreshed += len(rows)
+    return refreshed
+
+
+def excluded_agent_leads(agent_ids: List, today_is: datetime, states: Optional[Iterable[str]] = None,
+                         source_id: Optional[int] = None) -> Dict[Tuple, int]:
+    """
+    Saleable leads the buyer's own agents already hold, subtracted from the shared inventory
+    """
+    if not agent_ids:
+        return {}
+    held = select(MA.mortgage_id).where(MA.agent_id.in_(agent_ids)).distinct()
+    query = _inventory_counts_query(today_is).filter(ML.mortgage_id.in_(held))
+    if states is not None:
+        query = query.filter(ML.state.in_(list(states)))
+    if source_id is not None:
+        query = query.filter(ML.source_id == source_id)
+    return {(row.state, row.source_id, row.completed, row.call_date): row.lead_count for row in query}
+
+
+def available_inventory(agent_ids: List, states: Optional[Iterable[str]] = None,
+                        source_id: Optional[int] = None, reserved_by: Optional[str] = None) -> Dict[Tuple, int]:
+    """
+    {(state, source_id, completed, call_date): count} of the leads the user can buy,
+    limited to the calls between 30 and 730 days old.
+    reserved_by: adds back the leads this user already holds in checkout
+    """
+    today_is = datetime.utcnow()
+    newest = (today_is - timedelta(days=INVENTORY_MIN_AGE_DAYS)).date()
+    oldest = (today_is - timedelta(days=INVENTORY_WINDOW_DAYS)).date()
+    query = MI.query.filter(MI.call_date >= oldest, MI.call_date <= newest, MI.lead_count > 0)
+    if states is not None:
+        states = list(states)
+        query = query.filter(MI.state.in_(states))
+    if source_id is not None:
+        query = query.filter(MI.source_id == source_id)
+    result = defaultdict(int)
+    for row in query.with_entities(MI.state, MI.source_id, MI.completed, MI.call_date, MI.lead_count):
+        result[(row.state, row.source_id, row.completed, row.call_date)] += row.lead_count
+    for key, count in excluded_agent_leads(agent_ids, today_is, states, source_id).items():
+        if key in result:
+            result[key] = max(result[key] - count, 0)
+    if reserved_by:
+        reserved = _inventory_counts_query(today_is, reserved_by).filter(
+            MR.call_in_date_time < today_is - timedelta(days=INVENTORY_MIN_AGE_DAYS))
+        if states is not None:
+            reserved = reserved.filter(ML.state.in_(states))
+        for row in reserved:
+            result[(row.state, row.source_id, row.completed, row.call_date)] += row.lead_count
+    return result
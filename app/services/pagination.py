@@ -0,0 +1,114 @@
+"""Keyset (seek) pagination for the long listing endpoints."""
+import json
+import base64
+from uuid import UUID
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, false, literal, or_, tuple_
+from sqlalchemy.orm import Query
+
+from app import db
+from app.services.custom_errors import *
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Opaque token of the last row sort key
+    """
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime):
+            encoded.append(["dt", value.isoformat()])
+        elif isinstance(value, date):
+            encoded.append(["d", value.isoformat()])
+        elif isinstance(value, UUID):
+            encoded.append(["u", str(value)])
+        else:
+            encoded.append(["v", value])
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> List[Any]:
+    try:
+        encoded = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        values = []
+        for kind, value in encoded:
+            if kind == "dt":
+                value = datetime.fromisoformat(value)
+            elif kind == "d":
+                value = date.fromisoformat(value)
+            elif kind == "u":
+                value = UUID(value)
+            values.append(value)
+        return values
+    except Exception as e:
+        print(f"decode_cursor {token} {e}")
+        raise BadRequest("Invalid pagination token")
+
+
+def estimated_count(query: Query) -> int:
+    """
+    Planner row estimate of the query, avoids a COUNT(*) over the whole result
+    """
+    compiled = query.order_by(None).statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True})
+    plan = db.session.connection().exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def after_cursor(key_columns: List, values: List[Any]):
+    """
+    Rows sorting after the cursor in the DESC NULLS LAST order. The leading key column may be NULL,
+    a lead without a call time, the others make the key unique and are never NULL. A row comparison
+    with a NULL is unknown, so the NULL leading keys get a predicate of their own.
+    """
+    first, rest = key_columns[0], key_columns[1:]
+    rest_after = tuple_(*rest) < tuple_(*[
+        literal(value, column.type) for column, value in zip(rest, values[1:])]) if rest else false()
+    if values[0] is None:
+        return and_(first.is_(None), rest_after)
+    return or_(
+        tuple_(*key_columns) < tuple_(*[literal(value, column.type) for column, value in zip(key_columns, values)]),
+        first.is_(None)
+        )
+
+
+def keyset_paginate(query: Query, key_columns: List, after: Optional[str], per_page: int,
+                    exact_total: bool = False) -> Tuple[List, Dict]:
+    """
+    Seek pagination ordered by key_columns descending, the last column has to make the key unique.
+    Entity queries return the model objects, column queries return dictionaries.
+    """
+    single_entity = (
+        len(query.column_descriptions) == 1 and isinstance(query.column_descriptions[0]["expr"], type)
+        )
+    pagination = {"per_page": per_page}
+    if exact_total:
+        pagination["total"] = query.order_by(None).count()
+    else:
+        pagination["total"] = estimated_count(query)
+        pagination["estimated"] = True
+    labels = [f"cursor_{i}" for i in range(len(key_columns))]
+    query = query.add_columns(*[column.label(label) for column, label in zip(key_columns, labels)])
+    if after:
+        query = query.filter(after_cursor(key_columns, decode_cursor(after)))
+    rows = (
+        query.order_by(None)
+        .order_by(*[column.desc().nulls_last() for column in key_columns])
+        .limit(per_page + 1)
+        .all()
+        )
+    items = []
+    for row in rows[:per_page]:
+        if single_entity:
+            items.append(row[0])
+        else:
+            items.append({k: v for k, v in row._asdict().items() if k not in labels})
+    pagination["length"] = len(items)
+    pagination["next"] = encode_cursor(
+        [getattr(rows[per_page - 1], label) for label in labels]) if len(rows) > per_page else None
+    return items, pagination
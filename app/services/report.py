@@ -2,47 +2,45 @@ from typing import (
     List, Dict, Union, 
     Optional, Tuple
     )
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from flask import g
 from sqlalchemy import func
 from sqlalchemy.sql.expression import over
 
-from app.models import (
-    MailingAssignee as MA,
-    MailingLead as ML,
-    MailingResponse as MR,
-    MailingLeadMemberStatusLog as MLMSL
-)
+from app.models import MailingAssignee as MA
 from app.services.custom_errors import *
+from app.services.aggregate_cache import cached_aggregate
+from app.services.report_summary import summarize_report
 from app import db
 
+
+def report_cache_key(report: "ReportAndAnalytics") -> Tuple:
+    return report.start_date.date(), report.end_date.date()
+
+
 class ReportAndAnalytics:
     def __init__(self, start_date: str, end_date: str):
         self.start_date = datetime.strptime(start_date, "%m-%d-%Y")
         self.end_date = datetime.strptime(end_date, "%m-%d-%Y") 
     
+    def summary(self, end_day: Optional[date] = None) -> Dict:
+        return summarize_report(self.start_date.date(), end_day or self.end_date.date())
+
+    @cached_aggregate("report", key=report_cache_key)
     def get_state_wise_call_sold_count(self) -> List[Dict]:
-        query_objs = (
-            ML.query
-            .join(MA, MA.mortgage_id == ML.mortgage_id)
-            .filter(
-                MA.sold_date >= self.start_date, 
-                MA.sold_date <= self.end_date,
-                MA.lead_status == 7
-                )
-            .with_entities(
-                func.count(func.distinct(MA.mortgage_id)).label('sold'),
-                ML.state
-                )
-            .group_by(ML.state)
-            )
-        data = [query_obj._asdict() for query_obj in query_objs.all()]
+        data = [
+            {"sold": counters["sold"], "state": state or None}
+            for (state, lead_status), counters in self.summary().items()
+            if lead_status == 7 and counters["sold"]
+            ]
         if data:
             return data
         raise NoContent()
 
+    @cached_aggregate("report", key=report_cache_key)
     def get_lead_status_based_count(self) -> List[Dict]:
+        # the latest status of each lead in the range, per day summaries would count every change
         subq = (
             db.session
             .query(
@@ -72,26 +70,14 @@ class ReportAndAnalytics:
             return data
         raise NoContent()
 
+    @cached_aggregate("report", key=report_cache_key)
     def getting_total_leads_and_sold_count(self) -> Dict:
-        leads_query = (
-            MA.query
-            .join(MR, MR.mortgage_id == MA.mortgage_id)
-            .filter(
-                MR.call_in_date_time >= self.start_date, 
-                MR.call_in_date_time <= self.end_date
-                )
-            .with_entities(
-                 func.count(MR.mortgage_id).filter(MA.lead_status == 7).label("sold"),
-                 func.count(MR.mortgage_id).filter(
-                      MR.completed == True,
-                      MA.lead_status != 7
-                      ).label("completed"),
-                 func.count(MR.mortgage_id).filter(
-                      MR.completed == False,
-                      MA.lead_status == 7).label("incomplete")
-                 )
-            ).first()
-        data = leads_query._asdict()
-        if data:
-             return data
-        raise NoContent()
\ No newline at end of file
+        data = {"sold": 0, "completed": 0, "incomplete": 0}
+        # the calls of the end date are left out, as call_in_date_time <= end_date did
+        for (_, lead_status), counters in self.summary(self.end_date.date() - timedelta(days=1)).items():
+            if lead_status == 7:
+                data["sold"] += counters["assignee_calls"]
+                data["incomplete"] += counters["incomplete_assignee_calls"]
+            else:
+                data["completed"] += counters["completed_assignee_calls"]
+        return data
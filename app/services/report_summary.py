@@ -0,0 +1,148 @@
+"""Daily report summaries, a date range report sums them and reads only the running day live."""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Date, cast, func, select
+
+from app import db
+from app.models import (
+    MailingAssignee as MA,
+    MailingLead as ML,
+    MailingResponse as MR,
+    ReportDailySummary as RS
+    )
+from app.services.crud import CRUD
+
+
+REPORT_SUMMARY_COLUMNS = ("sold", "assignee_calls", "completed_assignee_calls", "incomplete_assignee_calls")
+REPORT_REBUILD_CHUNK_DAYS = 90
+
+state_expr = func.coalesce(ML.state, '')
+
+
+def _as_datetime(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+def _summary_rows(start_day: date, end_day: date) -> Dict[Tuple, Dict]:
+    """
+    {(day, state, lead_status): counters} of the days in [start_day, end_day)
+    """
+    start, end = _as_datetime(start_day), _as_datetime(end_day)
+    rows = defaultdict(lambda: dict.fromkeys(REPORT_SUMMARY_COLUMNS, 0))
+    for row in (
+        MA.query.join(ML, ML.mortgage_id == MA.mortgage_id)
+        .filter(MA.lead_status == 7, MA.sold_date >= start_day, MA.sold_date < end_day)
+        .with_entities(
+            MA.sold_date.label('day'), state_expr.label('state'),
+            func.count(func.distinct(MA.mortgage_id)).label('sold')
+            )
+        .group_by(MA.sold_date, state_expr)
+        ):
+        rows[(row.day, row.state, 7)]['sold'] = row.sold
+    call_day = cast(MR.call_in_date_time, Date)
+    for row in (
+        MA.query.join(MR, MR.mortgage_id == MA.mortgage_id)
+        .join(ML, ML.mortgage_id == MA.mortgage_id)
+        .filter(MR.call_in_date_time >= start, MR.call_in_date_time < end)
+        .with_entities(
+            call_day.label('day'), state_expr.label('state'), MA.lead_status,
+            func.count(MR.mortgage_id).label('assignee_calls'),
+            func.count(MR.mortgage_id).filter(MR.completed == True).label('completed_assignee_calls'),
+            func.count(MR.mortgage_id).filter(MR.completed == False).label('incomplete_assignee_calls')
+            )
+        .group_by(call_day, state_expr, MA.lead_status)
+        ):
+        rows[(row.day, row.state, row.lead_status)].update(
+            assignee_calls=row.assignee_calls,
+            completed_assignee_calls=row.completed_assignee_calls,
+            incomplete_assignee_calls=row.incomplete_assignee_calls
+            )
+    return rows
+
+
+def _write_summary(rows: Dict[Tuple, Dict], now: datetime) -> int:
+    mappings = [
+        dict(day=day, state=state, lead_status=lead_status, created_at=now, modified_at=now, **counters)
+        for (day, state, lead_status), counters in rows.items() if lead_status is not None
+        ]
+    if mappings:
+        db.session.bulk_insert_mappings(RS, mappings)
+    return len(mappings)
+
+
+def refresh_report_summary(days: Iterable) -> int:
+    """
+    Recomputes every row of the given days, isoformat strings or dates
+    """
+    days = sorted({date.fromisoformat(day) if isinstance(day, str) else day for day in days if day})
+    now, written = datetime.utcnow(), 0
+    for day in days:
+        RS.query.filter(RS.day == day).delete(synchronize_session=False)
+        written += _write_summary(_summary_rows(day, day + timedelta(days=1)), now)
+    CRUD.db_commit()
+    print(f"refresh_report_summary days {len(days)} rows {written}")
+    return written
+
+
+def rebuild_report_summary() -> int:
+    first_day = db.session.execute(select(func.least(
+        func.min(MA.sold_date),
+        select(func.min(cast(MR.call_in_date_time, Date))).scalar_subquery()
+        ))).scalar()
+    RS.query.delete(synchronize_session=False)
+    now, written = datetime.utcnow(), 0
+    tomorrow = now.date() + timedelta(days=1)
+    start_day = first_day or now.date()
+    while start_day < tomorrow:
+        end_day = min(start_day + timedelta(days=REPORT_REBUILD_CHUNK_DAYS), tomorrow)
+        written += _write_summary(_summary_rows(start_day, end_day), now)
+        start_day = end_day
+    CRUD.db_commit()
+    print(f"rebuild_report_summary rows {written}")
+    return written
+
+
+def report_days_for_leads(mortgage_ids: Optional[List[str]] = None, agent_ids: Optional[List] = None,
+                          assignee_ids: Optional[List[int]] = None) -> List[str]:
+    """
+    Days whose summary rows count the given assignees, read before their status changes
+    """
+    query = (
+        MA.query.outerjoin(MR, MR.mortgage_id == MA.mortgage_id)
+        .with_entities(MA.sold_date, cast(MR.call_in_date_time, Date))
+        .distinct()
+        )
+    if mortgage_ids is not None:
+        query = query.filter(MA.mortgage_id.in_(mortgage_ids))
+    if agent_ids is not None:
+        query = query.filter(MA.agent_id.in_(agent_ids))
+    if assignee_ids is not None:
+        query = query.filter(MA.id.in_(assignee_ids))
+    days = {day for row in query for day in row if day}
+    days.add(datetime.utcnow().date())
+    return sorted(day.isoformat() for day in days)
+
+
+def summarize_report(start_day: date, end_day: date) -> Dict[Tuple, Dict]:
+    """
+    {(state, lead_status): counters} of [start_day, end_day] inclusive,
+    the closed days from the summary and today from the live tables
+    """
+    today = datetime.utcnow().date()
+    result = defaultdict(lambda: dict.fromkeys(REPORT_SUMMARY_COLUMNS, 0))
+    closed_end = min(end_day, today - timedelta(days=1))
+    if start_day <= closed_end:
+        for row in (
+            RS.query.filter(RS.day >= start_day, RS.day <= closed_end)
+            .with_entities(RS.state, RS.lead_status, *[func.sum(getattr(RS, column)).label(column) for column in REPORT_SUMMARY_COLUMNS])
+            .group_by(RS.state, RS.lead_status)
+            ):
+            for column in REPORT_SUMMARY_COLUMNS:
+                result[(row.state, row.lead_status)][column] += row._mapping[column] or 0
+    if start_day <= today <= end_day:
+        for (_, state, lead_status), counters in _summary_rows(today, today + timedelta(days=1)).items():
+            for column in REPORT_SUMMARY_COLUMNS:
+                result[(state, lead_status)][column] += counters[column]
+    return result
@@ -0,0 +1,76 @@
+"""Redis sorted set of the marketplace checkout reservations, scored by expiry time."""
+import time
+from typing import Dict, List
+
+from sqlalchemy import update
+
+from app import db, redis_obj
+from app.models import MailingLead as ML
+from app.services.crud import CRUD
+
+
+RESERVATION_LEDGER_KEY = "marketplace_reservations"
+RESERVATION_SECONDS = 1020
+RESERVATION_RELEASE_BATCH = 500
+
+
+def add_reservations(shopping_cart_temp_ids: List[str], seconds: int = RESERVATION_SECONDS) -> bool:
+    if not shopping_cart_temp_ids:
+        return True
+    expires_at = time.time() + seconds
+    redis_obj.zadd(RESERVATION_LEDGER_KEY, {temp_id: expires_at for temp_id in shopping_cart_temp_ids})
+    return True
+
+
+def remove_reservations(shopping_cart_temp_ids: List[str]) -> bool:
+    """
+    Drop reservations that were converted into a purchase
+    """
+    if shopping_cart_temp_ids:
+        redis_obj.zrem(RESERVATION_LEDGER_KEY, *shopping_cart_temp_ids)
+    return True
+
+
+def release_reserved_leads(shopping_cart_temp_ids: List[str]) -> List[str]:
+    """
+    Puts the still reserved leads of the given reservations back on sale, returns their mortgage ids
+    """
+    released = db.session.execute(
+        update(ML)
+        .where(ML.shopping_cart_temp_id.in_(shopping_cart_temp_ids), ML.is_in_checkout == True)
+        .values(is_in_checkout=False, shopping_cart_temp_id=None, item_reserved_temp_by=None, modified_at=ML.modified_at)
+        .returning(ML.mortgage_id),
+        execution_options={"synchronize_session": False}
+        ).scalars().all()
+    CRUD.db_commit()
+    return released
+
+
+def release_expired_reservations(batch_size: int = RESERVATION_RELEASE_BATCH) -> List[str]:
+    """
+    Releases the expired reservations batch by batch. An entry leaves the ledger only
+    after its leads are committed back, so a failed run is picked up by the next one.
+    """
+    released = []
+    while True:
+        expired = redis_obj.zrangebyscore(RESERVATION_LEDGER_KEY, "-inf", time.time(), start=0, num=batch_size)
+        if not expired:
+            break
+        released.extend(release_reserved_leads(expired))
+        redis_obj.zrem(RESERVATION_LEDGER_KEY, *expired)
+        if len(expired) < batch_size:
+            break
+    print(f"release_expired_reservations released {len(released)} leads")
+    return released
+
+
+def reservation_ledger_metrics() -> Dict:
+    now = time.time()
+    oldest = redis_obj.zrange(RESERVATION_LEDGER_KEY, 0, 0, withscores=True)
+    return {
+        "active_reservations": redis_obj.zcount(RESERVATION_LEDGER_KEY, now, "+inf"),
+        "expired_pending_release": redis_obj.zcount(RESERVATION_LEDGER_KEY, "-inf", now),
+        "oldest_reservation_age_seconds": (
+            round(now - (oldest[0][1] - RESERVATION_SECONDS)) if oldest else 0
+            ),
+        }
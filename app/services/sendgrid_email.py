@@ -1,139 +1,267 @@
+import json
+import time
+import hashlib
 from uuid import uuid4
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from app.models import SendgridLog
 from app.services.crud import CRUD
 from app.services.custom_errors import *
-from app import db
+from app import db, redis_obj
 from config import Config_is
 from flask import g
 
 
+SENDGRID_OUTBOX_KEY = "sendgrid_outbox"
+# {processing list: claimed at}, the batch of a flush stays there until it is delivered
+SENDGRID_PROCESSING_KEY = "sendgrid_outbox_processing"
+SENDGRID_PROCESSING_TIMEOUT = 600  # seconds before the batch of a crashed flush is queued again
+SENDGRID_FLUSH_BATCH = 2000  # queued messages per flush
+SENDGRID_MAX_ATTEMPTS = 5
+SENDGRID_MAX_RECIPIENTS = 1000  # personalizations and recipients per mail/send request
+SENDGRID_TIMEOUT = (5, 30)
+SENDGRID_RETRY = Retry(
+    total=4, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"POST"}), respect_retry_after_header=True, raise_on_status=False
+    )
+
+_sendgrid_session = None
+
+
+def sendgrid_session() -> requests.Session:
+    """
+    Keep-alive session of the process, shared by every request to SendGrid
+    """
+    global _sendgrid_session
+    if _sendgrid_session is None:
+        session = requests.Session()
+        session.mount(Config_is.SENDGRID_API_URL, HTTPAdapter(pool_maxsize=10, max_retries=SENDGRID_RETRY))
+        session.headers.update({
+            "Authorization": f"Bearer {Config_is.SENDGRID_API_KEY}",
+            "Content-Type": "application/json"
+            })
+        _sendgrid_session = session
+    return _sendgrid_session
+
+
+def post_to_sendgrid(data: Dict) -> Optional[str]:
+    """
+    Returns the error of a failed request, None once SendGrid accepted it
+    """
+    try:
+        response = sendgrid_session().post(Config_is.SENDGRID_API_URL, json=data, timeout=SENDGRID_TIMEOUT)
+    except Exception as e:
+        print(f"sendgrid exception {e}")
+        return f"Exception {e}"
+    print(f"sendgrid {response.status_code}")
+    if response.status_code in [200, 202]:
+        return None
+    return f"Status {response.status_code} {response.text[:500]}"
+
+
+def _content_key(message: Dict) -> str:
+    return hashlib.sha256(
+        json.dumps([message["html"], message.get("attachments")], sort_keys=True).encode()
+        ).hexdigest()
+
+
+def deliver_email_messages(messages: List[Dict]) -> List[Dict]:
+    """
+    Sends the messages with the same content in shared requests, a personalization per queued
+    recipient group carrying its own subject, and stores all their logs with one commit.
+    Returns the messages SendGrid did not accept.
+    """
+    groups = {}
+    for message in messages:
+        groups.setdefault(_content_key(message), []).append(message)
+    logs, failed = [], []
+    for group in groups.values():
+        chunk, recipients = [], 0
+        chunks = [chunk]
+        for message in group:
+            size = sum(len(personalization["to"]) for personalization in message["personalizations"])
+            if chunk and (recipients + size > SENDGRID_MAX_RECIPIENTS
+                          or len(chunk) + len(message["personalizations"]) > SENDGRID_MAX_RECIPIENTS):
+                chunk, recipients = [], 0
+                chunks.append(chunk)
+            chunk.append(message)
+            recipients += size
+        for chunk in chunks:
+            data = {
+                "personalizations": [
+                    personalization | {"subject": message["subject"]}
+                    for message in chunk for personalization in message["personalizations"]
+                    ],
+                "from": {"email": Config_is.SENDGRID_EMAIL_ADDRESS},
+                "subject": chunk[0]["subject"],
+                "content": [
+                    {
+                        "type": "text/html",
+                        "value": chunk[0]["html"]
+                    }
+                    ]
+                }
+            if chunk[0].get("attachments"):
+                data["attachments"] = chunk[0]["attachments"]
+            error = post_to_sendgrid(data)
+            if error:
+                failed.extend(chunk)
+            logs.extend(
+                SendgridLog(id=log["id"], event=log["event"], user_id=log["user_id"], error=error)
+                for message in chunk for log in message.get("logs", [])
+                )
+    if logs:
+        # the mails are out at this point, a failed log write must not send them again
+        try:
+            db.session.bulk_save_objects(logs)
+            CRUD.db_commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"sendgrid logs {len(logs)} {e}")
+    return failed
+
+
+def requeue_stale_email_batches() -> int:
+    """
+    Puts the batches of the flushes that died before finishing back in front of the outbox
+    """
+    requeued = 0
+    for key in redis_obj.zrangebyscore(SENDGRID_PROCESSING_KEY, "-inf", time.time() - SENDGRID_PROCESSING_TIMEOUT):
+        while redis_obj.lmove(key, SENDGRID_OUTBOX_KEY, "RIGHT", "LEFT") is not None:
+            requeued += 1
+        redis_obj.zrem(SENDGRID_PROCESSING_KEY, key)
+    if requeued:
+        print(f"requeue_stale_email_batches messages {requeued}")
+    return requeued
+
+
+def _claim_email_batch(batch_size: int) -> Tuple[str, List[Dict]]:
+    """
+    Moves the next batch into a processing list of this flush, it leaves redis only once delivered
+    """
+    key = f"{SENDGRID_OUTBOX_KEY}:processing:{uuid4().hex}"
+    redis_obj.zadd(SENDGRID_PROCESSING_KEY, {key: time.time()})
+    pipeline = redis_obj.pipeline()
+    for _ in range(batch_size):
+        pipeline.lmove(SENDGRID_OUTBOX_KEY, key, "LEFT", "RIGHT")
+    return key, [json.loads(message) for message in pipeline.execute() if message is not None]
+
+
+def _finish_email_batch(key: str, failed: List[Dict]) -> int:
+    """
+    Queues the failed messages again with their attempt counted and drops the processing list
+    together, returns the messages given up on
+    """
+    retry, dropped = [], 0
+    for message in failed:
+        message["attempts"] = message.get("attempts", 0) + 1
+        if message["attempts"] < SENDGRID_MAX_ATTEMPTS:
+            # the failed attempt is logged already, the next one gets log rows of its own,
+            # the webhook events find them by the unique_id the personalization carries
+            renewed = {}
+            for log in message.get("logs", []):
+                renewed[log["id"]] = str(uuid4())
+                log["id"] = renewed[log["id"]]
+            for personalization in message["personalizations"]:
+                custom_args = personalization.get("custom_args", {})
+                if custom_args.get("unique_id") in renewed:
+                    custom_args["unique_id"] = renewed[custom_args["unique_id"]]
+            retry.append(json.dumps(message))
+        else:
+            dropped += 1
+            print(f"sendgrid gave up after {message['attempts']} attempts {message['subject']}")
+    pipeline = redis_obj.pipeline()
+    if retry:
+        pipeline.rpush(SENDGRID_OUTBOX_KEY, *retry)
+    pipeline.delete(key)
+    pipeline.zrem(SENDGRID_PROCESSING_KEY, key)
+    pipeline.execute()
+    return dropped
+
+
+def flush_email_outbox(batch_size: int = SENDGRID_FLUSH_BATCH) -> int:
+    """
+    Delivers the queued messages until the outbox is empty or SendGrid fails, the failed ones
+    wait for the next flush. Returns how many were sent.
+    """
+    requeue_stale_email_batches()
+    sent = 0
+    while True:
+        key, messages = _claim_email_batch(batch_size)
+        if not messages:
+            redis_obj.zrem(SENDGRID_PROCESSING_KEY, key)
+            break
+        failed = deliver_email_messages(messages)
+        dropped = _finish_email_batch(key, failed)
+        sent += len(messages) - len(failed)
+        print(f"flush_email_outbox messages {len(messages)} failed {len(failed)} dropped {dropped}")
+        if failed or len(messages) < batch_size:
+            break
+    return sent
+
+
 class SendgridEmailSending:
-    def __init__(self, to_emails: List, 
-                 subject: str, html_content: str, 
+    """
+    The messages are queued for the flush_email_outbox task and sent directly without redis,
+    so True means queued.
+    """
+    def __init__(self, to_emails: List,
+                 subject: str, html_content: str,
                  event: int = None):
         self.to_emails = to_emails
         self.subject = subject
         self.html_content = html_content
         self.event =  event
-        self.headers = {
-            "Authorization": f"Bearer {Config_is.SENDGRID_API_KEY}",
-            "Content-Type": "application/json"
+
+    def _message(self, personalizations: List[Dict], logs: List[Dict] = None,
+                 attachments: List[Dict] = None) -> Dict:
+        return {
+            "personalizations": personalizations,
+            "subject": self.subject,
+            "html": self.html_content,
+            "attachments": attachments,
+            "logs": logs or []
             }
-    
-    def send_email_handle_log(self, data: Dict, bulk_insert_log: List):
+
+    def queue_message(self, message: Dict) -> bool:
         try:
-            response = requests.post(
-                "https://api.sendgrid.com/v3/mail/send", 
-                headers=self.headers, json=data
-                )
-            print(f"sendgrid {response.status_code}")
-            if response.status_code in [200, 202]:
-                db.session.bulk_save_objects(bulk_insert_log)
-                CRUD.db_commit()
-                return True
+            redis_obj.rpush(SENDGRID_OUTBOX_KEY, json.dumps(message))
+            return True
         except Exception as e:
-            print(f" handle error {e}")
-            for log_obj in bulk_insert_log:
-                log_obj.error =  f"Exception {e}"
-                db.session.add(log_obj)
-            CRUD.db_commit()
-            return False
-        print('no exception but not 200')
-        for log_obj in bulk_insert_log:
-            log_obj.error =  f"Exception {e}"
-            db.session.add(log_obj)
-        CRUD.db_commit()
-        return False
-    
+            print(f"sendgrid queue {e}")
+        return not deliver_email_messages([message])
+
     def send_email(self) -> bool:
-        to_emails_structure, bulk_insert_log = [], []
+        to_emails_structure, logs = [], []
         for user_data in self.to_emails:
-            unique_id = uuid4()
+            unique_id = str(uuid4())
             to_emails_structure.append(
                 {
-                    "to": [{"email": user_data.pop('email')}],
-                    "custom_args": {"unique_id": str(unique_id)}
+                    "to": [{"email": user_data['email']}],
+                    "custom_args": {"unique_id": unique_id}
                 })
-            bulk_insert_log.append(SendgridLog(id=unique_id, event=self.event, user_id=user_data['user_id']))
-        data = {
-            "personalizations": to_emails_structure,
-            "from": {"email": Config_is.SENDGRID_EMAIL_ADDRESS},
-            "subject": self.subject,
-            "content": [
-                {
-                    "type": "text/html",
-                    "value": self.html_content
-                }
-                ]
-            }
-        return self.send_email_handle_log(data, bulk_insert_log)
-        
+            logs.append({"id": unique_id, "event": self.event, "user_id": str(user_data['user_id'])})
+        return self.queue_message(self._message(to_emails_structure, logs))
+
     def send_email_without_logs(self) -> bool:
         print('send_email_without_logs')
-        try:
-            data = {
-                "personalizations": [
-                     {
-                         "to": [{"email": email_address} for  email_address in self.to_emails]
-                    }
-                    ],
-            "from": {"email": Config_is.SENDGRID_EMAIL_ADDRESS},
-            "subject": self.subject,
-            "content": [
-                {
-                    "type": "text/html",
-                    "value": self.html_content
-                }
-                ]
-            }
-            response = requests.post(
-                "https://api.sendgrid.com/v3/mail/send", 
-                headers=self.headers, json=data
-                )
-            if response.status_code in [200, 202]:
-                print(response.status_code)
-                return True
-            print(response.status_code)
-        except Exception as e:
-            print(f'Exception sendgrid {e}')
-        return False
+        return self.queue_message(self._message(
+            [{"to": [{"email": email_address} for email_address in self.to_emails]}]
+            ))
 
     def send_email_with_attachments(self, attachments: List[Dict]) -> bool:
-            data = {
-                "personalizations": [
-                    {
-                    "to": [{"email": email_address} for email_address in self.to_emails]
-                    }
-                ],
-                "from": {"email": Config_is.SENDGRID_EMAIL_ADDRESS},
-                "subject": self.subject,
-                "content": [
-                    {
-                        "type": "text/html",
-                        "value": self.html_content
-                    }
-                ],
-                "attachments": [
-                    {
-                        "content": attachment['encoded_file'],
-                        "filename": attachment['name'],
-                        "type": attachment['type'],
-                        "disposition": "attachment"
-                    } for attachment in attachments
+        return self.queue_message(self._message(
+            [{"to": [{"email": email_address} for email_address in self.to_emails]}],
+            attachments=[
+                {
+                    "content": attachment['encoded_file'],
+                    "filename": attachment['name'],
+                    "type": attachment['type'],
+                    "disposition": "attachment"
+                } for attachment in attachments
                 ]
-            }
-            try:
-                response = requests.post(
-                    "https://api.sendgrid.com/v3/mail/send", 
-                    headers=self.headers, json=data
-            )
-                if response.status_code in [200, 202]:
-                    return True
-                print(response.status_code)
-            except Exception as e:
-                print(f'Exception sendgrid {e}')
-            return False
+            ))
@@ -1,12 +1,12 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 from datetime import (datetime, timedelta)
-from typing import (Dict, List)
+from typing import (Dict, List, Optional, Tuple)
 from uuid import uuid4
 import queue
 
 
 from flask import (g, render_template)
-from sqlalchemy import (func, or_)
+from sqlalchemy import (func, or_, select, update)
 
 from app import app, db
 from app.models import (
@@ -20,8 +20,16 @@ from app.models import (
 )
 from app.services.sendgrid_email import SendgridEmailSending
 from app.services.crud import CRUD
+from app.services.reservation_ledger import (
+    add_reservations,
+    remove_reservations
+    )
+from app.services.marketplace_inventory import (
+    available_inventory,
+    inventory_month_bucket
+    )
 from app.services.custom_errors import (
-    InternalError, NoContent, BadRequest
+    NoContent, BadRequest
     )
 from app.services.utils import (
     add_redis_ttl_data,
@@ -75,128 +83,78 @@ def add_to_cart(data: Dict) -> bool:
     return True
 
 
-def get_mailing_leads_stock_availability(user_id: str, data: Dict, today_is: datetime, agent_ids: List, thread_response) -> Dict:
-        with app.app_context():
-            print('get_mailing_leads_stock_availability main context')
-            month_info = PRICING_DETAIL_MONTH.get(data['month'])
-            less_than = today_is - timedelta(days=month_info['start_day'])
-            greater_than = today_is - timedelta(days=month_info['end_day'])
-            print('greater')
-            lead_query = (
-                ML.query
-                .join(MR, ML.mortgage_id == MR.mortgage_id)
-                .join(MA, ML.mortgage_id == MA.mortgage_id)
-                .filter(
-                    MR.call_in_date_time >= greater_than,
-                    MR.call_in_date_time < less_than,
-                    ML.state == data['state'], 
-                    MR.completed== data['completed'],
-                    ~ML.lead_assigned_members.any(MA.agent_id.in_(agent_ids)), 
-                    or_(
-                        ML.last_purchased_date == None,
-                        ML.last_purchased_date < (today_is - timedelta(days=30)).date()
-                    ),
-                    ML.disabled_in_marketplace == False, 
-                    ML.can_sale == True,
-                    ML.source_id == data['source'],
-                    or_(ML.item_reserved_temp_by == user_id, ML.is_in_checkout == False)
-                    )
-                )
-            try:
-                with db.session.begin():
-                    thread_response.put({data['id']: {'stock': lead_query.distinct(ML.mortgage_id).count()}})
-            except Exception as e:
-                print(f"exceeded the limited quantity: {e}")
-                thread_response.put({data['id']: {'stock': 0}})
-                db.session.close()
-        return True
-
-
 def verify_stock_in_cart(cart_items: List) -> Dict:
-    result,thread_response = {}, queue.Queue()
-    thread_count = 0
+    """
+    Stock of every mailing cart line from a single inventory lookup
+    """
     print(cart_items)
-    with ThreadPoolExecutor(max_workers=5) as executor: 
-        for sc in cart_items:
-            print(sc)
-            if sc.get('category_id') == 1:
-                executor.submit(
-                    get_mailing_leads_stock_availability, 
-                    g.user['id'], sc, 
-                    datetime.utcnow(),
-                    g.user['mailing_agent_ids'], 
-                    thread_response
-                )
-                thread_count += 1
-    print(f"Thread count {thread_count}")
-    for _ in range(thread_count):
-        try:
-            res = thread_response.get(timeout=10)
-            result.update(res)
-        except queue.Empty:
-            print('empty queue')
-    if len(result) == thread_count:
-        return result
-    print(f"failed {thread_count} {result}")
-    raise InternalError()
+    mailing_items = [sc for sc in cart_items if sc.get('category_id') == 1]
+    if not mailing_items:
+        return {}
+    inventory = available_inventory(
+        g.user['mailing_agent_ids'], 
+        {sc['state'] for sc in mailing_items}, 
+        reserved_by=g.user['id']
+        )
+    today_date = datetime.utcnow().date()
+    stock = defaultdict(int)
+    for (state, source_id, completed, call_date), count in inventory.items():
+        stock[(state, source_id, completed, inventory_month_bucket((today_date - call_date).days))] += count
+    return {
+        sc['id']: {'stock': stock[(sc['state'], sc['source'], sc['completed'], sc['month'])]} 
+        for sc in mailing_items
+        }
 
 
-def reserving_mailing_for_checkout(
-    today_is: datetime, user_id: str, 
-    agent_ids: List, cart_item: Dict, 
-    thread_response: queue) -> bool:
-    try:
-        print(f"reserving_mailing_for_checkout")
-        with app.app_context():
-            unique_id = str(uuid4())
-            month_info = PRICING_DETAIL_MONTH.get(cart_item['month'])
-            less_than = today_is - timedelta(days=month_info['start_day'])
-            greater_than = today_is - timedelta(days=month_info['end_day'])
-            leads_obj = (
-                ML.query
-                .join(MR, ML.mortgage_id == MR.mortgage_id)
-                .filter(
-                    MR.call_in_date_time >= greater_than,
-                    MR.call_in_date_time < less_than,
-                    ~ML.lead_assigned_members.any(MA.agent_id.in_(agent_ids)),
-                    or_(
-                        ML.last_purchased_date == None,
-                        ML.last_purchased_date < (today_is - timedelta(days=30)).date()
-                        ),
-                    ML.state == cart_item['state'],
-                    MR.completed== cart_item['completed'],
-                    ML.disabled_in_marketplace == False,
-                    ML.can_sale == True,
-                    ML.source_id == cart_item['source'],
-                    or_(
-                        ML.item_reserved_temp_by == user_id, 
-                        ML.is_in_checkout == False
-                        )
-                    )
-                    .with_entities(ML.mortgage_id)
-                    .limit(cart_item['quantity'])
+def reserving_mailing_for_checkout(today_is: datetime, user_id: str, agent_ids: List, cart_item: Dict) -> Tuple[Optional[str], List[str]]:
+    """
+    Claims the quantity of a cart item in one statement, rows locked by a concurrent
+    checkout are skipped instead of being sold twice. Runs in the caller's transaction.
+    """
+    unique_id = str(uuid4())
+    month_info = PRICING_DETAIL_MONTH.get(cart_item['month'])
+    less_than = today_is - timedelta(days=month_info['start_day'])
+    greater_than = today_is - timedelta(days=month_info['end_day'])
+    candidates = (
+        select(ML.mortgage_id)
+        .join(MR, ML.mortgage_id == MR.mortgage_id)
+        .where(
+            MR.call_in_date_time >= greater_than,
+            MR.call_in_date_time < less_than,
+            ~ML.lead_assigned_members.any(MA.agent_id.in_(agent_ids)),
+            or_(
+                ML.last_purchased_date == None,
+                ML.last_purchased_date < (today_is - timedelta(days=30)).date()
+                ),
+            ML.state == cart_item['state'],
+            MR.completed== cart_item['completed'],
+            ML.disabled_in_marketplace == False,
+            ML.can_sale == True,
+            ML.source_id == cart_item['source'],
+            or_(
+                ML.item_reserved_temp_by == user_id, 
+                ML.is_in_checkout == False
+                )
             )
-            # print(f"Leads count--> {leads_obj.count()}")
-            valid_ids = [ld.mortgage_id for ld in leads_obj]
-            print(f" reserving_mailing_for_checkout valid_ids {valid_ids}")
-            if len(valid_ids) == cart_item['quantity']:
-                ML.query.filter(ML.mortgage_id.in_(valid_ids)).update(dict(is_in_checkout = True, shopping_cart_temp_id = unique_id, item_reserved_temp_by = user_id, modified_at = ML.modified_at))
-                add_redis_ttl_data(key=f"reserve_cart_{cart_item['pricing_id']}_{unique_id}", hours=0.28, data=str(cart_item['id']))
-                CRUD.db_commit()
-                thread_response.put((str(cart_item['id']), unique_id))
-                print(f'Successfully reserved leads for cart {cart_item["id"]}')
-            else:
-                print(f'*****failed to reserve enough leads for {cart_item}')
-                thread_response.put(False)
-    except Exception as e:
-        print(f"Exception in reserving_mailing_for_checkout: {e}")
-        thread_response.put(False)
-    return True
+        .limit(cart_item['quantity'])
+        .with_for_update(of=ML, skip_locked=True)
+        )
+    reserved = db.session.execute(
+        update(ML)
+        .where(ML.mortgage_id.in_(candidates.scalar_subquery()))
+        .values(is_in_checkout=True, shopping_cart_temp_id=unique_id, item_reserved_temp_by=user_id, modified_at=ML.modified_at)
+        .returning(ML.mortgage_id),
+        execution_options={"synchronize_session": False}
+        ).scalars().all()
+    print(f"reserving_mailing_for_checkout {cart_item['id']} reserved {len(reserved)}/{cart_item['quantity']}")
+    if len(reserved) != cart_item['quantity']:
+        return None, []
+    return unique_id, reserved
 
 
 def reserve_the_leads(cart_ids: List[str]) -> List[Dict]:
     print(f"reserve_the_leads cart_ids {cart_ids}")
-    result, thread_response = {}, queue.Queue()
+    result, reserved_ids = {}, []
     carts_obj = (
         SC.query.join(PD, PD.id == SC.pricing_id)
         .filter(
@@ -210,35 +168,32 @@ def reserve_the_leads(cart_ids: List[str]) -> List[Dict]:
             )
         )
     print(f"carts_obj -{carts_obj}")
-    thread_count = 0
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    today_is = datetime.utcnow()
+    try:
+        # All the cart items are reserved in a single transaction, either every item gets its leads or none
         for cart in carts_obj.all():
-            if cart.category == 1 and cart.month != 0:
-                result[str(cart.id)] = {'pricing_id': str(cart.pricing_id)}
-                executor.submit(
-                    reserving_mailing_for_checkout,
-                    datetime.utcnow(),
-                    g.user['id'], 
-                    g.user['mailing_agent_ids'],
-                    cart._asdict(),
-                    thread_response
-                )
-                thread_count += 1
-    for _ in range(thread_count):
-        try:
-            temp_cart_info = thread_response.get(timeout=10)
-            if temp_cart_info:
-                result[temp_cart_info[0]] |= {'id': temp_cart_info[0], 'shopping_cart_temp_id': temp_cart_info[1]}
-        except queue.Empty:
-            print("reserce leads Queue get timed out in this iteration.")
-            continue
-    if len(result) != thread_count:
-        db.session.rollback()
-        ML.query.filter(ML.is_in_checkout == True, ML.shopping_cart_temp_id.in_(list(result.keys())), ML.item_reserved_temp_by == g.user['id']).delete()
+            if cart.category != 1 or cart.month == 0:
+                continue
+            unique_id, reserved = reserving_mailing_for_checkout(
+                today_is, g.user['id'], g.user['mailing_agent_ids'], cart._asdict())
+            if not unique_id:
+                print(f'*****failed to reserve enough leads for {cart}')
+                raise BadRequest("Sorry leads are unable to reserve now please try again")
+            result[str(cart.id)] = {
+                'pricing_id': str(cart.pricing_id), 'id': str(cart.id), 'shopping_cart_temp_id': unique_id}
+            reserved_ids.extend(reserved)
         CRUD.db_commit()
-        # tasks.clear_expired_reserved_leads.apply_async(args=(list(result.keys()), ))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Exception in reserve_the_leads: {e}")
+        if isinstance(e, BadRequest):
+            raise
         raise BadRequest("Sorry leads are unable to reserve now please try again")
-    tasks.clear_expired_reserved_leads.apply_async(args=(list(result.keys()), ), countdown=1020)
+    for item in result.values():
+        add_redis_ttl_data(key=f"reserve_cart_{item['pricing_id']}_{item['shopping_cart_temp_id']}", hours=0.28, data=item['id'])
+    add_reservations([item['shopping_cart_temp_id'] for item in result.values()])
+    if reserved_ids:
+        tasks.refresh_marketplace_inventory.delay(reserved_ids)
     print(f"result is {result}")
     return list(result.values())
 
@@ -282,6 +237,8 @@ def assigning_reserved_mailing_leads(user: Dict, campaign_name: str, cart_item:
                 SC.query.filter(SC.id == cart_item['id']).update({'is_active': False, 'order_id': order_id})
                 db.session.bulk_save_objects(assigned_leads)
                 CRUD.db_commit()
+                remove_reservations([cart_id_with_temp_id])
+                tasks.refresh_marketplace_inventory.delay(mortgage_ids)
                 thread_response.put(True)
             except Exception as e:
                 import traceback
@@ -0,0 +1,114 @@
+"""Outbound SMS over a per worker Twilio client, rate limited per sender number."""
+import json
+import time
+import random
+import logging
+from uuid import uuid4
+from typing import Dict, List, Optional
+
+from urllib3.util.retry import Retry
+from twilio.rest import Client
+from twilio.http import HttpClient
+from twilio.http.http_client import TwilioHttpClient
+from twilio.http.response import Response
+
+from app import db, redis_obj
+from app.models import SmsLog
+from app.services.crud import CRUD
+from config import Config_is
+
+
+SMS_RATE_PER_SECOND = 1  # per sender, long code carrier throughput
+SMS_BATCH_SIZE = 50  # messages per dispatch task
+SMS_RETRY = Retry(
+    total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"POST"}), respect_retry_after_header=True, raise_on_status=False
+    )
+
+_twilio_client = None
+
+
+class FakeTwilioHttpClient(HttpClient):
+    """
+    Accepts every message without calling Twilio, the created messages are kept in sent
+    """
+    def __init__(self):
+        super().__init__(logging.getLogger(__name__), False)
+        self.sent = []
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None,
+                timeout=None, allow_redirects=False):
+        message = dict(data or {}) | {"sid": f"SM{uuid4().hex}", "status": "queued"}
+        self.sent.append(message)
+        return Response(201, json.dumps({
+            "sid": message["sid"], "status": "queued", "to": message.get("To"),
+            "from": message.get("From"), "body": message.get("Body")
+            }))
+
+
+def twilio_client() -> Client:
+    """
+    Client of the process, the pooled http client keeps the connections to Twilio alive
+    """
+    global _twilio_client
+    if _twilio_client is None:
+        if Config_is.TWILIO_FAKE_TRANSPORT:
+            http_client = FakeTwilioHttpClient()
+        else:
+            http_client = TwilioHttpClient(pool_connections=True, timeout=30, max_retries=SMS_RETRY)
+        _twilio_client = Client(Config_is.TWILIO_SID, Config_is.TWILIO_TOKEN, http_client=http_client)
+    return _twilio_client
+
+
+def acquire_sender(from_numbers: List[str]) -> str:
+    """
+    Sender number with room in the current second, waits for the next second when all are busy
+    """
+    if redis_obj is None:
+        return random.choice(from_numbers)
+    while True:
+        now = time.time()
+        for number in random.sample(from_numbers, len(from_numbers)):
+            key = f"sms_rate:{number}:{int(now)}"
+            pipeline = redis_obj.pipeline()
+            pipeline.incr(key)
+            pipeline.expire(key, 2)
+            if pipeline.execute()[0] <= SMS_RATE_PER_SECOND:
+                return number
+        time.sleep(int(now) + 1 - now)
+
+
+def send_sms_batch(messages: List[Dict], from_numbers: Optional[List[str]] = None) -> int:
+    """
+    messages: [{"to", "body", "event"}], the outcomes are stored with one commit.
+    Returns the number of messages Twilio accepted.
+    """
+    from_numbers = from_numbers or Config_is.TWILIO_SMS_NUMBERS
+    client, logs, sent = twilio_client(), [], 0
+    for message in messages:
+        sender = acquire_sender(from_numbers)
+        log = SmsLog(id=uuid4(), to_number=message["to"], from_number=sender, event=message.get("event"))
+        try:
+            created = client.messages.create(body=message["body"], from_=sender, to=message["to"])
+            log.sid, log.status = created.sid, created.status
+            sent += 1
+        except Exception as e:
+            print(f"send_sms_batch {message['to']} {e}")
+            log.status, log.error = "failed", f"Exception {e}"
+        logs.append(log)
+    if logs:
+        db.session.bulk_save_objects(logs)
+        CRUD.db_commit()
+    print(f"send_sms_batch sent {sent} of {len(messages)}")
+    return sent
+
+
+def dispatch_sms(messages: List[Dict], from_numbers: Optional[List[str]] = None) -> int:
+    """
+    Fans a recipient list out to send_sms_batch tasks, returns the number of tasks
+    """
+    from app import tasks
+    batches = [messages[i:i + SMS_BATCH_SIZE] for i in range(0, len(messages), SMS_BATCH_SIZE)]
+    for batch in batches:
+        tasks.send_sms_batch.delay(batch, from_numbers)
+    return len(batches)
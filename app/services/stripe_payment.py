@@ -11,7 +11,6 @@ from datetime import (
 from threading import Thread
 from random import randrange
 from time import sleep
-from concurrent.futures import ThreadPoolExecutor
 
 
 import stripe
@@ -30,6 +29,7 @@ from app.models import (
     PricingDetail as PD, UserPromotionCodeHistory as UPCH
     )
 from app.services.crud import CRUD
+from app.services.db_pool import run_fanout
 from app.services.utils import (
     add_redis_ttl_data,
     convert_datetime_to_timezone_date,
@@ -164,20 +164,21 @@ def payment_status_update_direct_checkout(payload: Dict):
             SC.pricing_id, PD.completed, PD.unit_price
             )
         )
-    with ThreadPoolExecutor(max_workers=5) as executor: 
-        for cart_obj in carts_obj.all():
-            cart_item = cart_obj._asdict()
-            cart_items.append(cart_item) 
-            executor.submit(
-                    assigning_reserved_mailing_leads, 
-                    user_info, 
-                    campaign_name,
-                    cart_item,
-                    cart_id_with_temp_id[str(cart_obj.id)],
-                    order_id, 
-                    today_is,
-                    thread_response
-                    )
+    assigning_calls = []
+    for cart_obj in carts_obj.all():
+        cart_item = cart_obj._asdict()
+        cart_items.append(cart_item)
+        assigning_calls.append((
+            assigning_reserved_mailing_leads,
+            user_info,
+            campaign_name,
+            cart_item,
+            cart_id_with_temp_id[str(cart_obj.id)],
+            order_id,
+            today_is,
+            thread_response
+            ))
+    run_fanout(assigning_calls)
 
     order_obj = MOS.query.filter(
         MOS.user_id == user_info['id'], 
@@ -188,10 +189,11 @@ def payment_status_update_direct_checkout(payload: Dict):
             MOS.user_id == user_info['id'], 
             MOS.id == order_id
         ).first()
-    invoice_data = order_obj.invoice_data
     if data.get("charges"):
         charge = data["charges"]["data"][0]
         card = charge["payment_method_details"]["card"]
+        # a new dict, the change of a mutated JSONB value is not detected
+        invoice_data = dict(order_obj.invoice_data or {})
         invoice_data["payment_details"] = {
             "method": charge["payment_method_details"]["type"],
             "card_brand": card["brand"],
@@ -202,7 +204,7 @@ def payment_status_update_direct_checkout(payload: Dict):
     order_obj.stripe_payment_id = data['id']
     order_obj.amount_received = data['amount_received'] / 100
     order_obj.payment_status = data['status']
-    print(invoice_data)
+    print(order_obj.invoice_data)
     CRUD.db_commit()
     failed_thread = 0
     for _ in range(len(cart_id_with_temp_id)):
@@ -0,0 +1,196 @@
+"""Month partitions of the call and status log tables: created ahead, split out of the default one, dropped once archived."""
+import re
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from app import db
+from app.models import MailingLeadMemberStatusLog as MLMSL, MailingResponse as MR
+from app.services.crud import CRUD
+from config import Config_is
+
+
+# {table: (partition key, months always kept)}, the marketplace sells calls up to 730 days old
+PARTITIONED_TABLES = {
+    "mailing_response": ("call_in_date_time", 26),
+    "mailing_lead_member_status_log": ("created_at", 26),
+}
+PARTITION_MONTHS_AHEAD = 3
+PARTITIONED_MODELS = {"mailing_response": MR, "mailing_lead_member_status_log": MLMSL}
+# Value a row without partition key gets on conversion. created_at is UTC, the calls are
+# stored in Config_is.TIME_ZONE the way the IVR webhooks write them.
+PARTITION_KEY_BACKFILL = {
+    "mailing_response": "COALESCE(created_at, modified_at) AT TIME ZONE 'UTC' AT TIME ZONE :time_zone",
+    "mailing_lead_member_status_log": "modified_at",
+}
+UNPARTITIONED_SUFFIX = "_unpartitioned"
+
+TABLE_KIND = text("""
+    SELECT relkind FROM pg_class WHERE relname = :table AND pg_table_is_visible(oid)
+    """)
+LIST_INDEXES = text("""
+    SELECT index.relname FROM pg_index
+    JOIN pg_class index ON index.oid = pg_index.indexrelid
+    JOIN pg_class tbl ON tbl.oid = pg_index.indrelid
+    WHERE tbl.relname = :table AND pg_table_is_visible(tbl.oid)
+    """)
+LIST_COLUMNS = text("""
+    SELECT column_name FROM information_schema.columns
+    WHERE table_name = :table AND table_schema = current_schema()
+    """)
+LIST_PARTITIONS = text("""
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    WHERE parent.relname = :table
+    """)
+
+
+def is_partitioned(table: str) -> bool:
+    return db.session.execute(TABLE_KIND, {"table": table}).scalar() == "p"
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def attached_partition_months(table: str) -> List[date]:
+    pattern = re.compile(rf"^{table}_(\d{{4}})_(\d{{2}})$")
+    months = []
+    for (name,) in db.session.execute(LIST_PARTITIONS, {"table": table}):
+        match = pattern.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def create_month_partition(table: str, month: date) -> None:
+    """
+    Adds the partition of the month, its rows already in the default partition are moved into it
+    first so the attach does not fail on them. Runs in the caller's transaction.
+    """
+    key = PARTITIONED_TABLES[table][0]
+    name, end = partition_name(table, month), month + relativedelta(months=1)
+    db.session.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)"))
+    db.session.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {table}_default WHERE {key} >= :start AND {key} < :end RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """), {"start": month, "end": end})
+    # the attach creates the indexes of the parent on the new partition
+    db.session.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{end}')"))
+
+
+def ensure_partitions(table: str, first_month: date, last_month: date) -> List[str]:
+    attached = set(attached_partition_months(table))
+    created, month = [], first_month.replace(day=1)
+    while month <= last_month:
+        if month not in attached:
+            create_month_partition(table, month)
+            created.append(partition_name(table, month))
+        month += relativedelta(months=1)
+    return created
+
+
+def split_default_partition(table: str) -> List[str]:
+    """
+    Moves the rows of the default partition into month partitions, e.g. after the
+    table was converted and its history copied through the parent
+    """
+    key = PARTITIONED_TABLES[table][0]
+    oldest, newest = db.session.execute(text(f"SELECT min({key}), max({key}) FROM {table}_default")).first()
+    if oldest is None:
+        return []
+    return ensure_partitions(table, oldest.date(), newest.date())
+
+
+def drop_archived_partitions(table: str, today: date) -> List[str]:
+    """
+    Drops the months past the retention once they are empty. Rows only leave a month when
+    lead_archive has copied their lead to S3 and deleted it, a month still holding a row of
+    a live lead stays attached so the lead views, reports and the archive keep reading it.
+    """
+    oldest_kept = today.replace(day=1) - relativedelta(months=PARTITIONED_TABLES[table][1])
+    dropped = []
+    for month in attached_partition_months(table):
+        if month >= oldest_kept:
+            break
+        name = partition_name(table, month)
+        if db.session.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+            continue
+        db.session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+    return dropped
+
+
+def convert_to_partitioned(table: str, today: Optional[date] = None) -> Dict:
+    """
+    One time conversion of the plain table: the rows missing the partition key are backfilled,
+    a row still without one aborts the conversion. The partitioned table is created from the
+    model with the month partitions of the history and the months ahead, the rows are copied
+    into it and the tables swap names. Writes wait for the whole run, reads go on until the swap.
+    The old table stays as <table>_unpartitioned, to be dropped once the new one is checked.
+    Runs in the caller's transaction.
+    """
+    key = PARTITIONED_TABLES[table][0]
+    if is_partitioned(table):
+        return {"table": table, "converted": False}
+    old = f"{table}{UNPARTITIONED_SUFFIX}"
+    db.session.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+    backfilled = db.session.execute(
+        text(f"UPDATE {table} SET {key} = {PARTITION_KEY_BACKFILL[table]} WHERE {key} IS NULL"),
+        {"time_zone": Config_is.TIME_ZONE}).rowcount
+    missing = db.session.execute(text(f"SELECT count(*) FROM {table} WHERE {key} IS NULL")).scalar()
+    if missing:
+        raise ValueError(f"{table} has {missing} rows without {key} and nothing to backfill it from")
+    # index and sequence names are per schema, the old ones make room for the ones of the model
+    for (index,) in db.session.execute(LIST_INDEXES, {"table": table}).all():
+        db.session.execute(text(f"ALTER INDEX {index} RENAME TO {index[:63 - len(UNPARTITIONED_SUFFIX)]}{UNPARTITIONED_SUFFIX}"))
+    sequence = db.session.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}).scalar()
+    if sequence:
+        db.session.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {sequence.split('.')[-1][:50]}{UNPARTITIONED_SUFFIX}"))
+    db.session.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+    model_table = PARTITIONED_MODELS[table].__table__
+    model_table.create(bind=db.session.connection())
+    oldest, newest = db.session.execute(text(f"SELECT min({key}), max({key}) FROM {old}")).first()
+    today = today or datetime.utcnow().date()
+    ensure_partitions(
+        table, (oldest or datetime.utcnow()).date(), today.replace(day=1) + relativedelta(months=PARTITION_MONTHS_AHEAD))
+    old_columns = {column for (column,) in db.session.execute(LIST_COLUMNS, {"table": old})}
+    columns = [column for column in model_table.columns if column.name in old_columns]
+    dialect = postgresql.dialect()
+    copied = db.session.execute(text(
+        f"INSERT INTO {table} ({', '.join(column.name for column in columns)}) "
+        f"SELECT {', '.join(f'CAST({column.name} AS {column.type.compile(dialect=dialect)})' for column in columns)} FROM {old}"
+        )).rowcount
+    db.session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)"))
+    print(f"convert_to_partitioned {table} backfilled {backfilled} copied {copied}")
+    return {"table": table, "converted": True, "backfilled": backfilled, "copied": copied}
+
+
+def maintain_partitions(today: Optional[date] = None) -> Dict[str, Dict]:
+    """
+    Daily run, one transaction per table. A table not converted yet is left alone.
+    """
+    today = today or datetime.utcnow().date()
+    result = {}
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(table):
+            print(f"maintain_partitions {table} is not partitioned, run flask partition-tables first")
+            result[table] = {"skipped": True}
+            continue
+        created = split_default_partition(table)
+        created += ensure_partitions(
+            table, today.replace(day=1), today.replace(day=1) + relativedelta(months=PARTITION_MONTHS_AHEAD))
+        dropped = drop_archived_partitions(table, today)
+        CRUD.db_commit()
+        result[table] = {"created": created, "dropped": dropped}
+        print(f"maintain_partitions {table} created {created} dropped {dropped}")
+    return result
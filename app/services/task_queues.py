@@ -0,0 +1,85 @@
+"""Celery queues of the worker tier, their routes and their depth and latency metrics."""
+import time
+from typing import Dict, Optional
+
+from app import redis_obj
+
+
+IVR_REALTIME_QUEUE = "ivr-realtime"
+MARKETPLACE_QUEUE = "marketplace"
+NOTIFICATIONS_QUEUE = "notifications"
+MAINTENANCE_QUEUE = "maintenance"
+# uploads an admin waits on, kept apart from the long nightly maintenance tasks
+INGEST_QUEUE = "ingest"
+TASK_QUEUES = (IVR_REALTIME_QUEUE, MARKETPLACE_QUEUE, NOTIFICATIONS_QUEUE, MAINTENANCE_QUEUE, INGEST_QUEUE)
+
+TASK_ROUTES = {
+    'app.tasks.process_ivr_events': {'queue': IVR_REALTIME_QUEUE},
+    'app.tasks.clear_latest_ivr_temp_data': {'queue': IVR_REALTIME_QUEUE},
+    'app.tasks.latest_ivr_response_alert_to_agents': {'queue': IVR_REALTIME_QUEUE},
+    'app.tasks.clear_expired_reserved_leads': {'queue': MARKETPLACE_QUEUE},
+    'app.tasks.refresh_marketplace_inventory': {'queue': MARKETPLACE_QUEUE},
+    'app.tasks.flush_email_outbox': {'queue': NOTIFICATIONS_QUEUE},
+    'app.tasks.celery_twilio_sms': {'queue': NOTIFICATIONS_QUEUE},
+    'app.tasks.send_sms_batch': {'queue': NOTIFICATIONS_QUEUE},
+    'app.tasks.rebuild_marketplace_inventory': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.refresh_dashboard_rollup': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.rebuild_dashboard_rollup': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.refresh_report_summary': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.close_report_summary_day': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.rebuild_report_summary': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.maintain_table_partitions': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.archive_old_leads': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.warm_ivr_lookup': {'queue': MAINTENANCE_QUEUE},
+    'app.tasks.ingest_mailer_upload': {'queue': INGEST_QUEUE},
+}
+
+# Worker settings per queue, the Procfile starts one worker process type per queue with them
+WORKER_PROFILES = {
+    IVR_REALTIME_QUEUE: {'concurrency': 4, 'prefetch_multiplier': 4},
+    MARKETPLACE_QUEUE: {'concurrency': 2, 'prefetch_multiplier': 1},
+    NOTIFICATIONS_QUEUE: {'concurrency': 4, 'prefetch_multiplier': 1},
+    MAINTENANCE_QUEUE: {'concurrency': 1, 'prefetch_multiplier': 1},
+    INGEST_QUEUE: {'concurrency': 2, 'prefetch_multiplier': 1},
+}
+
+TASK_LATENCY_KEY = "celery_task_latency:{queue}"
+TASK_LATENCY_SAMPLES = 500
+
+
+def record_task_latency(queue: Optional[str], enqueued_at: Optional[float]) -> None:
+    """
+    Seconds the task waited in its queue before a worker started it
+    """
+    if not queue or not enqueued_at or redis_obj is None:
+        return
+    key = TASK_LATENCY_KEY.format(queue=queue)
+    try:
+        pipeline = redis_obj.pipeline(transaction=False)
+        pipeline.lpush(key, round(max(time.time() - float(enqueued_at), 0), 3))
+        pipeline.ltrim(key, 0, TASK_LATENCY_SAMPLES - 1)
+        pipeline.execute()
+    except Exception as e:
+        print(f"record_task_latency {queue} {e}")
+
+
+def task_queue_metrics() -> Dict:
+    """
+    Messages waiting and the wait of the last started tasks, per queue
+    """
+    pipeline = redis_obj.pipeline(transaction=False)
+    for queue in TASK_QUEUES:
+        pipeline.llen(queue)
+        pipeline.lrange(TASK_LATENCY_KEY.format(queue=queue), 0, -1)
+    results = pipeline.execute()
+    metrics = {}
+    for i, queue in enumerate(TASK_QUEUES):
+        samples = sorted(float(sample) for sample in results[2 * i + 1])
+        metrics[queue] = {
+            "depth": results[2 * i],
+            "latency_samples": len(samples),
+            "latency_p50_seconds": samples[len(samples) // 2] if samples else 0,
+            "latency_p95_seconds": samples[min(int(len(samples) * 0.95), len(samples) - 1)] if samples else 0,
+            "latency_max_seconds": samples[-1] if samples else 0,
+            } | WORKER_PROFILES[queue]
+    return metrics
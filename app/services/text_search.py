@@ -0,0 +1,29 @@
+"""Substring search over the pg_trgm GIN indexes, with a similarity rank of the matches."""
+from typing import List, Optional
+
+from sqlalchemy import func, or_
+
+
+TRGM_MIN_LENGTH = 3  # shorter terms have no trigram to look up, the planner falls back to a scan
+
+
+def _escape_like(term: str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def contains(columns: List, term: str):
+    """
+    Case insensitive substring match of term in any of the columns, served by their trigram indexes
+    """
+    pattern = f"%{_escape_like(term.strip())}%"
+    return or_(*[column.ilike(pattern, escape='\\') for column in columns])
+
+
+def similarity_rank(columns: List, term: Optional[str]):
+    """
+    Best trigram similarity of term over the columns, None when the term is too short to rank
+    """
+    term = (term or '').strip()
+    if len(term) < TRGM_MIN_LENGTH:
+        return None
+    return func.greatest(*[func.coalesce(func.similarity(column, term), 0) for column in columns])
@@ -0,0 +1,112 @@
+"""Per worker TTL LRU of verified auth token payloads, invalidated over redis pub/sub."""
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from app import redis_obj
+
+
+TOKEN_CACHE_SECONDS = 60
+TOKEN_CACHE_SIZE = 4096
+TOKEN_INVALIDATION_CHANNEL = "auth_token_invalidation"
+
+
+def token_hash(key_ends_with: str, token: str) -> str:
+    return hashlib.sha256(f"{key_ends_with}:{token}".encode()).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE, ttl: int = TOKEN_CACHE_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # token hash: (expires at, user id, payload)
+        self.user_tokens = {}  # user id: set of token hashes
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def get(self, key_ends_with: str, token: str) -> Optional[Dict]:
+        hashed = token_hash(key_ends_with, token)
+        with self.lock:
+            entry = self.entries.get(hashed)
+            if not entry:
+                return None
+            if entry[0] <= time.monotonic():
+                self._pop(hashed)
+                return None
+            self.entries.move_to_end(hashed)
+            return copy.deepcopy(entry[2])
+
+    def set(self, key_ends_with: str, token: str, payload: Dict, token_expires_at: float) -> None:
+        """
+        token_expires_at: epoch seconds of the token expiry, an entry never outlives its token
+        """
+        self.start_listener()
+        ttl = min(self.ttl, token_expires_at - time.time())
+        if ttl <= 0:
+            return
+        hashed = token_hash(key_ends_with, token)
+        user_id = str(payload.get('id'))
+        with self.lock:
+            self._pop(hashed)
+            self.entries[hashed] = (time.monotonic() + ttl, user_id, copy.deepcopy(payload))
+            self.user_tokens.setdefault(user_id, set()).add(hashed)
+            while len(self.entries) > self.maxsize:
+                self._pop(next(iter(self.entries)))
+
+    def evict(self, user_id: str, hashed: Optional[str] = None) -> None:
+        with self.lock:
+            for key in ([hashed] if hashed else list(self.user_tokens.get(user_id, ()))):
+                self._pop(key)
+
+    def _pop(self, hashed: str) -> None:
+        entry = self.entries.pop(hashed, None)
+        if entry:
+            tokens = self.user_tokens.get(entry[1])
+            if tokens is not None:
+                tokens.discard(hashed)
+                if not tokens:
+                    self.user_tokens.pop(entry[1], None)
+
+    def start_listener(self) -> None:
+        if self.listener or redis_obj is None:
+            return
+        with self.lock:
+            if self.listener:
+                return
+            self.listener = threading.Thread(target=self._listen, name="token-cache-invalidation", daemon=True)
+            self.listener.start()
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = redis_obj.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(TOKEN_INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    data = json.loads(message["data"])
+                    self.evict(data["user_id"], data.get("token"))
+            except Exception as e:
+                print(f"token cache invalidation listener {e}")
+                # Entries cached while disconnected could miss an invalidation
+                with self.lock:
+                    self.entries.clear()
+                    self.user_tokens.clear()
+                time.sleep(1)
+
+
+token_cache = TokenCache()
+
+
+def publish_token_invalidation(user_id: str, key_ends_with: Optional[str] = None, token: Optional[str] = None) -> None:
+    """
+    Evict a token, or every token of the user without one, from the cache of all the workers
+    """
+    message = {"user_id": str(user_id), "token": token_hash(key_ends_with, token) if token else None}
+    token_cache.evict(message["user_id"], message["token"])
+    try:
+        redis_obj.publish(TOKEN_INVALIDATION_CHANNEL, json.dumps(message))
+    except Exception as e:
+        print(f"publish_token_invalidation {user_id} {e}")
@@ -1,18 +1,20 @@
 """API Endpoints related to IVR calls and SMS."""
 import json
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List, Optional
 
-from sqlalchemy import or_
-from app.services.crud import CRUD
+from sqlalchemy import cast, func
+from sqlalchemy.dialects.postgresql import JSONB
 from app.services.custom_errors import *
+from app.services.ivr_lookup import find_ivr_lead, ivr_loan_date
+from app.services.ivr_events import publish_ivr_event
 from app.models import MailingLead as ML, MailingResponse as MR
 from app.services.utils import (
     convert_utc_to_timezone
     )
 from config import Config_is
 from constants import LEAD_CATEGORY
-from app import tasks
+from app import db
 
 def loan_date_format_with_suffix(date_obj: datetime.date) -> str:
     if not date_obj:
@@ -24,195 +26,157 @@ def loan_date_format_with_suffix(date_obj: datetime.date) -> str:
         suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
     return date_obj.strftime(f"%B {day}{suffix} %Y")
 
-def twilio_mortgage_id_validation(data: Dict) -> Dict:
+def inventory_call_dates(response: MR) -> List[str]:
+    """
+    Call in date the marketplace inventory counted the lead under, before a new call moves it
+    """
+    if response and response.call_in_date_time:
+        return [response.call_in_date_time.date().isoformat()]
+    return []
+
+
+def ivr_mortgage_id_validation(data: Dict, any_id: bool = False, file_id: int = None) -> Dict:
+    """
+    Answers the IVR keypad validation from the lookup cache, the mailing_response
+    write of the call start is a call_start event of the IVR stream.
+    any_id: match the temp or the real mortgage id, otherwise 5 digits are a temp mortgage id
+    """
     try:
         data["mortgage_id"] = data["mortgage_id"].replace("#", "").replace("*", "")
-        leads = ML.query.outerjoin(MR, MR.mortgage_id == ML.mortgage_id)
-        if len(data['mortgage_id']) == 5:
-            leads = leads.filter(ML.temp_mortgage_id == data["mortgage_id"])
-        else:
-            leads = leads.filter(ML.mortgage_id == data["mortgage_id"])
     except Exception as e:
-        leads = None
         print(e)
-    leads = leads.order_by(ML.created_at.desc()).with_entities(ML, MR).first()
-    if not leads:
-        # return {
-        #     "name": "",
-        #     "bank": "",
-        #     "date": "",
-        #     "url": "",
-        #     "status": "invalid",
-        #     "message": "Failed",
-        #     "state": "",
-        # }
         return {}
-    if leads[1] and leads[1].temp_data and leads[1].call_sid:
-        get_twilio_status_call_back({'CallSid': leads[1].call_sid, 'CallStatus': 'completed'})
+    by_temp = None if any_id else len(data['mortgage_id']) == 5
+    lead = find_ivr_lead(data["mortgage_id"], by_temp, file_id)
+    if not lead:
+        return {}
     try:
         data = json.dumps(data).replace("#", "").replace("*", "")
         data = json.loads(data)
     except Exception as e:
         print(e)
     data["timestamp"] = convert_utc_to_timezone(datetime.utcnow())
-    updates = dict(
-        call_sid=data['sid'], call_in_date_time=data["timestamp"], temp_data=data
-    )
-    if leads[-1]:
-        CRUD.update(MR, {"id": leads[-1].id}, updates)
-    else:
-        CRUD.create(MR, {"mortgage_id": leads[0].mortgage_id, **updates})
+    publish_ivr_event("call_start", {"mortgage_id": lead['mortgage_id'], "data": data})
     return dict(
-        name=leads[0].full_name,
-        mortgage_id=leads[0].mortgage_id,
-        lender_name=leads[0].lender_name,
-        loan_date=loan_date_format_with_suffix(leads[0].loan_date),
+        name=lead['full_name'],
+        mortgage_id=lead['mortgage_id'],
+        lender_name=lead['lender_name'],
+        loan_date=loan_date_format_with_suffix(ivr_loan_date(lead)),
         # loan_amount=leads[0].loan_amount,
-        source=LEAD_CATEGORY[1]['sources'][leads[0].source_id]['name'],
-        url=f"{Config_is.FRONT_END_URL}/single-mortgage-public/{leads[0].mortgage_id}/{leads[0].uuid}",
-        state=leads[0].state
+        source=LEAD_CATEGORY[1]['sources'][lead['source_id']]['name'],
+        url=f"{Config_is.FRONT_END_URL}/single-mortgage-public/{lead['mortgage_id']}/{lead['uuid']}",
+        state=lead['state']
     )
 
 
-def temp_twilio_mortgage_id_validation(data: Dict) -> Dict:
-    try:
-        data["mortgage_id"] = data["mortgage_id"].replace("#", "").replace("*", "")
-        leads = ML.query.outerjoin(MR, MR.mortgage_id == ML.mortgage_id)
-        if len(data['mortgage_id']) == 5:
-            leads = leads.filter(ML.temp_mortgage_id == data["mortgage_id"])
-        else:
-            leads = leads.filter(ML.mortgage_id == data["mortgage_id"])
-    except Exception as e:
-        leads = None
-        print(e)
-    # leads = leads.order_by(MR.created_at.desc()).with_entities(ML, MR).first()
-    leads = leads.order_by(ML.created_at.desc()).with_entities(ML, MR).first()
-    if not leads:
-        # return {
-        #     "name": "",
-        #     "bank": "",
-        #     "date": "",
-        #     "url": "",
-        #     "status": "invalid",
-        #     "message": "Failed",
-        #     "state": "",
-        # }
-        return {}
-    if leads[1] and leads[1].temp_data and leads[1].call_sid:
-        get_twilio_status_call_back({'CallSid': leads[1].call_sid, 'CallStatus': 'completed'})
-    try:
-        data = json.dumps(data).replace("#", "").replace("*", "")
-        data = json.loads(data)
-    except Exception as e:
-        print(e)
-    data["timestamp"] = convert_utc_to_timezone(datetime.utcnow())
+def apply_call_start(data: Dict) -> Dict:
+    """
+    Stores the new call on the lead response, an unfinished previous call is finalized first
+    """
+    mortgage_id, data = data["mortgage_id"], data["data"]
+    response = (
+        MR.query.filter(MR.mortgage_id == mortgage_id)
+        .with_entities(MR.id, MR.call_sid, MR.temp_data, MR.call_in_date_time)
+        .first()
+        )
+    alert = None
+    if response and response.temp_data and response.call_sid:
+        alert = finalize_ivr_call(response.call_sid)
     updates = dict(
         call_sid=data['sid'], call_in_date_time=data["timestamp"], temp_data=data
     )
-    if leads[-1]:
-        CRUD.update(MR, {"id": leads[-1].id}, updates)
+    if response:
+        MR.query.filter(
+            MR.id == response.id, MR.call_in_date_time == response.call_in_date_time
+            ).update(updates, synchronize_session=False)
     else:
-        CRUD.create(MR, {"mortgage_id": leads[0].mortgage_id, **updates})
-    return dict(
-        name=leads[0].full_name,
-        mortgage_id=leads[0].mortgage_id,
-        lender_name=leads[0].lender_name,
-        loan_date=loan_date_format_with_suffix(leads[0].loan_date),
-        # loan_amount=leads[0].loan_amount,
-        source=LEAD_CATEGORY[1]['sources'][leads[0].source_id]['name'],
-        url=f"{Config_is.FRONT_END_URL}/single-mortgage-public/{leads[0].mortgage_id}/{leads[0].uuid}",
-        state=leads[0].state
-    )
+        db.session.add(MR(mortgage_id=mortgage_id, **updates))
+    return {
+        "mortgage_id": mortgage_id, "previous_call_dates": inventory_call_dates(response), "alert": alert,
+        "closed_call_sid": response.call_sid if response else None, "opened_call_sid": data['sid']
+        }
+
+
+def twilio_mortgage_id_validation(data: Dict) -> Dict:
+    return ivr_mortgage_id_validation(data)
+
+
+def temp_twilio_mortgage_id_validation(data: Dict) -> Dict:
+    return ivr_mortgage_id_validation(data)
 
 
 def temp_twilio_mortgage_id_validation_for_file(data: Dict, file_id: int = None) -> Dict:
-    try:
-        data["mortgage_id"] = data["mortgage_id"].replace("#", "").replace("*", "")
-        leads = ML.query.outerjoin(MR, MR.mortgage_id == ML.mortgage_id)
-        leads = leads.filter(or_(ML.temp_mortgage_id == data["mortgage_id"], ML.mortgage_id == data["mortgage_id"]))
-        if file_id:
-            leads = leads.filter(ML.file_id == file_id)
-    except Exception as e:
-        leads = None
-        print(e)
-    # leads = leads.order_by(MR.created_at.desc()).with_entities(ML, MR).first()
-    leads = leads.order_by(ML.created_at.desc()).with_entities(ML, MR).first()
-    if not leads:
-        return {}
-    if leads[1] and leads[1].temp_data and leads[1].call_sid:
-        get_twilio_status_call_back({'CallSid': leads[1].call_sid, 'CallStatus': 'completed'})
-    try:
-        data = json.dumps(data).replace("#", "").replace("*", "")
-        data = json.loads(data)
-    except Exception as e:
-        print(e)
-    data["timestamp"] = convert_utc_to_timezone(datetime.utcnow())
-    updates = dict(
-        call_sid=data['sid'], call_in_date_time=data["timestamp"], temp_data=data
-    )
-    if leads[-1]:
-        CRUD.update(MR, {"id": leads[-1].id}, updates)
-    else:
-        CRUD.create(MR, {"mortgage_id": leads[0].mortgage_id, **updates})
-    data = dict(
-        name=leads[0].full_name,
-        mortgage_id=leads[0].mortgage_id,
-        lender_name=leads[0].lender_name,
-        loan_date=loan_date_format_with_suffix(leads[0].loan_date),
-        # loan_amount=leads[0].loan_amount,
-        source=LEAD_CATEGORY[1]['sources'][leads[0].source_id]['name'],
-        url=f"{Config_is.FRONT_END_URL}/single-mortgage-public/{leads[0].mortgage_id}/{leads[0].uuid}",
-        state=leads[0].state
-        )
-    return data
+    return ivr_mortgage_id_validation(data, any_id=True, file_id=file_id)
+
 
 def get_twilio_status_call_back(data: Dict) -> bool:
     print(f"get_twilio_status_call_back {data}")
     if data.get("CallStatus") != "completed" or not data.get("CallSid"):
         return False
+    publish_ivr_event("call_completed", {"call_sid": data["CallSid"]})
+    return True
+
+
+def finalize_ivr_call(call_sid: str) -> Optional[Dict]:
+    """
+    Moves the collected keypad answers of a finished call into the response,
+    returns the agents alert of the lead. The caller commits.
+    """
     lead_is = (
         ML.query.join(MR, MR.mortgage_id == ML.mortgage_id)
-        .filter(MR.call_sid == data.pop("CallSid"))
-        .with_entities(ML, MR)
+        .filter(MR.call_sid == call_sid)
+        .with_entities(
+            ML.state, ML.city, ML.uuid, ML.source_id, ML.full_name, ML.zip, ML.address,
+            ML.lender_name, ML.loan_amount, ML.mortgage_id,
+            MR.id.label('response_id'), MR.call_in_date_time, MR.temp_data, MR.completed
+            )
         .order_by(MR.modified_at.desc())
         .first()
     )
     print(f"lead_is {lead_is}")
-    if not lead_is or not lead_is.MailingResponse.temp_data:
+    if not lead_is or not lead_is.temp_data:
         print('no response')
-        return False
-    lead, response = lead_is
-    temp_data = response.temp_data
+        return None
+    temp_data = dict(lead_is.temp_data)
     for i in ["coborrower", "health", "tobacco", "spouse"]:
         if temp_data.get(i) == "2":
             temp_data[i] = "0"
-    response.ivr_logs = response.ivr_logs + [temp_data]
-    print(f'LOg is {response.ivr_logs}')
     mortgage_info= dict(
-        state=lead.state, city=lead.city, uuid=lead.uuid, 
-        source_id=lead.source_id, full_name=lead.full_name, 
-        zip=lead.zip, address=lead.address, 
-        lender_name=lead.lender_name, 
-        loan_amount=lead.loan_amount,
-        mortgage_id=lead.mortgage_id
+        state=lead_is.state, city=lead_is.city, uuid=lead_is.uuid, 
+        source_id=lead_is.source_id, full_name=lead_is.full_name, 
+        zip=lead_is.zip, address=lead_is.address, 
+        lender_name=lead_is.lender_name, 
+        loan_amount=lead_is.loan_amount,
+        mortgage_id=lead_is.mortgage_id
         )
-    if not response.completed:
+    completed = bool(lead_is.completed)
+    if not completed:
         if len(temp_data) > 2 and (
             all(temp_data.get(r) for r in ["age", "health", "number", "tobacco"])
             and any(temp_data.get(r) for r in ["spouse", "coborrower"])
         ):
-            response.completed = True
-    if response.completed:
-        sub = f"🔥 New Completed Lead Alert -{lead.mortgage_id}! Contact Immediately! 🔥"
+            completed = True
+    if completed:
+        sub = f"🔥 New Completed Lead Alert -{lead_is.mortgage_id}! Contact Immediately! 🔥"
     else:
-        sub = f"🔥 New Incomplete Lead Alert -{lead.mortgage_id}! Contact Immediately! 🔥"
-    response.ivr_response = temp_data
-    response.temp_data = {}
-    # response.call_sid = ""
-    CRUD.db_commit()
-    # Email and SMS alert
-    tasks.latest_ivr_response_alert_to_agents.delay(mortgage_info, sub, temp_data)
-    return True
+        sub = f"🔥 New Incomplete Lead Alert -{lead_is.mortgage_id}! Contact Immediately! 🔥"
+    # The log is appended in the database, the existing entries are never loaded
+    # the partition key in the filter keeps the update on the partition of the row
+    MR.query.filter(MR.id == lead_is.response_id, MR.call_in_date_time == lead_is.call_in_date_time).update({
+        MR.ivr_logs: func.coalesce(MR.ivr_logs, cast("[]", JSONB)).op("||")(cast(json.dumps([temp_data]), JSONB)),
+        MR.ivr_response: temp_data,
+        MR.temp_data: {},
+        MR.completed: completed,
+        }, synchronize_session=False)
+    return {"mortgage_info": mortgage_info, "subject": sub, "ivr_response": temp_data}
+
+
+def apply_call_completed(data: Dict) -> Dict:
+    alert = finalize_ivr_call(data["call_sid"])
+    return {
+        "mortgage_id": alert["mortgage_info"]["mortgage_id"] if alert else None, "alert": alert,
+        "closed_call_sid": data["call_sid"]
+        }
 
 
 def twilio_call_response_incomplete(data: Dict) -> bool:
@@ -229,29 +193,33 @@ def twilio_call_response_incomplete(data: Dict) -> bool:
     for i in ["coborrower", "health", "tobacco", "spouse"]:
         if data.get(i) == "2":
             data[i] = "0"
+    publish_ivr_event("call_progress", data)
+    return True
+
+
+def apply_call_progress(data: Dict) -> Dict:
+    """
+    Keeps the keypad answers of the ongoing call in temp_data
+    """
     lead_is = (
         ML.query.outerjoin(MR, ML.mortgage_id == MR.mortgage_id)
         .filter(ML.mortgage_id == data.get("mortgage_id"))
-        .with_entities(ML.mortgage_id, MR.id)
+        .with_entities(ML.mortgage_id, MR.id, MR.call_in_date_time)
         .first()
     )
     print(f"lead is {lead_is}")
     if not lead_is:
-        return False
+        return {}
     if lead_is.id:
-        print(f"lead_is.id {lead_is.id}")
-        CRUD.update(
-            MR, {"id": lead_is.id}, {"temp_data": data, "call_sid": data['sid']}
-        )
+        MR.query.filter(MR.id == lead_is.id, MR.call_in_date_time == lead_is.call_in_date_time).update(
+            {"temp_data": data, "call_sid": data['sid']}, synchronize_session=False)
     else:
-        CRUD.create(
-            MR,
-            {"mortgage_id": data["mortgage_id"]},
-            {
-                "temp_data": data,
-                "call_sid": data['sid'],
-                "timestamp": data["timestamp"],
-            },
-        )
-    return True
+        db.session.add(MR(mortgage_id=data["mortgage_id"], temp_data=data, call_sid=data['sid']))
+    return {"opened_call_sid": data['sid']}
+
 
+IVR_EVENT_HANDLERS = {
+    "call_start": apply_call_start,
+    "call_progress": apply_call_progress,
+    "call_completed": apply_call_completed,
+    }
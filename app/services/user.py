@@ -18,7 +18,10 @@ from app.models import (
     )
 from app.services.utils import email_format_validation
 from app.services.sendgrid_email import SendgridEmailSending
+from app.services.sms_dispatch import dispatch_sms
 from app.services.crud import CRUD
+from app.services.pagination import keyset_paginate
+from app.services.text_search import contains, similarity_rank
 from app.services.utils import (
     discard_crucial_user_data,
     generate_short_code, 
@@ -29,7 +32,6 @@ from app.services.custom_errors import *
 from app import db, redis_obj
 from config import Config_is
 from constants import LEAD_CATEGORY
-from app import tasks
 
 
 def verify_registration_short_url(id_: str) -> str:
@@ -70,10 +72,12 @@ def sent_email_invitation(
         [to_email], f"{Config_is.APP_NAME} Application Invitation", 
         invitation_html, 1
         ).send_email()
-    tasks.celery_twilio_sms(
-        to=phone, 
-        body=f"You are invited to join {Config_is.APP_NAME} {Config_is.FRONT_END_REGISTRATION_SHORT_URL}/{temp_id}", 
-        twilio_from_numbers=[Config_is.TWILIO_SMS_NUMBER_FOR_INVITATION]
+    dispatch_sms(
+        [{
+            "to": phone, "event": 1,
+            "body": f"You are invited to join {Config_is.APP_NAME} {Config_is.FRONT_END_REGISTRATION_SHORT_URL}/{temp_id}"
+        }],
+        [Config_is.TWILIO_SMS_NUMBER_FOR_INVITATION]
         )
     
     if response:
@@ -225,13 +229,26 @@ def change_user_active_inactive_status(
     return True
 
 
-def list_users_with_filter(page: int, per_page: int, query_filters: Dict) -> Tuple:
-    users_obj = User.query
+def list_users_with_filter(page: int, per_page: int, query_filters: Dict, 
+                           after: Optional[str] = None, exact_total: bool = False) -> Tuple:
+    users_obj, rank = User.query, None
     if query_filters.get('name'):
-        users_obj =  users_obj.filter(User.name.ilike(f"%{query_filters.pop('name')}%"))
+        name = query_filters.pop('name')
+        users_obj =  users_obj.filter(contains([User.name], name))
+        # the keyset cursor needs the plain order, only the page based listing is ranked
+        rank = similarity_rank([User.name], name) if after is None else None
     for k, v in query_filters.items():
          users_obj =  users_obj.filter(getattr(User, k) == v)
-    users_obj = users_obj.order_by(User.modified_at.desc()).paginate(
+    if rank is not None:
+        users_obj = users_obj.order_by(rank.desc())
+    users_obj = users_obj.order_by(User.modified_at.desc())
+    if after is not None:
+        items, pagination = keyset_paginate(users_obj, [User.modified_at, User.id], after, per_page, exact_total)
+        data = [user_obj.to_dict() for user_obj in items]
+        if data:
+            return data, pagination
+        raise NoContent()
+    users_obj = users_obj.paginate(
         page=page, per_page=per_page, error_out=False
     )
     data = [user_obj.to_dict() for user_obj in users_obj.items]
@@ -278,7 +295,7 @@ def list_agents_with_filter(page: int, per_page: int, category_id: int = None,
             raise NoContent()
         else:
             agents_obj = agents_obj.filter(
-                User.name.ilike(f"%{agent_id_or_name}%")
+                contains([User.name], agent_id_or_name)
                 )
     agents_obj = agents_obj.order_by(User.modified_at.desc()).paginate(
         page=page, per_page=per_page, error_out=False)
@@ -326,7 +343,7 @@ def list_agents_for_assignment(
     if source_id:
         db_query = db_query.filter(Agent.source == source_id)
     if data.get("name"):
-        db_query = db_query.filter(User.name.ilike(f"%{data['name']}%"))
+        db_query = db_query.filter(contains([User.name], data['name']))
     elif data.get("agent_id"):
         db_query = db_query.filter(Agent.id == data["agent_id"])
     db_query = db_query.with_entities(
@@ -1,23 +1,35 @@
-import random
+import os
+import socket
 import ssl
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict
 
 from flask import render_template
 from celery import Celery
 from celery.schedules import crontab
-from twilio.rest import Client
-from celery.signals import task_postrun, task_failure
+from kombu import Queue
+from celery.signals import before_task_publish, task_prerun, task_postrun, task_failure
 
 from app import create_app, db, redis_obj
 from app.models import (
     MailingAssignee as MA, 
-    MailingResponse as MR,
-    MailingLead as ML, 
     User, Agent
     )
-from app.services.crud import CRUD
-from app.services.sendgrid_email import SendgridEmailSending
+from app.services.sendgrid_email import SendgridEmailSending, flush_email_outbox as flush_sendgrid_outbox
+from app.services.mailer_ingest import (
+    ingest_uploaded_mailer_file,
+    mark_upload_failed
+    )
+from app.services import (
+    marketplace_inventory, ivr_lookup, ivr_events, sms_dispatch, dashboard_rollup, report_summary, table_partitions,
+    lead_archive
+    )
+from app.services.aggregate_cache import invalidate_aggregate_cache
+from app.services.reservation_ledger import release_expired_reservations
+from app.services.task_queues import (
+    MAINTENANCE_QUEUE, TASK_QUEUES, TASK_ROUTES, record_task_latency
+    )
 from config import Config_is
 from constants import (DISABLED_STATES, FLAGGED_IVR_RESULT)
 
@@ -32,19 +44,75 @@ app.conf.broker_use_ssl = {
     'ssl_check_hostname': False
 }
 
+app.conf.task_queues = [Queue(queue) for queue in TASK_QUEUES]
+app.conf.task_default_queue = MAINTENANCE_QUEUE
+app.conf.task_routes = TASK_ROUTES
+# Workers reserve only what they run, a slow task does not hold back the queue behind it
+app.conf.worker_prefetch_multiplier = 1
+
+# The frequent runs expire instead of piling up while their queue is backed up
 app.conf.beat_schedule = {
-    # 'run-every-6-minute': {
-    #     'task': 'app.tasks.clear_expired_reserved_leads',
-    #     'schedule': timedelta(seconds=360)
-    # },
+    'process-ivr-events-every-3-seconds': {
+        'task': 'app.tasks.process_ivr_events',
+        'schedule': timedelta(seconds=3),
+        'options': {'expires': 3}
+    },
+    'flush-email-outbox-every-2-seconds': {
+        'task': 'app.tasks.flush_email_outbox',
+        'schedule': timedelta(seconds=2),
+        'options': {'expires': 2}
+    },
+    'release-expired-reservations-every-minute': {
+        'task': 'app.tasks.clear_expired_reserved_leads',
+        'schedule': timedelta(seconds=60),
+        'options': {'expires': 60}
+    },
     'run-every-2-minute': {
         'task': 'app.tasks.clear_latest_ivr_temp_data',
-        'schedule': timedelta(seconds=120)
+        'schedule': timedelta(seconds=120),
+        'options': {'expires': 120}
+    },
+    'rebuild-marketplace-inventory-daily': {
+        'task': 'app.tasks.rebuild_marketplace_inventory',
+        'schedule': crontab(hour=0, minute=5)
+    },
+    'refresh-dashboard-rollup-every-5-minutes': {
+        'task': 'app.tasks.refresh_dashboard_rollup',
+        'schedule': timedelta(minutes=5),
+        'options': {'expires': 300}
+    },
+    'rebuild-dashboard-rollup-daily': {
+        'task': 'app.tasks.rebuild_dashboard_rollup',
+        'schedule': crontab(hour=0, minute=15)
+    },
+    'close-report-summary-day-daily': {
+        'task': 'app.tasks.close_report_summary_day',
+        'schedule': crontab(hour=0, minute=20)
+    },
+    'maintain-table-partitions-daily': {
+        'task': 'app.tasks.maintain_table_partitions',
+        'schedule': crontab(hour=0, minute=30)
+    },
+    'archive-old-leads-daily': {
+        'task': 'app.tasks.archive_old_leads',
+        'schedule': crontab(hour=1, minute=0)
     },
 }
 
 app.conf.timezone = 'UTC'
 
+@before_task_publish.connect
+def stamp_enqueued_at(sender=None, headers=None, **kwargs):
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+
+@task_prerun.connect
+def track_queue_latency(task_id=None, task=None, *args, **kwargs):
+    record_task_latency(
+        (task.request.delivery_info or {}).get('routing_key'), task.request.get('enqueued_at'))
+
+
 @task_postrun.connect
 def close_session(*args, **kwargs):
     """
@@ -60,20 +128,14 @@ def log_task_failure(sender=None, task_id=None, exception=None, *args, **kwargs)
     db.session.remove()
 
 @app.task
-def celery_twilio_sms(to: str, body: str, twilio_from_numbers: list = Config_is.TWILIO_SMS_NUMBERS) -> bool:
+def celery_twilio_sms(to: str, body: str, twilio_from_numbers: list = None) -> bool:
     # body = f'{body}\nIf you would no longer like to receive these messages REPLY STOP to unsubscribe.'
-    print('started celery_twilio_sms')
-    print(twilio_from_numbers)
-    try:
-        client = Client(Config_is.TWILIO_SID, Config_is.TWILIO_TOKEN)
-        message_send = client.messages.create(
-            body=body,
-            from_=random.choice(twilio_from_numbers),
-            to=to)
-    except Exception as e:
-        print('twilio exceptiomn')
-        print(e)
-    return True
+    return sms_dispatch.send_sms_batch([{"to": to, "body": body}], twilio_from_numbers) == 1
+
+
+@app.task
+def send_sms_batch(messages: List[Dict], from_numbers: List[str] = None) -> int:
+    return sms_dispatch.send_sms_batch(messages, from_numbers)
 
 
 @app.task
@@ -110,31 +172,125 @@ def latest_ivr_response_alert_to_agents(mortgage_info: Dict, subject: str, ivr_r
     if ivr_response.get('age'):
         sms_body = f"{sms_body} Age: {ivr_response['age']}"
     sms_body = f"{sms_body} {mortgage_info['url']}"
-    for ld_mem in lead_members_obj:
-        SendgridEmailSending([{'user_id': str(ld_mem.user_id), 'email': ld_mem.email}], subject, render_template("email_ivr_response.html", data=mortgage_info), 9).send_email()
-        # celery_twilio_sms.delay(row.phone, body)
+    # One request with a personalization per member
+    members = list({ld_mem.email: {'user_id': str(ld_mem.user_id), 'email': ld_mem.email} for ld_mem in lead_members_obj}.values())
+    if members:
+        SendgridEmailSending(members, subject, render_template("email_ivr_response.html", data=mortgage_info), 9).send_email()
+    if Config_is.IVR_ALERT_SMS:
+        phones = sorted({ld_mem.phone for ld_mem in lead_members_obj if ld_mem.phone})
+        sms_dispatch.dispatch_sms([{"to": phone, "body": sms_body, "event": 9} for phone in phones])
     return True
 
 
 @app.task
-def clear_latest_ivr_temp_data():
-    from app.services.twilio_call_sms import get_twilio_status_call_back
-    for mr in MR.query.filter(MR.call_in_date_time <= (datetime.utcnow()-timedelta(minutes=5))).with_entities(MR.call_sid, MR.temp_data).all():
-        if mr.temp_data and mr.temp_data:
-            get_twilio_status_call_back({"CallSid": mr.call_sid, 'CallStatus': 'completed'})
-    return True
+def clear_latest_ivr_temp_data() -> int:
+    """
+    Finalizes the calls still open 5 minutes after they started, returns how many were closed
+    """
+    return ivr_events.close_stale_ivr_calls()
 
 @app.task
-def clear_expired_reserved_leads(shopping_cart_temp_ids: str):
+def clear_expired_reserved_leads(*args):
     """
-    Reserved leads in marketplace will be cleared after 17mins if its not assigned successfully
+    Reserved leads in marketplace will be cleared after 17mins if its not assigned successfully.
+    The expiries come from the reservation ledger, the arguments of the old per checkout
+    countdown tasks are ignored.
     """
-    print(f"clear_expired_reserved_leads -> {shopping_cart_temp_ids}")
-    ML.query.filter(ML.item_reserved_temp_by.in_(shopping_cart_temp_ids)).update(
-        {'is_in_checkout': False, 
-        'shopping_cart_temp_id': None, 
-        'item_reserved_temp_by': None, 
-        'modified_at': ML.modified_at
-        })
-    CRUD.db_commit()
+    released = release_expired_reservations()
+    if released:
+        marketplace_inventory.refresh_marketplace_inventory(released)
     return True
+
+
+@app.task
+def flush_email_outbox() -> int:
+    return flush_sendgrid_outbox()
+
+
+@app.task
+def process_ivr_events() -> int:
+    return ivr_events.process_ivr_events(f"{socket.gethostname()}-{os.getpid()}")
+
+
+@app.task
+def warm_ivr_lookup(file_id: int = None) -> int:
+    return ivr_lookup.warm_ivr_lookup(file_id)
+
+
+@app.task
+def refresh_marketplace_inventory(mortgage_ids: List[str], previous_call_dates: List[str] = None) -> int:
+    return marketplace_inventory.refresh_marketplace_inventory(mortgage_ids, previous_call_dates)
+
+
+@app.task
+def rebuild_marketplace_inventory() -> int:
+    return marketplace_inventory.rebuild_marketplace_inventory()
+
+
+@app.task
+def refresh_dashboard_rollup() -> int:
+    refreshed = dashboard_rollup.refresh_recent_dashboard_rollup()
+    invalidate_aggregate_cache("dashboard")
+    return refreshed
+
+
+@app.task
+def rebuild_dashboard_rollup() -> int:
+    rebuilt = dashboard_rollup.rebuild_dashboard_rollup()
+    invalidate_aggregate_cache("dashboard")
+    return rebuilt
+
+
+@app.task
+def refresh_report_summary(days: List[str]) -> int:
+    refreshed = report_summary.refresh_report_summary(days)
+    invalidate_aggregate_cache("report")
+    return refreshed
+
+
+@app.task
+def close_report_summary_day() -> int:
+    """
+    Stores the day that just ended, the reports stop reading it live
+    """
+    yesterday = datetime.utcnow().date() - timedelta(days=1)
+    return refresh_report_summary(
+        [yesterday.isoformat(), (yesterday - timedelta(days=1)).isoformat()])
+
+
+@app.task
+def rebuild_report_summary() -> int:
+    rebuilt = report_summary.rebuild_report_summary()
+    invalidate_aggregate_cache("report")
+    return rebuilt
+
+
+@app.task
+def maintain_table_partitions() -> Dict:
+    return table_partitions.maintain_partitions()
+
+
+@app.task
+def archive_old_leads() -> int:
+    archived = lead_archive.archive_old_leads()
+    if archived:
+        invalidate_aggregate_cache()
+    return archived
+
+
+@app.task(bind=True, max_retries=5, default_retry_delay=60)
+def ingest_mailer_upload(self, file_id: int, csv_headers: Dict) -> bool:
+    """
+    Loads an uploaded mailer file from s3 in committed chunks,
+    a retry resumes after the last committed chunk of the file.
+    """
+    print(f"ingest_mailer_upload -> {file_id} attempt {self.request.retries}")
+    try:
+        return ingest_uploaded_mailer_file(file_id, csv_headers)
+    except Exception as e:
+        db.session.rollback()
+        print(f"ingest_mailer_upload {file_id} exception {e}")
+        if self.request.retries >= self.max_retries:
+            mark_upload_failed(file_id, str(e))
+            raise
+        raise self.retry(exc=e)
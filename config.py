@@ -16,17 +16,28 @@ class Config:
     DEBUG = os.environ.get('DEBUG', False)
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL'].replace('postgres://', 'postgresql://')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_FANOUT_WORKERS = int(os.environ.get('DB_FANOUT_WORKERS', 8))
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', DB_FANOUT_WORKERS + 2))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 4))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
     SECRET_KEY = os.environ['SECRET_KEY']
     AUTH_TOKEN_EXPIRES = int(os.environ['AUTH_TOKEN_EXPIRES'])
     SENDGRID_EMAIL_ADDRESS = os.environ['SENDGRID_EMAIL_ADDRESS']
     SENDGRID_API_KEY = os.environ['SENDGRID_API_KEY']
+    # Point at sendgrid_stub.py to run without the real service
+    SENDGRID_API_URL = os.environ.get('SENDGRID_API_URL', 'https://api.sendgrid.com/v3/mail/send')
     AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
     AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
     AWS_BUCKET_REGION = os.environ['AWS_BUCKET_REGION']
     S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
+    # Leads uploaded and last active before this many days are moved to the S3 archive
+    LEAD_ARCHIVE_HORIZON_DAYS = int(os.environ.get('LEAD_ARCHIVE_HORIZON_DAYS', 760))
     REDIS_URL = os.environ['REDIS_URL']
     TWILIO_SID = os.environ['TWILIO_SID']
     TWILIO_TOKEN = os.environ['TWILIO_TOKEN']
+    # Messages are accepted locally without calling Twilio
+    TWILIO_FAKE_TRANSPORT = os.environ.get('TWILIO_FAKE_TRANSPORT', '').lower() in ('1', 'true')
+    IVR_ALERT_SMS = os.environ.get('IVR_ALERT_SMS', '').lower() in ('1', 'true')  # texts the agents besides the email
     CRYPTO_KEY = os.environ['CRYPTO_KEY']
     SUPPRESSION_LIST_ALERT_TO = [_.strip() for _ in os.environ.get('SUPPRESSION_LIST_ALERT_TO', '').split(',')]
     TIME_ZONE = os.environ.get('TIME_ZONE')
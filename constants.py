@@ -28,6 +28,8 @@ LEAD_CATEGORY = {
     # }
 }
 
+MAILER_UPLOAD_STATUS = {1: 'Queued', 2: 'Processing', 3: 'Completed', 4: 'Failed'}
+
 CSV_DOWNLOAD_MORTGAGE_FIELDS = ["Identifier", "Lead Full Name", "Client Address", "City", "State", "Zip", "Lender", "Loan Amount", "Loan Date", " Agent ID", "Call In Date", "Lead Phone Number", "Borrower Age", "Borrower Medical Issues", "Borrower Tobacco Use,Co-Borrower?", "Borrower Phone", "First Name", "Last Name", "Lead Status"]
 CSV_DOWNLOAD_IVR_COMPLETED_FIELDS = ["Identifier", "Lead Full Name", "Client Address", "City", "State", "Zip", "Lender", "Loan Amount", "Loan Date", "Agent ID", "Call In Date", "Lead Phone Number", "Borrower Age", "Borrower Medical Issues", "Borrower Tobacco Use,Co-Borrower?", "Borrower Phone", "First Name", "Last Name", "Lead Status"]
 PRICING_DETAIL_MONTH = {
@@ -0,0 +1,95 @@
+"""
+Compares the IVR documents stored as json and as JSONB: table size, a keypad answer filter
+(->> on json, @> on the GIN indexed JSONB, as the processed leads download filters) and an
+ivr_logs append (the old JSON round trip cast against the in place ||).
+
+    python scripts/bench_jsonb.py [--sizes 100000 1000000] [--appended 10000] [--repeat 3]
+
+Runs against DATABASE_URL on temporary tables shaped like mailing_response, the database is
+left as it was.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+
+app = create_app()
+
+
+SEED_SQL = [
+    "DROP TABLE IF EXISTS bench_ivr_json, bench_ivr_jsonb",
+    """
+    CREATE TEMPORARY TABLE bench_ivr_json AS
+    SELECT n AS id, doc AS ivr_response, json_build_array(doc, doc) AS ivr_logs
+    FROM generate_series(1, :count) n, LATERAL (SELECT json_build_object(
+        'health', (n % 2)::text, 'tobacco', (n / 2 % 2)::text, 'coborrower', (n / 4 % 2)::text,
+        'age', (30 + n % 50)::text, 'number', '555' || lpad(n::text, 7, '0'),
+        'ani', '+1555' || lpad(n::text, 7, '0'), 'timestamp', to_char(now(), 'MM-DD-YYYY HH24:MI:SS')
+        ) AS doc) docs
+    """,
+    """
+    CREATE TEMPORARY TABLE bench_ivr_jsonb AS
+    SELECT id, ivr_response::jsonb AS ivr_response, ivr_logs::jsonb AS ivr_logs FROM bench_ivr_json
+    """,
+    "CREATE INDEX ON bench_ivr_jsonb USING gin (ivr_response jsonb_path_ops)",
+    "ANALYZE bench_ivr_json",
+    "ANALYZE bench_ivr_jsonb",
+    ]
+SIZE_SQL = text("SELECT pg_total_relation_size(CAST(:table AS regclass))")
+FILTER_SQL = {
+    "json": text("SELECT count(*) FROM bench_ivr_json WHERE ivr_response->>'tobacco' = '1' AND ivr_response->>'health' = '0'"),
+    "jsonb": text("""SELECT count(*) FROM bench_ivr_jsonb WHERE ivr_response @> '{"tobacco": "1", "health": "0"}'"""),
+    }
+APPEND_SQL = {
+    "json": text("""
+        UPDATE bench_ivr_json SET ivr_logs = (ivr_logs::jsonb || CAST(:entry AS jsonb))::json WHERE id <= :appended
+        """),
+    "jsonb": text("UPDATE bench_ivr_jsonb SET ivr_logs = ivr_logs || CAST(:entry AS jsonb) WHERE id <= :appended"),
+    }
+LOG_ENTRY = '[{"health": "1", "tobacco": "0", "age": "52", "number": "5550000001"}]'
+
+
+def timed(statement, params=None) -> float:
+    started = time.perf_counter()
+    db.session.execute(statement, params or {})
+    return time.perf_counter() - started
+
+
+def bench(count: int, appended: int, repeat: int) -> None:
+    started = time.perf_counter()
+    for sql in SEED_SQL:
+        db.session.execute(text(sql), {"count": count})
+    print(f"{count} IVR documents seeded in {time.perf_counter() - started:.2f}s")
+    for kind in ("json", "jsonb"):
+        size = db.session.execute(SIZE_SQL, {"table": f"bench_ivr_{kind}"}).scalar()
+        filtered = statistics.median(timed(FILTER_SQL[kind]) for _ in range(repeat))
+        appends = statistics.median(
+            timed(APPEND_SQL[kind], {"entry": LOG_ENTRY, "appended": appended}) for _ in range(repeat)
+            )
+        print(f"  {kind}: {size / 1024 / 1024:.1f} MB with indexes, answer filter {filtered:.3f}s, "
+              f"{appended} log appends {appends:.3f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--appended", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with app.app_context():
+        try:
+            for count in args.sizes:
+                bench(count, args.appended, args.repeat)
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
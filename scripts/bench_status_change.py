@@ -0,0 +1,110 @@
+"""
+Times the two statements of a bulk lead status change, STATUS_CHANGE_SQL and CAN_SALE_SQL,
+over seeded leads of one agent.
+
+    python scripts/bench_status_change.py [--sizes 10000 100000] [--repeat 3]
+
+Runs against DATABASE_URL. The seeded rows live in one transaction that is rolled back at
+the end, the database is left as it was.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+
+# The app is created before the services are imported, as runserver does
+app = create_app()
+
+from app.models import User, Agent, UploadedFile as UF  # noqa: E402
+from app.services.leads_operations import STATUS_CHANGE_SQL, CAN_SALE_SQL  # noqa: E402
+from constants import EXCLUDED_STATUS_FILTER_FROM_SALE  # noqa: E402
+
+
+SEED_LEADS_SQL = text("""
+    INSERT INTO mailing_lead
+        (mortgage_id, uuid, file_id, agent_id, state, source_id, can_sale, disabled_in_marketplace,
+         is_in_checkout, is_active, created_at, modified_at)
+    SELECT :prefix || lpad(n::text, 9, '0'), left(md5(:prefix || n), 10), :file_id, :agent_id, 'CA', 1, true, false,
+        false, true, now(), now()
+    FROM generate_series(1, :count) n
+    """)
+SEED_ASSIGNEES_SQL = text("""
+    INSERT INTO mailing_assignee (mortgage_id, agent_id, lead_status, is_active, created_at, modified_at)
+    SELECT :prefix || lpad(n::text, 9, '0'), :agent_id, 1, true, now(), now()
+    FROM generate_series(1, :count) n
+    """)
+
+
+def seed(count: int):
+    """
+    count leads, each assigned to the same new agent, returns (mortgage ids, agent id, user id)
+    """
+    user = User(id=uuid4(), email=f"bench-{uuid4().hex[:12]}@example.com", name="Bench", role_id=2)
+    db.session.add(user)
+    db.session.flush()
+    agent = Agent(category=1, source=1, user_id=user.id)
+    uploaded = UF(name="bench.csv", campaign="bench", source_id=1, category=1, uploaded_by=user.id)
+    db.session.add_all([agent, uploaded])
+    db.session.flush()
+    prefix = f"B{uuid4().hex[:6]}"
+    params = {"prefix": prefix, "count": count, "agent_id": agent.id, "file_id": uploaded.id}
+    db.session.execute(SEED_LEADS_SQL, params)
+    db.session.execute(SEED_ASSIGNEES_SQL, params)
+    db.session.execute(text("ANALYZE mailing_lead"))
+    db.session.execute(text("ANALYZE mailing_assignee"))
+    return [f"{prefix}{n:09d}" for n in range(1, count + 1)], agent.id, user.id
+
+
+def timed(statement, params):
+    started = time.perf_counter()
+    rowcount = db.session.execute(statement, params).rowcount
+    return time.perf_counter() - started, rowcount
+
+
+def bench(count: int, repeat: int) -> None:
+    started = time.perf_counter()
+    mortgage_ids, agent_id, user_id = seed(count)
+    print(f"{count} leads seeded in {time.perf_counter() - started:.2f}s")
+    status_times, can_sale_times = [], []
+    for run in range(repeat):
+        # alternating between a sold and an open status flips can_sale of every lead each run
+        lead_status = EXCLUDED_STATUS_FILTER_FROM_SALE[0] if run % 2 == 0 else 1
+        seconds, changed = timed(STATUS_CHANGE_SQL, {
+            "lead_status": lead_status, "changed_at": datetime.utcnow(), "user_id": user_id,
+            "mortgage_ids": mortgage_ids, "agent_ids": [agent_id]
+            })
+        status_times.append(seconds)
+        seconds, flipped = timed(CAN_SALE_SQL, {
+            "mortgage_ids": mortgage_ids, "excluded_statuses": EXCLUDED_STATUS_FILTER_FROM_SALE
+            })
+        can_sale_times.append(seconds)
+        print(f"  run {run + 1} status {lead_status}: status change {changed} rows {status_times[-1]:.3f}s, "
+              f"can_sale {flipped} rows {can_sale_times[-1]:.3f}s")
+    print(f"{count} leads median: status change {statistics.median(status_times):.3f}s, "
+          f"can_sale {statistics.median(can_sale_times):.3f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with app.app_context():
+        try:
+            for count in args.sizes:
+                bench(count, args.repeat)
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Times the lead name search, contains() over LEAD_SEARCH_COLUMNS ordered by lead_search_rank(),
+served by the pg_trgm GIN indexes and with index scans disabled, over seeded leads.
+
+    python scripts/bench_trgm_search.py [--sizes 1000000 5000000] [--terms "john smi" "oak" "zzq"] [--repeat 3]
+
+Runs against DATABASE_URL, which needs the pg_trgm extension (flask create-indexes installs
+it). The seeded rows live in one transaction that is rolled back at the end, the database is
+left as it was.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+from uuid import uuid4
+
+from sqlalchemy import select, text
+from sqlalchemy.schema import CreateIndex
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, db  # noqa: E402
+
+# The app is created before the services are imported, as runserver does
+app = create_app()
+
+from app.models import User, Agent, MailingLead as ML, UploadedFile as UF  # noqa: E402
+from app.services.leads_operations import LEAD_SEARCH_COLUMNS, lead_search_rank  # noqa: E402
+from app.services.text_search import contains  # noqa: E402
+
+
+LEAD_TRGM_INDEXES = ["ix_mailing_lead_full_name_trgm", "ix_mailing_lead_address_trgm", "ix_mailing_lead_city_trgm"]
+SEED_LEADS_SQL = text("""
+    INSERT INTO mailing_lead
+        (mortgage_id, uuid, file_id, state, source_id, full_name, address, city, can_sale,
+         disabled_in_marketplace, is_in_checkout, is_active, created_at, modified_at)
+    SELECT :prefix || lpad(n::text, 9, '0'), left(md5(:prefix || n), 10), :file_id, 'CA', 1,
+        (ARRAY['John', 'Mary', 'James', 'Linda', 'Robert', 'Maria', 'David', 'Susan'])[1 + n % 8] || ' '
+            || (ARRAY['Smith', 'Johnson', 'Garcia', 'Brown', 'Miller', 'Davis', 'Lopez'])[1 + n / 8 % 7]
+            || ' ' || upper(substr(md5(n::text), 1, 4)),
+        n % 9000 || ' ' || (ARRAY['Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Lake'])[1 + n % 6] || ' St',
+        (ARRAY['Fresno', 'Oakland', 'Sacramento', 'San Diego', 'Long Beach', 'Bakersfield'])[1 + n / 5 % 6],
+        true, false, false, true, now(), now()
+    FROM generate_series(1, :count) n
+    """)
+
+
+def prepare() -> None:
+    """
+    Checks pg_trgm is there and builds the lead trigram indexes the database is missing, both
+    inside the transaction that is rolled back
+    """
+    if not db.session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar():
+        sys.exit("pg_trgm is not installed, run flask --app runserver create-indexes first")
+    indexes = {index.name: index for index in ML.__table__.indexes}
+    for name in LEAD_TRGM_INDEXES:
+        db.session.execute(CreateIndex(indexes[name], if_not_exists=True))
+
+
+def seed(count: int) -> None:
+    user = User(id=uuid4(), email=f"bench-{uuid4().hex[:12]}@example.com", name="Bench", role_id=2)
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(Agent(category=1, source=1, user_id=user.id))
+    uploaded = UF(name="bench.csv", campaign="bench", source_id=1, category=1, uploaded_by=user.id)
+    db.session.add(uploaded)
+    db.session.flush()
+    db.session.execute(SEED_LEADS_SQL, {"prefix": f"T{uuid4().hex[:6]}", "count": count, "file_id": uploaded.id})
+    db.session.execute(text("ANALYZE mailing_lead"))
+
+
+def search(term: str):
+    return select(ML.mortgage_id).where(
+        contains(LEAD_SEARCH_COLUMNS, term)
+        ).order_by(lead_search_rank(term).desc()).limit(20)
+
+
+def timed(statement):
+    started = time.perf_counter()
+    rows = db.session.execute(statement).all()
+    return time.perf_counter() - started, len(rows)
+
+
+def bench(count: int, seeded: int, terms, repeat: int) -> None:
+    started = time.perf_counter()
+    seed(count - seeded)
+    print(f"{count} leads seeded in {time.perf_counter() - started:.2f}s")
+    for term in terms:
+        indexed, scanned = [], []
+        for _ in range(repeat):
+            seconds, found = timed(search(term))
+            indexed.append(seconds)
+            db.session.execute(text("SET LOCAL enable_bitmapscan = off"))
+            db.session.execute(text("SET LOCAL enable_indexscan = off"))
+            seconds, _ = timed(search(term))
+            scanned.append(seconds)
+            db.session.execute(text("SET LOCAL enable_bitmapscan = on"))
+            db.session.execute(text("SET LOCAL enable_indexscan = on"))
+        print(f"  {term!r}: {found} rows, trigram index {statistics.median(indexed):.3f}s, "
+              f"scan {statistics.median(scanned):.3f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000000, 5000000])
+    parser.add_argument("--terms", nargs="+", default=["john smi", "oak", "bakersf", "zzq"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with app.app_context():
+        try:
+            prepare()
+            seeded = 0
+            # each size tops up the leads seeded for the one before
+            for count in sorted(args.sizes):
+                bench(count, seeded, args.terms, args.repeat)
+                seeded = count
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
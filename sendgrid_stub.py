@@ -0,0 +1,54 @@
+"""
+Local stand-in for the SendGrid v3/mail/send endpoint.
+
+    python sendgrid_stub.py [port]
+    SENDGRID_API_URL=http://127.0.0.1:8025/v3/mail/send
+
+Accepted requests are kept in memory, GET /messages lists them and DELETE /messages clears them.
+"""
+import sys
+import json
+from uuid import uuid4
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+received = []
+
+
+class SendgridStubHandler(BaseHTTPRequestHandler):
+    def _reply(self, status: int, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path != "/v3/mail/send":
+            return self._reply(404, {"errors": [{"message": "not found"}]})
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except Exception as e:
+            return self._reply(400, {"errors": [{"message": str(e)}]})
+        if not data.get("personalizations") or len(data["personalizations"]) > 1000:
+            return self._reply(400, {"errors": [{"message": "personalizations must have 1 to 1000 items"}]})
+        received.append(data)
+        print(f"sendgrid stub {data.get('subject')} personalizations {len(data['personalizations'])}")
+        self._reply(202, headers={"X-Message-Id": uuid4().hex})
+
+    def do_GET(self):
+        if self.path != "/messages":
+            return self._reply(404, {"errors": [{"message": "not found"}]})
+        self._reply(200, received)
+
+    def do_DELETE(self):
+        received.clear()
+        self._reply(204)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8025
+    print(f"sendgrid stub listening on {port}")
+    ThreadingHTTPServer(("127.0.0.1", port), SendgridStubHandler).serve_forever()